@@ -0,0 +1,220 @@
+"""
+Compares serving the API with gunicorn's gevent workers (WSGI) against
+uvicorn workers (ASGI) running the async views.
+
+Starts each deployment in turn on a scratch database holding running jobs,
+holds `--streams` SSE streams open on them while `--pollers` clients poll
+/progress/ for `--duration` seconds, and reports the streams that got their
+first event, progress latency and throughput and the server memory as JSON.
+
+    python -m benchmarks.bench_asgi [--streams 1000] [--pollers 50] --output run.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEPLOYMENTS = {
+    "gevent": ["open_weather_project.wsgi:application", "-k", "gevent"],
+    "asgi": ["open_weather_project.asgi:application", "-k", "uvicorn.workers.UvicornWorker"],
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--deployments", default="gevent,asgi", help="comma separated, from gevent and asgi")
+    parser.add_argument("--streams", type=int, default=500, help="SSE streams held open")
+    parser.add_argument("--pollers", type=int, default=50, help="clients polling /progress/ in a loop")
+    parser.add_argument("--jobs", type=int, default=20, help="running jobs the clients spread over")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of load per deployment")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn workers per deployment")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    return parser.parse_args()
+
+
+def configure(database):
+    os.environ.update(
+        DJANGO_SETTINGS_MODULE="open_weather_project.settings",
+        SECRET_KEY=os.environ.get("SECRET_KEY", "benchmark"),
+        SQLITE_PATH=database,
+        OPEN_WEATHER_API_KEY="benchmark",
+        OPEN_WEATHER_STREAM_POLL_INTERVAL="1",
+        OPEN_WEATHER_STREAM_HEARTBEAT="1",
+        OPEN_WEATHER_METRICS="0",
+    )
+    import django
+
+    django.setup()
+
+
+def create_jobs(count):
+    from django.core.management import call_command
+    from django.utils import timezone
+
+    from open_weather_api.models import WeatherData
+
+    call_command("migrate", verbosity=0)
+    now = timezone.now()
+    jobs_ids = [f"bench-{number}" for number in range(count)]
+    WeatherData.objects.bulk_create(
+        WeatherData(
+            user_defined_id=user_defined_id,
+            request_datetime=now,
+            status=WeatherData.RUNNING,
+            started_at=now,
+            updated_at=now,
+            cities_ids=[1],
+            total_cities=1,
+        )
+        for user_defined_id in jobs_ids
+    )
+    return jobs_ids
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(deployment, port, workers):
+    command = [
+        sys.executable, "-m", "gunicorn", *DEPLOYMENTS[deployment],
+        "-b", f"127.0.0.1:{port}", "-w", str(workers), "--worker-connections", "10000",
+    ]
+    server = subprocess.Popen(command, cwd=ROOT, stderr=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/ratelimit/", timeout=1)
+            return server
+        except httpx.TransportError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f"{deployment} server did not start")
+
+
+def server_rss_mb(server):
+    """
+    Resident memory of the gunicorn master and its workers.
+    """
+    pids = [server.pid]
+    children = subprocess.run(["pgrep", "-P", str(server.pid)], capture_output=True, text=True)
+    pids += [int(pid) for pid in children.stdout.split()]
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except FileNotFoundError:
+            continue
+    return round(total / 1024, 1)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def hold_stream(client, user_defined_id, opened, stop):
+    try:
+        async with client.stream("GET", f"/collect/{user_defined_id}/stream/") as response:
+            async for _ in response.aiter_bytes():
+                opened.append(user_defined_id)
+                # Only the first event matters, then the stream is just held
+                await stop.wait()
+                return
+    except httpx.HTTPError:
+        return
+
+
+async def poll_progress(client, jobs_ids, latencies, errors, stop):
+    number = 0
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            response = await client.get(f"/progress/{jobs_ids[number % len(jobs_ids)]}/")
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - started)
+        except httpx.HTTPError:
+            errors.append(1)
+        number += 1
+
+
+async def load(base_url, args, jobs_ids):
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    timeout = httpx.Timeout(30, pool=None)
+    opened = []
+    latencies = []
+    errors = []
+    stop = asyncio.Event()
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+        tasks = [
+            asyncio.ensure_future(hold_stream(client, jobs_ids[number % len(jobs_ids)], opened, stop))
+            for number in range(args.streams)
+        ]
+        tasks += [
+            asyncio.ensure_future(poll_progress(client, jobs_ids, latencies, errors, stop))
+            for _ in range(args.pollers)
+        ]
+        await asyncio.sleep(args.duration)
+        stop.set()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return opened, latencies, errors
+
+
+def run(deployment, args, jobs_ids):
+    port = free_port()
+    server = start_server(deployment, port, args.workers)
+    try:
+        opened, latencies, errors = asyncio.run(load(f"http://127.0.0.1:{port}", args, jobs_ids))
+        rss = server_rss_mb(server)
+    finally:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait()
+    return {
+        "streams_opened": len(opened),
+        "progress_requests": len(latencies),
+        "progress_errors": len(errors),
+        "progress_per_second": round(len(latencies) / args.duration, 1),
+        "progress_latency_p50_ms": round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+        "progress_latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        "server_rss_mb": rss,
+    }
+
+
+def main():
+    args = parse_args()
+    results = {"config": {key: value for key, value in vars(args).items() if key != "output"}}
+    with tempfile.TemporaryDirectory() as directory:
+        configure(os.path.join(directory, "bench.sqlite3"))
+        jobs_ids = create_jobs(args.jobs)
+        for deployment in args.deployments.split(","):
+            results[deployment] = run(deployment, args, jobs_ids)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
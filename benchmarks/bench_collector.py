@@ -0,0 +1,110 @@
+"""
+Compares the pipelined collector against the old chunk-then-sleep loop,
+and the single-city fetch strategy against the group endpoint.
+
+Both run against a local fake upstream with a long-tailed latency
+distribution. Every duration (quota window and latency) is divided by
+`--time-scale` so the benchmark finishes quickly; reported numbers are
+converted back to real seconds per 1,000 cities.
+
+    python -m benchmarks.bench_collector [--cities 300] [--time-scale 20]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "open_weather_project.settings")
+os.environ.setdefault("SECRET_KEY", "benchmark")
+django.setup()
+
+import httpx  # noqa: E402
+from django.conf import settings  # noqa: E402
+from more_itertools import chunked  # noqa: E402
+
+from open_weather_api.fake_upstream import FakeOpenWeatherServer, lognormal_latency  # noqa: E402
+from open_weather_api.collector import iter_collect  # noqa: E402
+from open_weather_api.ratelimit import TokenBucket  # noqa: E402
+
+SCENARIOS = [
+    # name, calls per window, window seconds, median latency seconds
+    ("free tier 10/11s", 10, 11.0, 0.25),
+    ("paid tier 10/1s", 10, 1.0, 0.25),
+    ("paid tier, slow upstream", 10, 1.0, 0.8),
+]
+
+
+def run_chunked(cities_ids, calls, period):
+    """
+    The previous loop: fire a chunk, wait for the slowest, sleep the rest.
+    Each call opens its own connection, as the requests.get calls it made.
+    """
+    url = settings.OPEN_WEATHER_API_URL + "/weather"
+    with ThreadPoolExecutor(calls) as pool:
+        for chunk in chunked(cities_ids, calls):
+            start_time = time.time()
+            list(pool.map(lambda city_id: httpx.get(url, params={"id": city_id}), chunk))
+            time.sleep(max(0, period - (time.time() - start_time)))
+
+
+def run_pipelined(cities_ids, calls, period, strategy="single"):
+    limiter = TokenBucket(calls, period)
+    for _ in iter_collect(cities_ids, limiter=limiter, max_in_flight=calls * 4, strategy=strategy):
+        pass
+
+
+def timed(function, *args):
+    start_time = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--cities", type=int, default=300)
+    parser.add_argument("--time-scale", type=float, default=20.0)
+    parser.add_argument("--json", action="store_true", help="print JSON instead of a table")
+    args = parser.parse_args()
+
+    cities_ids = list(range(1, args.cities + 1))
+    per_thousand = 1000 / args.cities * args.time_scale
+    results = []
+    for name, calls, period, median in SCENARIOS:
+        server = FakeOpenWeatherServer(latency=lognormal_latency(median / args.time_scale, seed=1)).start()
+        settings.OPEN_WEATHER_API_URL = server.base_url
+        scaled_period = period / args.time_scale
+        chunked_seconds = timed(run_chunked, cities_ids, calls, scaled_period) * per_thousand
+        pipelined_seconds = timed(run_pipelined, cities_ids, calls, scaled_period) * per_thousand
+        grouped_seconds = timed(run_pipelined, cities_ids, calls, scaled_period, "group") * per_thousand
+        server.shutdown()
+        results.append(
+            {
+                "scenario": name,
+                "quota_floor_s_per_1000": round(1000 / calls * period, 1),
+                "chunked_s_per_1000": round(chunked_seconds, 1),
+                "pipelined_s_per_1000": round(pipelined_seconds, 1),
+                "speedup": round(chunked_seconds / pipelined_seconds, 2),
+                "grouped_s_per_1000": round(grouped_seconds, 1),
+            }
+        )
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'scenario':<28}{'quota floor':>12}{'chunked':>10}{'pipelined':>11}{'speedup':>9}{'grouped':>10}")
+    for row in results:
+        print(
+            f"{row['scenario']:<28}{row['quota_floor_s_per_1000']:>11}s"
+            f"{row['chunked_s_per_1000']:>9}s{row['pipelined_s_per_1000']:>10}s{row['speedup']:>8}x"
+            f"{row['grouped_s_per_1000']:>9}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
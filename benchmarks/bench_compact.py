@@ -0,0 +1,124 @@
+"""
+Compares storing the readings of a finished job as a JSON list of dicts
+against the compact archive format of open_weather_api.compact.
+
+For a job of `--cities` readings, reports the stored size and the best
+time to load it: decoding the JSON document, unpacking the archive from
+bytes and from a memory-mapped file, and turning the arrays back into
+Python rows, as an export does. "page ms" is the time to read a results
+page of `--page` readings halfway through the job, which with an archive
+only reads the ranges the page spans (see compact.filter_arrays).
+
+    python -m benchmarks.bench_compact [--cities 20000] [--page 100] [--json]
+"""
+
+import argparse
+import datetime as dt
+import json
+import os
+import sys
+import tempfile
+import time
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "open_weather_project.settings")
+os.environ.setdefault("SECRET_KEY", "benchmark")
+django.setup()
+
+from django.test import override_settings  # noqa: E402
+
+from open_weather_api import fastjson  # noqa: E402
+from open_weather_api.compact import (  # noqa: E402
+    ArchiveReader,
+    FileArchive,
+    arrays_from_rows,
+    filter_arrays,
+    pack,
+    unpack,
+)
+
+COLUMNS = ["city_id", "temperature", "humidity", "observed_at"]
+
+
+def readings(count):
+    observed_at = dt.datetime(2023, 10, 1, 12, tzinfo=dt.timezone.utc)
+    return [
+        (3439525 + n, round(-20 + (n % 6000) / 100, 2), n % 101, observed_at + dt.timedelta(seconds=n % 600), n + 1)
+        for n in range(count)
+    ]
+
+
+def best(function, repeat):
+    fastest = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        fastest = min(fastest, time.perf_counter() - start)
+    return fastest * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--cities", type=int, default=20000)
+    parser.add_argument("--page", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    rows = readings(args.cities)
+    document = fastjson.dumps(
+        [dict(zip(COLUMNS, row[:3]), observed_at=row[3].isoformat()) for row in rows]
+    ).encode()
+    data = pack(arrays_from_rows(rows))
+    cursor = rows[len(rows) // 2][0]
+
+    def json_page():
+        readings = fastjson.loads(document)
+        return [reading for reading in readings if reading["city_id"] > cursor][: args.page]
+
+    def archive_page(arrays):
+        return filter_arrays(arrays, cursor, limit=args.page).rows(COLUMNS)
+
+    with tempfile.TemporaryDirectory() as directory, override_settings(OPEN_WEATHER_COMPACT_DIR=directory):
+        archive = FileArchive()
+        archive.write("bench", data)
+        # Decoding JSON already gives Python values, so loading is all it costs
+        json_ms = best(lambda: fastjson.loads(document), args.repeat)
+        results = {
+            "json list of dicts": {
+                "bytes": len(document),
+                "load_ms": json_ms,
+                "rows_ms": json_ms,
+                "page_ms": best(json_page, args.repeat),
+            },
+            "archive bytes": {
+                "bytes": len(data),
+                "load_ms": best(lambda: unpack(data), args.repeat),
+                "rows_ms": best(lambda: unpack(data).rows(COLUMNS), args.repeat),
+                "page_ms": best(lambda: archive_page(unpack(data)), args.repeat),
+            },
+            "archive file (mmap)": {
+                "bytes": os.path.getsize(archive.path("bench")),
+                "load_ms": best(lambda: archive.read("bench"), args.repeat),
+                "rows_ms": best(lambda: archive.read("bench").rows(COLUMNS), args.repeat),
+                "page_ms": best(lambda: archive_page(ArchiveReader(archive, "bench")), args.repeat),
+            },
+        }
+
+    if args.json:
+        print(json.dumps({name: {key: round(value, 3) for key, value in result.items()} for name, result in results.items()}, indent=2))
+        return
+    baseline = results["json list of dicts"]
+    print(f"{'storage':<24}{'bytes':>12}{'size':>8}{'load ms':>10}{'rows ms':>10}{'speedup':>9}{'page ms':>10}{'speedup':>9}")
+    for name, result in results.items():
+        print(
+            f"{name:<24}{result['bytes']:>12}{result['bytes'] / baseline['bytes']:>7.0%}"
+            f"{result['load_ms']:>10.3f}{result['rows_ms']:>10.3f}{baseline['rows_ms'] / result['rows_ms']:>8.1f}x"
+            f"{result['page_ms']:>10.3f}{baseline['page_ms'] / result['page_ms']:>8.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+End-to-end benchmark of a collection through /collect/ and /progress/.
+
+Starts the bundled fake OpenWeather server, queues `--jobs` collections of
+`--cities` cities each through the API, runs a collect_worker until they are
+done while polling their progress, and reports throughput, per-city upstream
+latency, database writes per city and peak memory as JSON.
+
+    python -m benchmarks.bench_e2e --output run.json [--compare previous.json]
+"""
+
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--jobs", type=int, default=2)
+    parser.add_argument("--cities", type=int, default=500, help="cities per job")
+    parser.add_argument("--latency", default="lognormal:0.02:0.8", help="fake upstream latency")
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    parser.add_argument("--quota", default="", help="fake upstream quota as <calls>/<seconds>")
+    parser.add_argument("--rate-limit", default="1000/1", help="collector rate limit as <calls>/<seconds>")
+    parser.add_argument("--strategy", default="single", choices=["single", "group"])
+    parser.add_argument(
+        "--trace-memory", action="store_true", help="also report the peak of Python allocations (slower)"
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    return parser.parse_args()
+
+
+def configure(args, database):
+    calls, period = args.rate_limit.split("/")
+    os.environ.update(
+        DJANGO_SETTINGS_MODULE="open_weather_project.settings",
+        SECRET_KEY=os.environ.get("SECRET_KEY", "benchmark"),
+        SQLITE_PATH=database,
+        OPEN_WEATHER_API_KEY="benchmark",
+        OPEN_WEATHER_RATE_LIMIT_CALLS=calls,
+        OPEN_WEATHER_RATE_LIMIT_PERIOD=period,
+        OPEN_WEATHER_FETCH_STRATEGY=args.strategy,
+        OPEN_WEATHER_WORKER_POLL_INTERVAL="0.05",
+    )
+    import django
+
+    django.setup()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(args):
+    from asgiref.sync import async_to_sync
+    from django.core.management import call_command
+    from django.db.backends.signals import connection_created
+    from django.test import Client
+
+    from open_weather_api.client import RequestTiming
+    from open_weather_api.fake_upstream import FakeOpenWeatherServer, parse_latency
+    from open_weather_api.jobs import Worker
+
+    call_command("migrate", verbosity=0)
+    quota = None
+    if args.quota:
+        calls, period = args.quota.split("/")
+        quota = (int(calls), float(period))
+    server = FakeOpenWeatherServer(
+        latency=parse_latency(args.latency, seed=1), error_rate=args.error_rate, quota=quota, seed=1
+    ).start()
+    from django.conf import settings
+
+    settings.OPEN_WEATHER_API_URL = server.base_url
+
+    db_writes = []
+
+    def count_writes(execute, sql, params, many, context):
+        if sql.lstrip().upper().startswith(WRITE_STATEMENTS):
+            db_writes.append(1)
+        return execute(sql, params, many, context)
+
+    connection_created.connect(
+        lambda connection, **kwargs: connection.execute_wrappers.append(count_writes), weak=False
+    )
+
+    latencies = []
+    finish = RequestTiming.finish
+
+    def recording_finish(timing):
+        finish(timing)
+        latencies.append(timing.total)
+        return timing
+
+    client = Client(HTTP_HOST="localhost")
+    jobs_ids = [f"bench-{time.time_ns()}-{number}" for number in range(args.jobs)]
+    cities_ids = list(range(1, args.cities + 1))
+
+    if args.trace_memory:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    for user_defined_id in jobs_ids:
+        response = client.post(
+            "/collect/", {"user_defined_id": user_defined_id, "cities_ids": cities_ids}, content_type="application/json"
+        )
+        assert response.status_code == 202, response.content
+
+    worker = Worker(concurrency=args.jobs, poll_interval=0.05)
+    with patch.object(RequestTiming, "finish", recording_finish):
+        thread = threading.Thread(target=async_to_sync(worker.run), kwargs={"burst": True})
+        thread.start()
+        progress_latencies = []
+        progress = {}
+
+        def poll():
+            for user_defined_id in jobs_ids:
+                poll_start = time.perf_counter()
+                progress[user_defined_id] = client.get(f"/progress/{user_defined_id}/").json()
+                progress_latencies.append(time.perf_counter() - poll_start)
+
+        while thread.is_alive():
+            poll()
+            time.sleep(0.1)
+        thread.join()
+        poll()
+    wall_seconds = time.perf_counter() - start_time
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    server.shutdown()
+
+    done = sum(job["done"] for job in progress.values())
+    failed = sum(job["failed"] for job in progress.values())
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "wall_seconds": round(wall_seconds, 3),
+        "cities_done": done,
+        "cities_failed": failed,
+        "cities_per_second": round(done / wall_seconds, 1),
+        "upstream_latency_p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "upstream_latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "progress_latency_p50_ms": round(percentile(progress_latencies, 0.5) * 1000, 2),
+        "progress_latency_p99_ms": round(percentile(progress_latencies, 0.99) * 1000, 2),
+        "db_writes": len(db_writes),
+        "db_writes_per_city": round(len(db_writes) / max(done, 1), 3),
+        "peak_traced_memory_mb": round(peak_traced / 2**20, 2) if args.trace_memory else None,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "upstream": dict(server.stats),
+    }
+
+
+def compare(results, previous):
+    print(f"{'metric':<28}{'previous':>12}{'current':>12}{'change':>10}", file=sys.stderr)
+    for key, value in results.items():
+        old = previous.get(key)
+        if not isinstance(value, (int, float)) or not isinstance(old, (int, float)):
+            continue
+        change = f"{(value - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"{key:<28}{old:>12}{value:>12}{change:>10}", file=sys.stderr)
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        configure(args, os.path.join(directory, "bench.sqlite3"))
+        results = run(args)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Measures the CPU cost per city of the JSON work around a collection:
+decoding the upstream response, building the stored payload, encoding the
+stream event and encoding the cached observation for its JSON field.
+
+"before" is the previous path: response.json() with the standard library,
+the full response kept and stored. "after" decodes with open_weather_api's
+fastjson backend and keeps only the projected fields.
+
+    python -m benchmarks.bench_json [--cities 20000] [--json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "open_weather_project.settings")
+os.environ.setdefault("SECRET_KEY", "benchmark")
+django.setup()
+
+from django.test import override_settings  # noqa: E402
+
+from open_weather_api import fastjson  # noqa: E402
+from open_weather_api.collector import project  # noqa: E402
+from open_weather_api.fake_upstream import weather_response  # noqa: E402
+from open_weather_api.schema import PayloadSchema  # noqa: E402
+
+SCHEMA = PayloadSchema()
+
+
+def before(body):
+    response = json.loads(body)
+    event = json.dumps(SCHEMA.build([response])[0])
+    stored = json.dumps(response)
+    return event, stored
+
+
+def after(body):
+    response = project(fastjson.loads(body))
+    event = fastjson.dumps(SCHEMA.build([response])[0])
+    stored = fastjson.dumps(response)
+    return event, stored
+
+
+def measure(path, bodies, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.process_time()
+        for body in bodies:
+            path(body)
+        best = min(best, time.process_time() - start)
+    return best / len(bodies) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--cities", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    bodies = [json.dumps(weather_response(3439525 + n)).encode() for n in range(args.cities)]
+    results = {"before (json, full response)": measure(before, bodies, args.repeat)}
+    for backend in ["json", "orjson"]:
+        if backend == "orjson" and fastjson.orjson is None:
+            continue
+        with override_settings(OPEN_WEATHER_JSON_BACKEND=backend):
+            results[f"after ({backend}, projected)"] = measure(after, bodies, args.repeat)
+
+    if args.json:
+        print(json.dumps({name: round(cost, 2) for name, cost in results.items()}, indent=2))
+        return
+    baseline = results["before (json, full response)"]
+    print(f"{'path':<32}{'us/city':>10}{'speedup':>10}")
+    for name, cost in results.items():
+        print(f"{name:<32}{cost:>10.2f}{baseline / cost:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Measures the CPU cost per city of building the payloads stored for a job.
+
+"per city" is the payload built before schemas existed, hard-coded for
+the default fields. The other paths build batches with
+schema.PayloadSchema, for the default lean schema and for a rich one in
+imperial units, which stores more fields than "per city", at several batch
+sizes, the smallest being the default OPEN_WEATHER_BATCH_SIZE.
+
+    python -m benchmarks.bench_payloads [--cities 20000] [--batch-sizes 10,100,1000] [--json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "open_weather_project.settings")
+os.environ.setdefault("SECRET_KEY", "benchmark")
+django.setup()
+
+from more_itertools import chunked  # noqa: E402
+
+from open_weather_api import schema  # noqa: E402
+from open_weather_api.fake_upstream import weather_response  # noqa: E402
+
+RICH_FIELDS = ["feels_like", "pressure", "wind_speed", "wind_deg", "clouds", "lat", "lon"]
+SCHEMAS = {
+    "lean, metric": schema.PayloadSchema(),
+    "rich, imperial": schema.PayloadSchema(RICH_FIELDS, "imperial"),
+}
+
+
+def per_city(batches):
+    return [
+        [
+            {
+                "city_id": response["id"],
+                "temperature": round(response["main"]["temp"] - 273.15, 2),
+                "humidity": response["main"]["humidity"],
+            }
+            for response in batch
+        ]
+        for batch in batches
+    ]
+
+
+def with_schema(payload_schema):
+    def build(batches):
+        return [payload_schema.build(batch) for batch in batches]
+
+    return build
+
+
+def measure(build, batches, cities, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.process_time()
+        build(batches)
+        best = min(best, time.process_time() - start)
+    return best / cities * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--cities", type=int, default=20000)
+    parser.add_argument("--batch-sizes", default="10,100,1000")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    responses = [schema.project(weather_response(3439525 + n)) for n in range(args.cities)]
+    results = {}
+    for batch_size in [int(size) for size in args.batch_sizes.split(",")]:
+        batches = list(chunked(responses, batch_size))
+        paths = {"per city (lean, metric)": per_city}
+        for schema_name, payload_schema in SCHEMAS.items():
+            paths[f"schema ({schema_name})"] = with_schema(payload_schema)
+        results[batch_size] = {
+            name: measure(build, batches, args.cities, args.repeat)
+            for name, build in paths.items()
+        }
+
+    if args.json:
+        print(json.dumps({
+            size: {name: round(us, 2) for name, us in rows.items()}
+            for size, rows in results.items()
+        }, indent=2))
+        return
+    print(f"{'batch':>6}  {'path':<26}{'us/city':>10}{'vs per city':>13}")
+    for batch_size, rows in results.items():
+        baseline = rows["per city (lean, metric)"]
+        for name, us in rows.items():
+            print(f"{batch_size:>6}  {name:<26}{us:>10.2f}{baseline / us:>12.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Measures how fast concurrent jobs can store readings in SQLite.
+
+For each `--configs` entry (journal mode and synchronous level), starts
+`--processes` processes on a fresh database file, each running `--jobs`
+jobs that save `--cities` readings through the write-behind buffer, as
+collect_worker processes do, and reports readings and transactions per
+second and the time each process spent in queries, including waits on
+the database lock, as JSON.
+
+    python -m benchmarks.bench_writes [--configs delete:full,wal:normal] [--processes 4]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--configs", default="delete:full,wal:normal", help="comma separated <journal_mode>:<synchronous>"
+    )
+    parser.add_argument("--processes", type=int, default=4, help="writer processes, like collect_worker")
+    parser.add_argument("--jobs", type=int, default=4, help="concurrent jobs per process")
+    parser.add_argument("--cities", type=int, default=2000, help="readings per job")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    return parser.parse_args()
+
+
+def environment(database, config):
+    journal_mode, synchronous = config.split(":")
+    return dict(
+        os.environ,
+        DJANGO_SETTINGS_MODULE="open_weather_project.settings",
+        SECRET_KEY=os.environ.get("SECRET_KEY", "benchmark"),
+        SQLITE_PATH=database,
+        OPEN_WEATHER_SQLITE_JOURNAL_MODE=journal_mode,
+        OPEN_WEATHER_SQLITE_SYNCHRONOUS=synchronous,
+        OPEN_WEATHER_METRICS="0",
+        OPEN_WEATHER_TRACE_SPANS="0",
+    )
+
+
+def writer(env, args, number, start, results):
+    os.environ.update(env)
+    import asyncio
+
+    import django
+
+    django.setup()
+    from django.db.backends.signals import connection_created
+    from django.utils import timezone
+
+    from open_weather_api.jobs import enqueue_job, save_readings
+    from open_weather_api.writebehind import WriteBehind
+
+    jobs = [
+        enqueue_job(f"bench-{number}-{job}", range(1, args.cities + 1)) for job in range(args.jobs)
+    ]
+    query_seconds = []
+
+    def timed_execute(execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            query_seconds.append(time.perf_counter() - started)
+
+    async def write(job):
+        now = timezone.now()
+        async with WriteBehind(job, save_readings, size=args.batch_size, interval=1) as buffer:
+            for city_id in range(1, args.cities + 1):
+                await buffer.add(dict(city_id=city_id, temperature=20.0, humidity=50, observed_at=now))
+                # Stands in for awaiting the next upstream response
+                await asyncio.sleep(0)
+            return buffer
+
+    async def write_all():
+        return await asyncio.gather(*(write(job) for job in jobs))
+
+    # Saves run on sync_to_async's thread, which opens its own connection
+    connection_created.connect(
+        lambda connection, **kwargs: connection.execute_wrappers.append(timed_execute), weak=False
+    )
+    start.wait()
+    started = time.perf_counter()
+    buffers = asyncio.run(write_all())
+    results.put(
+        {
+            "seconds": time.perf_counter() - started,
+            "readings": args.jobs * args.cities,
+            "transactions": sum(buffer.flushes for buffer in buffers),
+            "query_seconds": sum(query_seconds),
+        }
+    )
+
+
+def run(config, args):
+    with tempfile.TemporaryDirectory() as directory:
+        env = environment(os.path.join(directory, "bench.sqlite3"), config)
+        subprocess.run([sys.executable, "manage.py", "migrate", "-v", "0"], cwd=ROOT, env=env, check=True)
+        context = multiprocessing.get_context("spawn")
+        start = context.Barrier(args.processes)
+        results = context.Queue()
+        processes = [
+            context.Process(target=writer, args=(env, args, number, start, results))
+            for number in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        runs = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    seconds = max(run["seconds"] for run in runs)
+    readings = sum(run["readings"] for run in runs)
+    transactions = sum(run["transactions"] for run in runs)
+    return {
+        "seconds": round(seconds, 3),
+        "readings_per_second": round(readings / seconds, 1),
+        "transactions_per_second": round(transactions / seconds, 1),
+        "readings_per_transaction": round(readings / max(transactions, 1), 1),
+        "query_seconds_per_process": round(sum(run["query_seconds"] for run in runs) / len(runs), 3),
+    }
+
+
+def main():
+    args = parse_args()
+    results = {"config": {key: value for key, value in vars(args).items() if key != "output"}}
+    for config in args.configs.split(","):
+        results[config] = run(config, args)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+Keeps upstream calls near the real quota ceiling without losing cities:
+an AIMD limit on the requests in flight, retries with jittered exponential
+backoff that honour Retry-After, and a circuit breaker that stops calling
+an upstream that is down.
+"""
+
+import asyncio
+import datetime as dt
+import email.utils
+import random
+import time
+import weakref
+
+from django.conf import settings
+
+from . import metrics
+
+_breakers = weakref.WeakKeyDictionary()
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling upstream while the circuit breaker is open.
+    """
+
+
+class AIMDConcurrency:
+    """
+    Additive-increase/multiplicative-decrease limit on the requests in
+    flight, between `minimum` and `maximum`.
+
+    Every successful call adds 1/limit, so the limit grows by one per round
+    trip; throttling, server errors or a call slower than `latency_target`
+    (0 to ignore latency) halve it. Decreases closer than `cooldown` seconds
+    count once, as the calls in flight at a decrease all carry the same
+    signal.
+    """
+
+    def __init__(
+        self,
+        maximum,
+        minimum=1,
+        latency_target=0,
+        decrease=0.5,
+        cooldown=1.0,
+        clock=time.monotonic,
+    ):
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.latency_target = latency_target
+        self.decrease_factor = decrease
+        self.cooldown = cooldown
+        self.clock = clock
+        self.value = float(maximum)
+        self._decreased_at = None
+
+    @property
+    def limit(self):
+        return int(self.value)
+
+    def increase(self):
+        self.value = min(self.maximum, self.value + 1 / self.value)
+
+    def decrease(self):
+        now = self.clock()
+        if self._decreased_at is not None and now - self._decreased_at < self.cooldown:
+            return
+        self._decreased_at = now
+        self.value = max(self.minimum, self.value * self.decrease_factor)
+
+    def on_success(self, latency):
+        if self.latency_target and latency > self.latency_target:
+            self.decrease()
+        else:
+            self.increase()
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failed calls and rejects calls for
+    `reset_timeout` seconds. Then a single probe call is let through: its
+    success closes the breaker, its failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold=None, reset_timeout=None, clock=time.monotonic):
+        self.threshold = threshold or settings.OPEN_WEATHER_BREAKER_THRESHOLD
+        self.reset_timeout = (
+            settings.OPEN_WEATHER_BREAKER_RESET_TIMEOUT
+            if reset_timeout is None
+            else reset_timeout
+        )
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = None
+
+    def allow(self):
+        """
+        Returns whether a call may be made now.
+        """
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and self.clock() - self._opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            self.state = self.OPEN
+            self._opened_at = self.clock()
+
+
+def get_breaker():
+    """
+    Returns the circuit breaker shared by every collection of the running
+    event loop, as they all call the same upstream.
+    """
+    loop = asyncio.get_running_loop()
+    breaker = _breakers.get(loop)
+    if breaker is None:
+        breaker = _breakers[loop] = CircuitBreaker()
+    return breaker
+
+
+def retry_after(response):
+    """
+    Returns the seconds to wait asked for by the Retry-After header of the
+    response, or by X-RateLimit-Remaining/Reset when the quota is spent.
+    None if the response asks for nothing.
+    """
+    value = response.headers.get("Retry-After")
+    if value:
+        if value.strip().isdigit():
+            return float(value)
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, (date - dt.datetime.now(dt.timezone.utc)).total_seconds())
+    if response.headers.get("X-RateLimit-Remaining") == "0":
+        try:
+            reset = float(response.headers["X-RateLimit-Reset"])
+        except (KeyError, ValueError):
+            return None
+        # Either an epoch time or a number of seconds
+        return max(0.0, reset - time.time()) if reset > 1e9 else reset
+    return None
+
+
+def backoff(attempt, base=None, cap=None):
+    """
+    Full jitter exponential backoff: a random delay up to base * 2**attempt,
+    capped at `cap` seconds.
+    """
+    base = settings.OPEN_WEATHER_RETRY_BACKOFF if base is None else base
+    cap = settings.OPEN_WEATHER_RETRY_BACKOFF_MAX if cap is None else cap
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class UpstreamStats:
+    """
+    Counts the calls of a collection that were retried, throttled by
+    upstream or rejected by the open circuit breaker.
+    """
+
+    __slots__ = ("retries", "throttled", "rejected")
+
+    def __init__(self):
+        self.retries = 0
+        self.throttled = 0
+        self.rejected = 0
+
+
+class UpstreamControl:
+    """
+    What the calls of one collection share: the in-flight limit, the
+    circuit breaker of the event loop, the pause asked for by upstream and
+    the retry counters.
+    """
+
+    def __init__(self, max_in_flight=None, breaker=None, stats=None, clock=time.monotonic):
+        max_in_flight = max_in_flight or settings.OPEN_WEATHER_MAX_IN_FLIGHT
+        if settings.OPEN_WEATHER_ADAPTIVE_CONCURRENCY:
+            self.concurrency = AIMDConcurrency(
+                max_in_flight,
+                minimum=settings.OPEN_WEATHER_MIN_IN_FLIGHT,
+                latency_target=settings.OPEN_WEATHER_LATENCY_TARGET,
+                clock=clock,
+            )
+        else:
+            self.concurrency = AIMDConcurrency(max_in_flight, minimum=max_in_flight)
+        self.breaker = breaker or get_breaker()
+        self.stats = stats or UpstreamStats()
+        self.clock = clock
+        self._paused_until = 0.0
+
+    @property
+    def limit(self):
+        return self.concurrency.limit
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, self.clock() + seconds)
+
+    async def before_call(self):
+        """
+        Waits out any pause asked for by upstream, then raises
+        CircuitOpenError if the breaker rejects the call.
+        """
+        delay = self._paused_until - self.clock()
+        if delay > 0:
+            metrics.SLEEP_SECONDS.observe(delay, "upstream_pause")
+            await asyncio.sleep(delay)
+        if not self.breaker.allow():
+            self.stats.rejected += 1
+            raise CircuitOpenError("Upstream calls are suspended by the circuit breaker")
+
+    def on_success(self, response, latency):
+        self.breaker.record_success()
+        self.concurrency.on_success(latency)
+        delay = retry_after(response)
+        if delay:
+            self.pause(delay)
+
+    def on_throttled(self, response):
+        """
+        Backs off after a 429 and returns how long to wait before retrying.
+        """
+        # A 429 proves upstream is up, it just wants fewer calls
+        self.breaker.record_success()
+        self.stats.throttled += 1
+        self.concurrency.decrease()
+        delay = retry_after(response)
+        if delay is None:
+            return None
+        self.pause(delay)
+        return delay
+
+    def on_failure(self):
+        self.breaker.record_failure()
+        self.concurrency.decrease()
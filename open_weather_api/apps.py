@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class OpenWeatherApiConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "open_weather_api"
+
+    def ready(self):
+        from .sqlite import configure_connection
+
+        connection_created.connect(configure_connection, dispatch_uid="open_weather_sqlite")
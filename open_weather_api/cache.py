@@ -0,0 +1,174 @@
+import datetime as dt
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import CachedObservation
+
+# Keeps `city_id__in` lookups below SQLite's limit of query parameters
+LOOKUP_CHUNK_SIZE = 500
+
+
+class ObservationCache:
+    """
+    Per-city cache of raw OpenWeather responses shared by collection jobs.
+
+    OpenWeather only refreshes current conditions every ~10 minutes, so a
+    response younger than `ttl` seconds is as good as a new upstream call.
+    Subclasses store the entries; this class keeps the hit/miss counters.
+    """
+
+    def __init__(self, ttl=None, max_entries=None):
+        self.ttl = settings.OPEN_WEATHER_CACHE_TTL if ttl is None else ttl
+        self.max_entries = max_entries or settings.OPEN_WEATHER_CACHE_MAX_ENTRIES
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, cities_ids):
+        """
+        Returns a dict with the fresh cached response of each city found.
+        """
+        cities_ids = list(cities_ids)
+        found = self.lookup(cities_ids)
+        self.hits += len(found)
+        self.misses += len(cities_ids) - len(found)
+        return found
+
+    def set_many(self, responses):
+        """
+        Stores the responses of a dict keyed by city ID.
+        """
+        if responses:
+            self.store(responses)
+
+    def stats(self):
+        return {
+            "backend": type(self).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "ttl": self.ttl,
+            "max_entries": self.max_entries,
+        }
+
+    def lookup(self, cities_ids):
+        raise NotImplementedError
+
+    def store(self, responses):
+        raise NotImplementedError
+
+
+class LocalObservationCache(ObservationCache):
+    """
+    In-process LRU cache, shared by the jobs of a single worker.
+    """
+
+    def __init__(self, ttl=None, max_entries=None, clock=time.monotonic):
+        super().__init__(ttl, max_entries)
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, cities_ids):
+        found = {}
+        now = self.clock()
+        with self._lock:
+            for city_id in cities_ids:
+                entry = self._entries.get(city_id)
+                if entry is None:
+                    continue
+                stored_at, response = entry
+                if now - stored_at > self.ttl:
+                    del self._entries[city_id]
+                    continue
+                self._entries.move_to_end(city_id)
+                found[city_id] = response
+        return found
+
+    def store(self, responses):
+        now = self.clock()
+        with self._lock:
+            for city_id, response in responses.items():
+                self._entries[city_id] = (now, response)
+                self._entries.move_to_end(city_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class DjangoObservationCache(ObservationCache):
+    """
+    Stores entries in a Django cache (OPEN_WEATHER_CACHE_ALIAS), shared by
+    every process using it. Size and eviction follow that cache's own
+    settings, e.g. MAX_ENTRIES or the LRU policy of Redis/Memcached.
+    """
+
+    key = "open_weather:city:{}"
+
+    def __init__(self, ttl=None, max_entries=None, alias=None):
+        super().__init__(ttl, max_entries)
+        self.cache = caches[alias or settings.OPEN_WEATHER_CACHE_ALIAS]
+
+    def lookup(self, cities_ids):
+        keys = {self.key.format(city_id): city_id for city_id in cities_ids}
+        return {
+            keys[key]: response
+            for key, response in self.cache.get_many(list(keys)).items()
+        }
+
+    def store(self, responses):
+        self.cache.set_many(
+            {self.key.format(city_id): response for city_id, response in responses.items()},
+            timeout=self.ttl,
+        )
+
+
+class DatabaseObservationCache(ObservationCache):
+    """
+    Stores entries in the CachedObservation table, shared by every process
+    using the database. Once it holds more than `max_entries` rows, the
+    least recently fetched ones are evicted.
+    """
+
+    def lookup(self, cities_ids):
+        fresh_after = timezone.now() - dt.timedelta(seconds=self.ttl)
+        found = {}
+        for start in range(0, len(cities_ids), LOOKUP_CHUNK_SIZE):
+            found.update(
+                CachedObservation.objects.filter(
+                    city_id__in=cities_ids[start : start + LOOKUP_CHUNK_SIZE],
+                    fetched_at__gte=fresh_after,
+                ).values_list("city_id", "response")
+            )
+        return found
+
+    def store(self, responses):
+        now = timezone.now()
+        CachedObservation.objects.bulk_create(
+            [
+                CachedObservation(city_id=city_id, response=response, fetched_at=now)
+                for city_id, response in responses.items()
+            ],
+            update_conflicts=True,
+            unique_fields=["city_id"],
+            update_fields=["response", "fetched_at"],
+        )
+        excess = CachedObservation.objects.count() - self.max_entries
+        if excess > 0:
+            oldest = CachedObservation.objects.order_by("fetched_at").values_list(
+                "city_id", flat=True
+            )[:excess]
+            CachedObservation.objects.filter(city_id__in=list(oldest)).delete()
+
+
+def build_cache():
+    """
+    Returns the cache configured by OPEN_WEATHER_CACHE_BACKEND, or None when
+    caching is disabled.
+    """
+    if not settings.OPEN_WEATHER_CACHE_BACKEND or not settings.OPEN_WEATHER_CACHE_TTL:
+        return None
+    return import_string(settings.OPEN_WEATHER_CACHE_BACKEND)()
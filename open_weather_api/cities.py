@@ -0,0 +1,134 @@
+import gzip
+import json
+
+from django.conf import settings
+
+from .models import City, CitySet
+
+# Keys accepted by the `filter` of a POST to /collect/
+FILTER_KEYS = ("country", "name", "bbox")
+
+
+class CitySelectionError(ValueError):
+    pass
+
+
+def open_cities_file(path):
+    return gzip.open(path, "rt") if str(path).endswith(".gz") else open(path)
+
+
+def read_cities_file(path):
+    """
+    Reads the cities of `path`, either OpenWeather's city.list.json (optionally
+    gzipped) or a comma or newline separated list of city IDs, and returns
+    City instances.
+    """
+    with open_cities_file(path) as f:
+        content = f.read()
+    if content.lstrip().startswith("["):
+        return [
+            City(
+                id=int(item["id"]),
+                name=item.get("name", ""),
+                state=item.get("state", ""),
+                country=item.get("country", ""),
+                lat=item.get("coord", {}).get("lat"),
+                lon=item.get("coord", {}).get("lon"),
+            )
+            for item in json.loads(content)
+        ]
+    return [
+        City(id=int(city_id))
+        for city_id in content.replace("\n", ",").split(",")
+        if city_id.strip()
+    ]
+
+
+def city_set_ids(name):
+    """
+    Returns the IDs of the cities in the named set, or None if there is no
+    such set.
+    """
+    if not CitySet.objects.filter(name=name).exists():
+        return None
+    return list(
+        City.objects.filter(sets__name=name).order_by("id").values_list("id", flat=True)
+    )
+
+
+def default_cities():
+    """
+    Returns the IDs collected when a request names no cities: the default
+    city set if it was loaded, else the IDs of OPEN_WEATHER_CITIES_FILE.
+    """
+    cities_ids = city_set_ids(settings.OPEN_WEATHER_DEFAULT_CITY_SET)
+    if cities_ids is not None:
+        return cities_ids
+    return [city.id for city in read_cities_file(settings.OPEN_WEATHER_CITIES_FILE)]
+
+
+def filter_cities(filters):
+    """
+    Returns the IDs of the registered cities matching `filters`: an exact
+    `country` code, a `name` prefix and/or a `bbox` of
+    [min_lon, min_lat, max_lon, max_lat].
+    """
+    if not isinstance(filters, dict) or not filters:
+        raise CitySelectionError("filter must be a non-empty object")
+    unknown = set(filters) - set(FILTER_KEYS)
+    if unknown:
+        raise CitySelectionError(
+            f"Unknown filter {', '.join(sorted(unknown))}, "
+            f"expected {', '.join(FILTER_KEYS)}"
+        )
+    cities = City.objects.all()
+    if "country" in filters:
+        cities = cities.filter(country=str(filters["country"]).upper())
+    if "name" in filters:
+        cities = cities.filter(name__istartswith=filters["name"])
+    if "bbox" in filters:
+        try:
+            min_lon, min_lat, max_lon, max_lat = (float(x) for x in filters["bbox"])
+        except (TypeError, ValueError):
+            raise CitySelectionError(
+                "bbox must be [min_lon, min_lat, max_lon, max_lat]"
+            )
+        cities = cities.filter(
+            lon__gte=min_lon, lon__lte=max_lon, lat__gte=min_lat, lat__lte=max_lat
+        )
+    return list(cities.order_by("id").values_list("id", flat=True))
+
+
+def select_cities(body):
+    """
+    Returns the city IDs requested by the body of a POST to /collect/: an
+    explicit `cities_ids` list, the name of a `city_set` or a `filter` over
+    the registry, or the default cities when none is given.
+
+    Raises CitySelectionError when the selection is invalid or empty.
+    """
+    given = [key for key in ("cities_ids", "city_set", "filter") if key in body]
+    if len(given) > 1:
+        raise CitySelectionError(
+            "Only one of cities_ids, city_set or filter can be given"
+        )
+    if not given:
+        cities_ids = default_cities()
+    elif given[0] == "cities_ids":
+        cities_ids = body["cities_ids"]
+        if not isinstance(cities_ids, list) or not all(
+            isinstance(city_id, int) and not isinstance(city_id, bool)
+            for city_id in cities_ids
+        ):
+            raise CitySelectionError("cities_ids must be a list of integers")
+        # Duplicates would be fetched once but counted twice
+        cities_ids = list(dict.fromkeys(cities_ids))
+    elif given[0] == "city_set":
+        cities_ids = city_set_ids(body["city_set"])
+        if cities_ids is None:
+            raise CitySelectionError(f"Unknown city set {body['city_set']!r}")
+    else:
+        cities_ids = filter_cities(body["filter"])
+    if not cities_ids:
+        raise CitySelectionError("No cities selected")
+    return cities_ids
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import time
+import weakref
+
+import httpx
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+# httpcore trace steps that open a connection, and the one spent waiting
+# for the server to answer a request that was already sent.
+CONNECT_STEPS = ("connection.connect_tcp", "connection.start_tls")
+SERVER_STEPS = ("http11.receive_response_headers", "http2.receive_response_headers")
+
+_clients = weakref.WeakKeyDictionary()
+
+
+class RequestTiming:
+    """
+    Splits the duration of one upstream call into connection setup (TCP and
+    TLS handshakes, zero when a pooled connection was reused) and time spent
+    waiting for the server, using httpx's trace extension.
+    """
+
+    __slots__ = ("connect", "server", "total", "reported", "_started", "_steps")
+
+    def __init__(self):
+        self.connect = 0.0
+        self.server = 0.0
+        self.total = 0.0
+        self.reported = False
+        self._started = time.perf_counter()
+        self._steps = {}
+
+    @property
+    def new_connection(self):
+        return self.connect > 0
+
+    async def trace(self, event_name, info):
+        step, _, phase = event_name.rpartition(".")
+        if phase == "started":
+            self._steps[step] = time.perf_counter()
+        elif phase in ("complete", "failed") and step in self._steps:
+            elapsed = time.perf_counter() - self._steps.pop(step)
+            if step in CONNECT_STEPS:
+                self.connect += elapsed
+            elif step in SERVER_STEPS:
+                self.server += elapsed
+
+    def finish(self):
+        self.total = time.perf_counter() - self._started
+        logger.debug(
+            "Upstream call took %.3fs (connect %.3fs, server %.3fs)",
+            self.total,
+            self.connect,
+            self.server,
+        )
+        return self
+
+
+class TimingSummary:
+    """
+    Adds up the timings of the upstream calls behind a set of results. Cities
+    fetched by the same group call share a timing, which is counted once.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.new_connections = 0
+        self.connect = 0.0
+        self.server = 0.0
+        self.total = 0.0
+
+    def add(self, timing):
+        if timing is None or timing.reported:
+            return
+        timing.reported = True
+        self.calls += 1
+        self.new_connections += timing.new_connection
+        self.connect += timing.connect
+        self.server += timing.server
+        self.total += timing.total
+
+
+def build_client():
+    """
+    Creates an HTTP client with a keep-alive connection pool configured from
+    the OPEN_WEATHER_POOL_* and timeout settings.
+    """
+    if settings.OPEN_WEATHER_HTTP2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            raise ImproperlyConfigured(
+                "OPEN_WEATHER_HTTP2 requires the h2 package (pip install httpx[http2])"
+            )
+    return httpx.AsyncClient(
+        http2=settings.OPEN_WEATHER_HTTP2,
+        limits=httpx.Limits(
+            max_connections=settings.OPEN_WEATHER_POOL_SIZE,
+            max_keepalive_connections=settings.OPEN_WEATHER_POOL_SIZE,
+            keepalive_expiry=settings.OPEN_WEATHER_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            settings.OPEN_WEATHER_REQUEST_TIMEOUT,
+            connect=settings.OPEN_WEATHER_CONNECT_TIMEOUT,
+        ),
+    )
+
+
+def get_client():
+    """
+    Returns the pooled client shared by every fetch of the running event
+    loop, so connections are reused across batches and across jobs.
+
+    Connections cannot move between event loops, hence one client per loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = _clients[loop] = build_client()
+    return client
+
+
+async def close_client():
+    """
+    Closes the pooled client of the running event loop, if it has one.
+    """
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
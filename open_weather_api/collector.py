@@ -0,0 +1,298 @@
+import asyncio
+import time
+from collections import namedtuple
+
+import httpx
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from more_itertools import chunked
+
+from . import fastjson, metrics
+from .adaptive import CircuitOpenError, UpstreamControl, backoff
+from .client import RequestTiming, close_client, get_client
+from .profiling import spans
+from .ratelimit import build_limiter
+from .schema import project
+
+WEATHER_URL = "{base_url}/weather"
+GROUP_URL = "{base_url}/group"
+
+# `raw` is the whole upstream response, only kept when it is archived
+CityResult = namedtuple(
+    "CityResult", ["city_id", "data", "error", "timing", "raw"], defaults=[None, None]
+)
+
+# Errors meaning a response could not be used
+RESPONSE_ERRORS = (
+    httpx.HTTPError,
+    CircuitOpenError,
+    ValueError,
+    KeyError,
+    TypeError,
+)
+
+
+def keep_raw(response):
+    """
+    Returns the response as received when OPEN_WEATHER_RAW_ARCHIVE archives
+    it, else None so it is freed as soon as it is projected.
+    """
+    return response if settings.OPEN_WEATHER_RAW_ARCHIVE else None
+
+
+def cache_entry(result):
+    """
+    What the observation cache keeps of a fetched city: the whole response
+    while responses are archived, so the jobs it serves archive it too, and
+    else only its projection.
+    """
+    return result.data if result.raw is None else result.raw
+
+
+def cached_result(city_id, response):
+    """
+    Returns the result of a city served from the observation cache. Entries
+    cached while responses were not archived are archived as projected.
+    """
+    return CityResult(city_id, project(response), None, raw=keep_raw(response))
+
+
+def decode(response):
+    wall, started = time.time(), time.perf_counter()
+    data = fastjson.loads(response.content)
+    elapsed = time.perf_counter() - started
+    metrics.JSON_DECODE_SECONDS.inc(elapsed)
+    spans.record("parse", wall, elapsed)
+    return data
+
+
+async def send(
+    client, limiter, control, url, params, timing, retry_errors=True, endpoint="weather"
+):
+    """
+    Makes one upstream call once the limiter allows it, and returns the
+    response or raises.
+
+    429s are retried after their Retry-After, or a jittered backoff, up to
+    OPEN_WEATHER_MAX_RETRIES times; server errors and timeouts too unless
+    `retry_errors` is False. Other errors, such as a 404 for an unknown
+    city, are raised right away.
+    """
+    attempt = 0
+    while True:
+        await control.before_call()
+        await limiter.acquire()
+        wall, started = time.time(), time.perf_counter()
+        delay = None
+        try:
+            response = await client.get(
+                url, params=params, extensions={"trace": timing.trace}
+            )
+        except httpx.TransportError as exc:
+            latency = time.perf_counter() - started
+            metrics.UPSTREAM_LATENCY.observe(latency, endpoint, "error")
+            spans.record("fetch", wall, latency)
+            control.on_failure()
+            error, retry = exc, retry_errors
+        else:
+            latency = time.perf_counter() - started
+            spans.record("fetch", wall, latency)
+            if response.status_code == 429:
+                metrics.UPSTREAM_LATENCY.observe(latency, endpoint, "throttled")
+                delay = control.on_throttled(response)
+                retry = True
+            elif response.status_code >= 500:
+                metrics.UPSTREAM_LATENCY.observe(latency, endpoint, "error")
+                control.on_failure()
+                retry = retry_errors
+            else:
+                metrics.UPSTREAM_LATENCY.observe(
+                    latency, endpoint, "ok" if response.is_success else "client_error"
+                )
+                control.on_success(response, latency)
+                response.raise_for_status()
+                return response
+            try:
+                response.raise_for_status()
+            except httpx.HTTPStatusError as exc:
+                error = exc
+        if not retry or attempt >= settings.OPEN_WEATHER_MAX_RETRIES:
+            raise error
+        control.stats.retries += 1
+        # A Retry-After pauses every call of the collection in before_call
+        if delay is None:
+            delay = backoff(attempt)
+            metrics.SLEEP_SECONDS.observe(delay, "retry")
+            await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def fetch_city(client, limiter, control, city_id):
+    """
+    Fetches the current weather of a single city.
+    """
+    timing = RequestTiming()
+    try:
+        response = await send(
+            client,
+            limiter,
+            control,
+            WEATHER_URL.format(base_url=settings.OPEN_WEATHER_API_URL),
+            {"id": city_id, "appid": settings.OPEN_WEATHER_API_KEY},
+            timing,
+        )
+        data = decode(response)
+        return CityResult(city_id, project(data), None, timing.finish(), keep_raw(data))
+    except RESPONSE_ERRORS as exc:
+        return CityResult(city_id, None, exc, timing.finish())
+
+
+async def fetch_single(client, limiter, control, cities_ids):
+    """
+    Fetches the cities one upstream call each.
+    """
+    return [
+        await fetch_city(client, limiter, control, city_id) for city_id in cities_ids
+    ]
+
+
+async def fetch_group(client, limiter, control, cities_ids):
+    """
+    Fetches several cities with one call to the group endpoint and splits its
+    `list` back into one result per city.
+
+    Cities missing from the response, or all of them when the call fails,
+    fall back to single-city calls, so failed group calls are only retried
+    when throttled.
+    """
+    timing = RequestTiming()
+    found = {}
+    try:
+        response = await send(
+            client,
+            limiter,
+            control,
+            GROUP_URL.format(base_url=settings.OPEN_WEATHER_API_URL),
+            {
+                "id": ",".join(str(city_id) for city_id in cities_ids),
+                "appid": settings.OPEN_WEATHER_API_KEY,
+            },
+            timing,
+            retry_errors=False,
+            endpoint="group",
+        )
+        found = {
+            item["id"]: (project(item), keep_raw(item))
+            for item in decode(response)["list"]
+        }
+    except RESPONSE_ERRORS:
+        pass
+    timing.finish()
+    results = []
+    for city_id in cities_ids:
+        if int(city_id) in found:
+            data, raw = found[int(city_id)]
+            results.append(CityResult(city_id, data, None, timing, raw))
+    missing = [city_id for city_id in cities_ids if int(city_id) not in found]
+    if missing:
+        results.extend(
+            await asyncio.gather(
+                *(fetch_city(client, limiter, control, city_id) for city_id in missing)
+            )
+        )
+    return results
+
+
+# Fetch strategy name: (coroutine fetching a list of cities, cities per call)
+STRATEGIES = {
+    "single": (fetch_single, lambda: 1),
+    "group": (fetch_group, lambda: settings.OPEN_WEATHER_GROUP_SIZE),
+}
+
+
+def get_strategy(name=None):
+    """
+    Returns the fetch coroutine and the number of cities it packs per
+    upstream call for OPEN_WEATHER_FETCH_STRATEGY.
+    """
+    name = name or settings.OPEN_WEATHER_FETCH_STRATEGY
+    if name not in STRATEGIES:
+        raise ImproperlyConfigured(
+            f"Unknown OPEN_WEATHER_FETCH_STRATEGY {name!r}, "
+            f"expected one of {', '.join(STRATEGIES)}"
+        )
+    fetch, cities_per_call = STRATEGIES[name]
+    return fetch, cities_per_call()
+
+
+async def collect(
+    cities_ids,
+    limiter=None,
+    max_in_flight=None,
+    client=None,
+    strategy=None,
+    control=None,
+):
+    """
+    Fetches every city in `cities_ids` and yields a CityResult as each one
+    completes.
+
+    At most `max_in_flight` requests are pending at any time and the limiter
+    paces how fast they are started, so results stream out continuously
+    instead of in fixed chunks. With OPEN_WEATHER_ADAPTIVE_CONCURRENCY the
+    `control` lowers that bound while upstream throttles, fails or slows
+    down, and raises it back as calls succeed; its counters tell how many
+    calls were retried. The fetch strategy decides how many cities each
+    upstream call carries. Calls go through the pooled client of the event
+    loop unless another `client` is given.
+    """
+    fetch, cities_per_call = get_strategy(strategy)
+    limiter = limiter or build_limiter()
+    control = control or UpstreamControl(max_in_flight)
+    client = client or get_client()
+
+    calls = chunked(cities_ids, cities_per_call)
+    pending = set()
+
+    def fill():
+        while len(pending) < control.limit:
+            call = next(calls, None)
+            if call is None:
+                return
+            pending.add(asyncio.ensure_future(fetch(client, limiter, control, call)))
+
+    try:
+        fill()
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pending.difference_update(done)
+            fill()
+            for task in done:
+                for result in task.result():
+                    yield result
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+def iter_collect(cities_ids, **kwargs):
+    """
+    Synchronous wrapper around `collect` for use in regular Django views.
+
+    The event loop only runs while the caller waits for the next result, but
+    requests already in flight keep progressing during that time.
+    """
+    loop = asyncio.new_event_loop()
+    results = collect(cities_ids, **kwargs)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(results.aclose())
+        loop.run_until_complete(close_client())
+        loop.close()
@@ -0,0 +1,437 @@
+"""
+Compact storage of the readings of finished jobs as parallel typed arrays:
+uint32 city IDs, float32 temperatures, uint8 humidities, int64 Unix
+observation times in microseconds and the int64 IDs the readings had as
+rows, sorted by city ID. A job of 20k cities takes 500 KB instead of one row
+(and index entries) per city, and reads are NumPy views over the stored
+bytes rather than a Python object per value. Keeping the row IDs lets
+streams number readings alike before and after compaction.
+
+OPEN_WEATHER_COMPACT_STORAGE picks where archives go once a job is done:
+"database" (a ReadingArchive blob), "file" (a file per job in
+OPEN_WEATHER_COMPACT_DIR, memory-mapped when read) or empty to keep rows.
+
+Readers that found the job uncompacted keep reading its rows, so the rows
+are only deleted OPEN_WEATHER_COMPACT_GRACE seconds after the archive is in
+place (see purge_compacted_rows).
+"""
+
+import datetime as dt
+import hashlib
+import mmap
+import os
+import struct
+from typing import NamedTuple
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import models, transaction
+from django.db.models.functions import Substr
+from django.utils import timezone
+
+from .models import CityReading, ReadingArchive, WeatherData
+
+MAGIC = b"OWRA"
+VERSION = 2
+# Magic, version and number of readings, padded so every array is aligned
+HEADER = struct.Struct("<4sII4x")
+# Stored in this order, widest first, so each array starts aligned
+FIELDS = (
+    ("observed_at", np.dtype("<i8")),
+    ("reading_id", np.dtype("<i8")),
+    ("city_id", np.dtype("<u4")),
+    ("temperature", np.dtype("<f4")),
+    ("humidity", np.dtype("u1")),
+)
+# Version 1 archives: observation times to the second and no row IDs
+FIELDS_V1 = tuple(field for field in FIELDS if field[0] != "reading_id")
+EPOCH = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+MICROSECOND = dt.timedelta(microseconds=1)
+# Readings filter_arrays reads per block, and left to search for a cursor
+# once its binary search has narrowed them down
+SCAN_BLOCK = 4096
+# Lookups of ResultsView's filters that arrays can answer
+LOOKUPS = {
+    "gte": np.greater_equal,
+    "lte": np.less_equal,
+    "gt": np.greater,
+    "lt": np.less,
+}
+
+
+class ReadingArrays(NamedTuple):
+    city_id: np.ndarray
+    temperature: np.ndarray
+    humidity: np.ndarray
+    observed_at: np.ndarray
+    reading_id: np.ndarray
+
+    def __len__(self):
+        return len(self.city_id)
+
+    def slice(self, start, stop):
+        return ReadingArrays(*(array[start:stop] for array in self))
+
+    def column(self, name, start, stop):
+        return getattr(self, name)[start:stop]
+
+    def take(self, positions):
+        return ReadingArrays(*(array[positions] for array in self))
+
+    def stored_after(self, reading_id):
+        """
+        Returns the readings whose rows had an ID above `reading_id`, in the
+        order they were stored.
+        """
+        positions = np.flatnonzero(self.reading_id > reading_id)
+        order = np.argsort(self.reading_id[positions], kind="stable")
+        return self.take(positions[order])
+
+    def columns(self, names):
+        """
+        Returns the arrays of `names` as lists of Python values, as read from
+        CityReading rows: temperatures back to their two decimals and
+        observation times as aware datetimes.
+        """
+        columns = []
+        for name in names:
+            array = getattr(self, name)
+            if name == "temperature":
+                columns.append(np.round(array.astype(np.float64), 2).tolist())
+            elif name == "observed_at":
+                # A job observes few distinct times, each converted once
+                times, positions = np.unique(array, return_inverse=True)
+                times = [
+                    moment.replace(tzinfo=dt.timezone.utc)
+                    for moment in times.astype("datetime64[us]").astype(object)
+                ]
+                columns.append([times[position] for position in positions.tolist()])
+            else:
+                columns.append(array.tolist())
+        return columns
+
+    def rows(self, names):
+        return list(zip(*self.columns(names)))
+
+
+def pack(arrays):
+    """
+    Serializes ReadingArrays into the archive format.
+    """
+    parts = [HEADER.pack(MAGIC, VERSION, len(arrays))]
+    for name, dtype in FIELDS:
+        parts.append(np.ascontiguousarray(getattr(arrays, name), dtype=dtype).tobytes())
+    return b"".join(parts)
+
+
+def layout(header):
+    """
+    Returns the version and number of readings of an archive from its
+    header, and the dtype and offset of each of its stored arrays.
+    """
+    magic, version, count = HEADER.unpack_from(header)
+    if magic != MAGIC or version not in (1, VERSION):
+        raise ValueError("Not a reading archive of a supported version")
+    offset = HEADER.size
+    arrays = {}
+    for name, dtype in FIELDS if version == VERSION else FIELDS_V1:
+        arrays[name] = (dtype, offset)
+        offset += dtype.itemsize * count
+    return version, count, arrays
+
+
+def upgrade(arrays, version, start, stop):
+    """
+    Converts the arrays of readings `start` to `stop` of a version 1
+    archive: times to microseconds and readings numbered from 1, as streams
+    did then.
+    """
+    if version == 1:
+        if "observed_at" in arrays:
+            arrays["observed_at"] = arrays["observed_at"] * 1_000_000
+        arrays["reading_id"] = np.arange(start + 1, stop + 1, dtype=FIELDS[1][1])
+    return arrays
+
+
+def unpack(buffer):
+    """
+    Returns ReadingArrays viewing `buffer` (bytes, memoryview or mmap)
+    without copying it.
+    """
+    version, count, offsets = layout(buffer)
+    arrays = {
+        name: np.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+        for name, (dtype, offset) in offsets.items()
+    }
+    return ReadingArrays(**upgrade(arrays, version, 0, count))
+
+
+class ArchiveReader:
+    """
+    Reads ranges of the arrays of an archive, as `read_ranges` of the
+    archive returns them, rather than the whole archive. Has the `slice`
+    and `column` of ReadingArrays, so `filter_arrays` takes either.
+    """
+
+    def __init__(self, archive, job_id):
+        self.read_ranges = archive.reader(job_id)
+        (header,) = self.read_ranges([(0, HEADER.size)])
+        self.version, self.count, self.offsets = layout(header)
+
+    def __len__(self):
+        return self.count
+
+    def arrays(self, names, start, stop):
+        stored = [name for name in names if name in self.offsets]
+        buffers = self.read_ranges(
+            [
+                (offset + dtype.itemsize * start, dtype.itemsize * (stop - start))
+                for dtype, offset in (self.offsets[name] for name in stored)
+            ]
+        )
+        arrays = {
+            name: np.frombuffer(buffer, dtype=self.offsets[name][0])
+            for name, buffer in zip(stored, buffers)
+        }
+        return upgrade(arrays, self.version, start, stop)
+
+    def slice(self, start, stop):
+        return ReadingArrays(**self.arrays(ReadingArrays._fields, start, stop))
+
+    def column(self, name, start, stop):
+        return self.arrays([name], start, stop)[name]
+
+
+def arrays_from_rows(rows):
+    """
+    Builds ReadingArrays from (city_id, temperature, humidity, observed_at,
+    id) rows sorted by city ID.
+    """
+    size = len(rows)
+    dtypes = dict(FIELDS)
+    return ReadingArrays(
+        city_id=np.fromiter((row[0] for row in rows), dtypes["city_id"], size),
+        temperature=np.fromiter((row[1] for row in rows), dtypes["temperature"], size),
+        humidity=np.fromiter((row[2] for row in rows), dtypes["humidity"], size),
+        observed_at=np.fromiter(
+            ((row[3] - EPOCH) // MICROSECOND for row in rows),
+            dtypes["observed_at"],
+            size,
+        ),
+        reading_id=np.fromiter((row[4] for row in rows), dtypes["reading_id"], size),
+    )
+
+
+class DatabaseArchive:
+    name = "database"
+
+    def write(self, job_id, data):
+        ReadingArchive.objects.update_or_create(job_id=job_id, defaults={"data": data})
+
+    def read(self, job_id):
+        data = ReadingArchive.objects.values_list("data", flat=True).get(job_id=job_id)
+        return unpack(data)
+
+    def reader(self, job_id):
+        def read_ranges(ranges):
+            # One query per call, returning only the requested bytes
+            parts = {
+                f"part_{number}": Substr(
+                    "data", offset + 1, size, output_field=models.BinaryField()
+                )
+                for number, (offset, size) in enumerate(ranges)
+            }
+            values = (
+                ReadingArchive.objects.filter(job_id=job_id)
+                .annotate(**parts)
+                .values_list(*parts)
+                .get()
+            )
+            return [bytes(value or b"") for value in values]
+
+        return read_ranges
+
+
+class FileArchive:
+    """
+    One file per job, mapped into memory when read so pages are only loaded
+    as they are touched and shared between the processes reading them.
+    """
+
+    name = "file"
+
+    def path(self, job_id):
+        # Job IDs are chosen by clients, so they never become paths
+        digest = hashlib.sha256(job_id.encode()).hexdigest()
+        return os.path.join(settings.OPEN_WEATHER_COMPACT_DIR, f"{digest}.owra")
+
+    def write(self, job_id, data):
+        os.makedirs(settings.OPEN_WEATHER_COMPACT_DIR, exist_ok=True)
+        path = self.path(job_id)
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+
+    def read(self, job_id):
+        with open(self.path(job_id), "rb") as f:
+            return unpack(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def reader(self, job_id):
+        with open(self.path(job_id), "rb") as f:
+            data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        return lambda ranges: [data[offset : offset + size] for offset, size in ranges]
+
+
+ARCHIVES = {archive.name: archive for archive in (DatabaseArchive, FileArchive)}
+
+
+def get_archive(name=None):
+    """
+    Returns the archive named `name`, by default OPEN_WEATHER_COMPACT_STORAGE,
+    or None when compaction is off.
+    """
+    name = settings.OPEN_WEATHER_COMPACT_STORAGE if name is None else name
+    if not name:
+        return None
+    if name not in ARCHIVES:
+        raise ImproperlyConfigured(
+            f"Unknown OPEN_WEATHER_COMPACT_STORAGE {name!r}, "
+            f"expected one of {', '.join(ARCHIVES)} or an empty value"
+        )
+    return ARCHIVES[name]()
+
+
+def compact_job(job, archive=None):
+    """
+    Packs the readings of a job that collected all its cities into an
+    archive, which readers use from then on, and deletes its rows once
+    OPEN_WEATHER_COMPACT_GRACE has passed. Returns False if the job still
+    misses cities, which a resume may fetch, is already compacted or stores
+    fields the archive has no array for.
+    """
+    archive = archive or get_archive()
+    if archive is None:
+        return False
+    job = WeatherData.objects.get(pk=job.pk)
+    if job.archive or job.payload_fields or job.done_cities < job.total_cities:
+        return False
+    rows = list(
+        job.readings.order_by("city_id").values_list(
+            "city_id", "temperature", "humidity", "observed_at", "id"
+        )
+    )
+    archive.write(job.pk, pack(arrays_from_rows(rows)))
+    grace = settings.OPEN_WEATHER_COMPACT_GRACE
+    if not grace:
+        with transaction.atomic():
+            WeatherData.objects.filter(pk=job.pk).update(archive=archive.name)
+            CityReading.objects.filter(job_id=job.pk).delete()
+        return True
+    WeatherData.objects.filter(pk=job.pk).update(
+        archive=archive.name,
+        purge_rows_after=timezone.now() + dt.timedelta(seconds=grace),
+    )
+    return True
+
+
+def purge_compacted_rows():
+    """
+    Deletes the rows of the compacted jobs whose grace period is over and
+    returns how many jobs were purged.
+    """
+    jobs_ids = list(
+        WeatherData.objects.filter(purge_rows_after__lte=timezone.now()).values_list(
+            "pk", flat=True
+        )
+    )
+    for job_id in jobs_ids:
+        with transaction.atomic():
+            CityReading.objects.filter(job_id=job_id).delete()
+            WeatherData.objects.filter(pk=job_id).update(purge_rows_after=None)
+    return len(jobs_ids)
+
+
+def load_arrays(job_id, archive_name):
+    """
+    Returns the readings of a job as ReadingArrays sorted by city ID, from
+    its archive, or from its rows while it has none.
+    """
+    if archive_name:
+        return get_archive(archive_name).read(job_id)
+    return arrays_from_rows(
+        list(
+            CityReading.objects.filter(job_id=job_id)
+            .order_by("city_id")
+            .values_list("city_id", "temperature", "humidity", "observed_at", "id")
+        )
+    )
+
+
+def open_archive(job_id, archive_name):
+    """
+    Returns an ArchiveReader of the archive of a compacted job.
+    """
+    return ArchiveReader(get_archive(archive_name), job_id)
+
+
+def comparable(name, values):
+    # Filters compare temperatures as stored in rows, not as float32
+    if name == "temperature":
+        return np.round(values.astype(np.float64), 2)
+    return values
+
+
+def search(arrays, cursor):
+    """
+    Returns the position of the first reading after city ID `cursor`,
+    reading a city ID per halving until SCAN_BLOCK of them are left.
+    """
+    low, high = 0, len(arrays)
+    while high - low > SCAN_BLOCK:
+        middle = (low + high) // 2
+        if arrays.column("city_id", middle, middle + 1)[0] <= cursor:
+            low = middle + 1
+        else:
+            high = middle
+    city_ids = arrays.column("city_id", low, high)
+    return low + int(np.searchsorted(city_ids, cursor, side="right"))
+
+
+def filter_arrays(arrays, cursor=0, filters=None, limit=None):
+    """
+    Returns the readings after city ID `cursor` matching `filters` (the
+    CityReading lookups built by ResultsView), at most `limit` of them.
+
+    `arrays` are ReadingArrays or an ArchiveReader, of which only what the
+    page needs is read: the filtered columns a block at a time from the
+    cursor until `limit` readings match, then the span of those readings.
+    """
+    count = len(arrays)
+    start = search(arrays, cursor)
+    stop = count if limit is None else min(count, start + limit)
+    if not filters or start == stop:
+        return arrays.slice(start, stop)
+    found = []
+    matched = 0
+    block = max(SCAN_BLOCK, limit or 0)
+    for low in range(start, count, block):
+        high = min(count, low + block)
+        mask = np.ones(high - low, dtype=bool)
+        for lookup, value in filters.items():
+            name, operator = lookup.split("__")
+            values = comparable(name, arrays.column(name, low, high))
+            if operator == "in":
+                mask &= np.isin(values, value)
+            else:
+                mask &= LOOKUPS[operator](values, value)
+        positions = low + np.flatnonzero(mask)
+        found.append(positions)
+        matched += len(positions)
+        if limit is not None and matched >= limit:
+            break
+    positions = np.concatenate(found)[:limit]
+    if not len(positions):
+        return arrays.slice(start, start)
+    first = int(positions[0])
+    return arrays.slice(first, int(positions[-1]) + 1).take(positions - first)
@@ -0,0 +1,270 @@
+"""
+Streams the readings of one or many jobs as NDJSON, CSV, Parquet or Arrow,
+optionally compressed, in constant memory: rows are read from a database
+cursor in batches and every batch is encoded and handed on before the next
+one is read.
+
+Parquet and Arrow need the optional pyarrow package and zstd compression
+the zstandard package.
+"""
+
+import csv
+import io
+import zlib
+from itertools import chain
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from more_itertools import chunked
+
+from . import fastjson
+from .compact import load_arrays
+from .models import CityReading, WeatherData
+
+COLUMNS = ("user_defined_id", "city_id", "temperature", "humidity", "observed_at")
+
+
+class ExportError(ValueError):
+    pass
+
+
+def reading_rows(jobs_ids, batch_size):
+    return (
+        CityReading.objects.filter(job_id__in=jobs_ids)
+        .order_by("job_id", "city_id")
+        .values_list(
+            "job_id", "city_id", "temperature", "humidity", "observed_at", "extra"
+        )
+        .iterator(chunk_size=batch_size)
+    )
+
+
+def archived_rows(job_id, archive, batch_size):
+    arrays = load_arrays(job_id, archive)
+    for start in range(0, len(arrays), batch_size):
+        for row in arrays.slice(start, start + batch_size).rows(COLUMNS[1:]):
+            yield (job_id, *row, {})
+
+
+def iter_readings(jobs_ids, batch_size=None):
+    """
+    Yields lists of up to `batch_size` reading rows (tuples of COLUMNS and
+    the other fields of the payload schema) of the jobs, by job then city,
+    from a server-side iterator or, for compacted jobs, from their archives.
+    """
+    batch_size = batch_size or settings.OPEN_WEATHER_EXPORT_BATCH_SIZE
+    archives = dict(
+        WeatherData.objects.filter(pk__in=jobs_ids)
+        .exclude(archive="")
+        .values_list("pk", "archive")
+    )
+    if not archives:
+        return chunked(reading_rows(jobs_ids, batch_size), batch_size)
+    rows = chain.from_iterable(
+        archived_rows(job_id, archives[job_id], batch_size)
+        if job_id in archives
+        else reading_rows([job_id], batch_size)
+        for job_id in sorted(set(jobs_ids))
+    )
+    return chunked(rows, batch_size)
+
+
+def ndjson_chunks(batches):
+    # The only format without a fixed set of columns, so the only one with
+    # the other fields of the payload schemas
+    for batch in batches:
+        yield "".join(
+            fastjson.dumps(
+                dict(zip(COLUMNS, row[:4]), observed_at=row[4].isoformat(), **row[5])
+            )
+            + "\n"
+            for row in batch
+        ).encode()
+
+
+def csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(COLUMNS)
+    for batch in batches:
+        writer.writerows(row[:4] + (row[4].isoformat(),) for row in batch)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ExportError("Parquet and Arrow exports require the pyarrow package")
+    return pyarrow
+
+
+def arrow_schema(pa):
+    return pa.schema(
+        [
+            ("user_defined_id", pa.string()),
+            ("city_id", pa.int64()),
+            ("temperature", pa.float64()),
+            ("humidity", pa.int64()),
+            ("observed_at", pa.timestamp("us", tz="UTC")),
+        ]
+    )
+
+
+def record_batch(pa, schema, batch):
+    columns = list(zip(*batch))[: len(schema)]
+    return pa.RecordBatch.from_arrays(
+        [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+        schema=schema,
+    )
+
+
+class DrainableSink(io.RawIOBase):
+    """
+    Write-only file that hands out whatever was written since the last
+    drain, for writers that expect a file but whose output is streamed.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def parquet_chunks(batches):
+    """
+    Writes every batch as a Parquet row group, so readers can load the file
+    a row group at a time.
+    """
+    pa = import_pyarrow()
+    import pyarrow.parquet as pq
+
+    schema = arrow_schema(pa)
+    sink = DrainableSink()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(record_batch(pa, schema, batch))
+            yield sink.drain()
+    yield sink.drain()
+
+
+def arrow_chunks(batches):
+    """
+    Writes an Arrow IPC stream with one record batch per batch of rows.
+    """
+    pa = import_pyarrow()
+
+    schema = arrow_schema(pa)
+    sink = DrainableSink()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(record_batch(pa, schema, batch))
+            yield sink.drain()
+    yield sink.drain()
+
+
+# Format: (chunk writer, content type, file extension)
+FORMATS = {
+    "ndjson": (ndjson_chunks, "application/x-ndjson", "ndjson"),
+    "csv": (csv_chunks, "text/csv", "csv"),
+    "parquet": (parquet_chunks, "application/vnd.apache.parquet", "parquet"),
+    "arrow": (arrow_chunks, "application/vnd.apache.arrow.stream", "arrows"),
+}
+
+
+def gzip_compressor():
+    # wbits=31 writes a gzip header and trailer around the deflate stream
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+
+def zstd_compressor():
+    try:
+        import zstandard
+    except ImportError:
+        raise ExportError("zstd compression requires the zstandard package")
+    return zstandard.ZstdCompressor().compressobj()
+
+
+# Compression: (compressor factory, content type, file extension)
+COMPRESSIONS = {
+    "gzip": (gzip_compressor, "application/gzip", "gz"),
+    "zstd": (zstd_compressor, "application/zstd", "zst"),
+}
+
+
+def compress(chunks, compressor):
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_readings(jobs_ids, export_format, compression=None, batch_size=None):
+    """
+    Returns an iterator of the encoded bytes of the readings of the jobs.
+
+    Raises ExportError up front if the format or compression is unknown or
+    its optional package is missing, before any row is read.
+    """
+    if export_format not in FORMATS:
+        raise ExportError(
+            f"Unknown format {export_format!r}, expected one of {', '.join(FORMATS)}"
+        )
+    if compression and compression not in COMPRESSIONS:
+        raise ExportError(
+            f"Unknown compression {compression!r}, "
+            f"expected one of {', '.join(COMPRESSIONS)}"
+        )
+    if export_format in ("parquet", "arrow"):
+        import_pyarrow()
+    writer = FORMATS[export_format][0]
+    chunks = writer(iter_readings(jobs_ids, batch_size))
+    if compression:
+        chunks = compress(chunks, COMPRESSIONS[compression][0]())
+    return (chunk for chunk in chunks if chunk)
+
+
+async def aiter_chunks(chunks):
+    """
+    Iterates `chunks` a chunk at a time from a thread. Under ASGI Django
+    would otherwise read a synchronous iterator whole before sending it.
+    Every chunk is read from the same thread, as the database cursor of an
+    export belongs to the connection of the thread it was opened in.
+    """
+    chunks = iter(chunks)
+    read = sync_to_async(next)
+    try:
+        while True:
+            chunk = await read(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        # Closes the cursor when the client goes away mid-export
+        await sync_to_async(chunks.close)()
+
+
+def export_content_type(export_format, compression=None):
+    if compression:
+        return COMPRESSIONS[compression][1]
+    return FORMATS[export_format][1]
+
+
+def export_filename(export_format, compression=None):
+    name = f"weather.{FORMATS[export_format][2]}"
+    if compression:
+        name += f".{COMPRESSIONS[compression][2]}"
+    return name
@@ -0,0 +1,200 @@
+"""
+Local stand-in for the OpenWeather current weather endpoints.
+
+Serves `/data/2.5/weather?id=<city_id>` and `/data/2.5/group?id=<a,b,...>`
+with synthetic payloads so the collector can be exercised and benchmarked
+without an API key. Latency, error rate and quota are configurable; calls
+beyond the quota are answered with 429 and a Retry-After header, like the
+real API. Run it standalone with `python manage.py run_fake_upstream`.
+"""
+
+import json
+import math
+import random
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Current conditions are refreshed every 10 minutes upstream
+OBSERVATION_INTERVAL = 600
+
+
+def weather_response(city_id, now=None):
+    city_id = int(city_id)
+    now = time.time() if now is None else now
+    return {
+        "coord": {"lon": round(city_id % 360 - 180, 2), "lat": round(city_id % 180 - 90, 2)},
+        "weather": [{"id": 800, "main": "Clear", "description": "clear sky", "icon": "01d"}],
+        "main": {
+            "temp": 273.15 + city_id % 40,
+            "feels_like": 272.15 + city_id % 40,
+            "pressure": 1000 + city_id % 30,
+            "humidity": city_id % 100,
+        },
+        "wind": {"speed": city_id % 15, "deg": city_id % 360},
+        "clouds": {"all": city_id % 100},
+        "dt": int(now // OBSERVATION_INTERVAL * OBSERVATION_INTERVAL),
+        "id": city_id,
+        "name": f"City {city_id}",
+        "cod": 200,
+    }
+
+
+def constant_latency(seconds):
+    return lambda: seconds
+
+
+def uniform_latency(low, high, seed=None):
+    rng = random.Random(seed)
+    return lambda: rng.uniform(low, high)
+
+
+def lognormal_latency(median, sigma=0.8, seed=None):
+    """
+    Returns a latency sampler with a long right tail, which is what makes
+    waiting for the slowest call of a batch expensive.
+    """
+    rng = random.Random(seed)
+    mu = math.log(median)
+    return lambda: rng.lognormvariate(mu, sigma)
+
+
+LATENCIES = {
+    "constant": constant_latency,
+    "uniform": uniform_latency,
+    "lognormal": lognormal_latency,
+}
+
+
+def parse_latency(spec, seed=None):
+    """
+    Builds a latency sampler from `<distribution>:<arg>[:<arg>]` in seconds,
+    e.g. `constant:0.1`, `uniform:0.05:0.5` or `lognormal:0.2:0.8`.
+    """
+    name, *args = spec.split(":")
+    if name not in LATENCIES:
+        raise ValueError(f"Unknown latency distribution {name!r}")
+    args = [float(arg) for arg in args]
+    if name == "constant":
+        return constant_latency(*args)
+    return LATENCIES[name](*args, seed=seed)
+
+
+class SlidingWindowQuota:
+    """
+    Allows `calls` requests in any window of `period` seconds.
+    """
+
+    def __init__(self, calls, period, clock=time.monotonic):
+        self.calls = calls
+        self.period = period
+        self.clock = clock
+        self._accepted = deque()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Returns 0 when the call is allowed, otherwise the seconds to wait.
+        """
+        with self._lock:
+            now = self.clock()
+            while self._accepted and now - self._accepted[0] >= self.period:
+                self._accepted.popleft()
+            if len(self._accepted) < self.calls:
+                self._accepted.append(now)
+                return 0
+            return self.period - (now - self._accepted[0])
+
+
+def is_city_id(value):
+    return value.isascii() and value.isdigit()
+
+
+class FakeOpenWeatherHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        server = self.server
+        server.count("requests")
+        retry_after = server.quota.allow() if server.quota else 0
+        if retry_after:
+            server.count("throttled")
+            self.send_json(
+                429,
+                {"cod": 429, "message": "Your account is temporary blocked"},
+                {"Retry-After": str(math.ceil(retry_after))},
+            )
+            return
+        time.sleep(max(0, server.latency()))
+        if server.error_rate and server.rng.random() < server.error_rate:
+            server.count("errors")
+            self.send_json(500, {"cod": 500, "message": "Internal error"})
+        elif url.path.endswith(("/weather", "/group")) and "id" not in params:
+            self.send_json(400, {"cod": "400", "message": "Nothing to geocode"})
+        elif url.path.endswith(("/weather", "/group")):
+            cities_ids = params["id"][0].split(",")
+            invalid = [city_id for city_id in cities_ids if not is_city_id(city_id)]
+            if invalid:
+                self.send_json(
+                    400, {"cod": "400", "message": f"{invalid[0]} is not a city ID"}
+                )
+            elif url.path.endswith("/weather"):
+                server.count("cities")
+                self.send_json(200, weather_response(cities_ids[0]))
+            else:
+                server.count("cities", len(cities_ids))
+                self.send_json(
+                    200,
+                    {"cnt": len(cities_ids), "list": [weather_response(city_id) for city_id in cities_ids]},
+                )
+        else:
+            self.send_json(404, {"cod": "404", "message": "city not found"})
+
+
+class FakeOpenWeatherServer(ThreadingHTTPServer):
+    """
+    Threaded fake upstream. `latency` is a callable returning seconds,
+    `error_rate` the fraction of calls failing with 500, and `quota` an
+    optional (calls, period) pair beyond which calls get a 429.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), latency=None, error_rate=0, quota=None, seed=None):
+        super().__init__(address, FakeOpenWeatherHandler)
+        self.latency = latency or constant_latency(0)
+        self.error_rate = error_rate
+        self.quota = SlidingWindowQuota(*quota) if quota else None
+        self.rng = random.Random(seed)
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self._stats_lock:
+            self.stats[name] += amount
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/data/2.5"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
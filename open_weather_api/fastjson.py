@@ -0,0 +1,87 @@
+"""
+JSON encoding and decoding for the hot paths: upstream responses, stream
+events and JSON model fields.
+
+OPEN_WEATHER_JSON_BACKEND picks orjson or the standard library ("auto"
+uses orjson when it is installed). Both produce the same compact output.
+"""
+
+import json
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Built once, as json.dumps builds a new encoder whenever it gets options
+stdlib_encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+
+def orjson_dumps(obj):
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+BACKENDS = {
+    "json": (json.loads, stdlib_encoder.encode),
+    "orjson": (orjson and orjson.loads, orjson_dumps),
+}
+
+
+def get_backend(name=None):
+    """
+    Returns the (loads, dumps) pair of the configured backend.
+    """
+    name = name or settings.OPEN_WEATHER_JSON_BACKEND
+    if name == "auto":
+        name = "orjson" if orjson else "json"
+    if name not in BACKENDS:
+        raise ImproperlyConfigured(
+            f"Unknown OPEN_WEATHER_JSON_BACKEND {name!r}, "
+            f"expected auto or one of {', '.join(BACKENDS)}"
+        )
+    if name == "orjson" and orjson is None:
+        raise ImproperlyConfigured(
+            "OPEN_WEATHER_JSON_BACKEND=orjson requires the orjson package"
+        )
+    return BACKENDS[name]
+
+
+# The configured backend, resolved once: settings lookups cost more than
+# encoding a small document
+_backend = None
+
+
+def backend():
+    global _backend
+    if _backend is None:
+        _backend = get_backend()
+    return _backend
+
+
+def reset_backend(setting, **kwargs):
+    global _backend
+    if setting == "OPEN_WEATHER_JSON_BACKEND":
+        _backend = None
+
+
+setting_changed.connect(reset_backend)
+
+
+def loads(data):
+    """
+    Decodes JSON from bytes or str. Invalid documents raise
+    json.JSONDecodeError with either backend.
+    """
+    return (_backend or backend())[0](data)
+
+
+def dumps(obj):
+    """
+    Encodes `obj` as compact JSON and returns a str.
+    """
+    return (_backend or backend())[1](obj)
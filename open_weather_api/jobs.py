@@ -0,0 +1,479 @@
+import asyncio
+import datetime as dt
+import logging
+import os
+import socket
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import metrics
+from .adaptive import UpstreamControl
+from .cache import build_cache
+from .client import TimingSummary, close_client
+from .compact import compact_job, purge_compacted_rows
+from .collector import cache_entry, cached_result, collect
+from .models import CityReading, WeatherData
+from .profiling import current_job, span, spans
+from .rawarchive import RawArchive
+from .ratelimit import FairShare, build_limiter
+from .rollups import update_rollups
+from .schema import PayloadSchema, require
+from .singleflight import get_shared_leases, get_single_flight, merge
+from .writebehind import WriteBehind
+
+logger = logging.getLogger(__name__)
+
+# Payload fields stored in CityReading columns rather than in its `extra`
+READING_COLUMNS = ("city_id", "temperature", "humidity", "observed_at")
+
+
+def observed_at(response, default):
+    """
+    Returns the observation time reported by OpenWeather, if any.
+    """
+    if "dt" not in response:
+        return default
+    return dt.datetime.fromtimestamp(response["dt"], tz=dt.timezone.utc)
+
+
+def build_readings(job, responses):
+    """
+    Builds the readings of a batch of responses with the job's payload
+    schema, observed when OpenWeather says or else when the job was created.
+    """
+    payloads = PayloadSchema.for_job(job).build(responses)
+    for payload, response in zip(payloads, responses):
+        payload["observed_at"] = observed_at(response, job.request_datetime)
+    return payloads
+
+
+def enqueue_job(user_defined_id, cities_ids, fields=None, units=None):
+    """
+    Creates a queued job that a `collect_worker` process will pick up,
+    storing the payload `fields` in `units` (see schema.PayloadSchema).
+    """
+    schema = PayloadSchema(fields, units)
+    cities_ids = [int(city_id) for city_id in cities_ids]
+    return WeatherData.objects.create(
+        user_defined_id=user_defined_id,
+        request_datetime=timezone.now(),
+        cities_ids=cities_ids,
+        total_cities=len(cities_ids),
+        payload_fields=schema.fields,
+        units=schema.units,
+    )
+
+
+def claim_next_job(worker):
+    """
+    Atomically moves the oldest queued job to running for `worker`.
+
+    The conditional update only succeeds for one worker when several race for
+    the same row, so this needs no external broker or row locks.
+    """
+    while True:
+        job = (
+            WeatherData.objects.filter(status=WeatherData.QUEUED)
+            .order_by("request_datetime")
+            .first()
+        )
+        if job is None:
+            return None
+        now = timezone.now()
+        claimed = WeatherData.objects.filter(
+            pk=job.pk, status=WeatherData.QUEUED
+        ).update(
+            status=WeatherData.RUNNING, worker=worker, started_at=now, updated_at=now
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def reading_row(job, reading):
+    columns = {name: reading[name] for name in READING_COLUMNS}
+    extra = {name: value for name, value in reading.items() if name not in columns}
+    return CityReading(job=job, extra=extra, **columns)
+
+
+def new_readings(job, readings):
+    """
+    Returns the readings of the cities the job has no reading of yet, once
+    each, as retried and resumed batches may repeat cities already stored,
+    and those of them whose observation (city and time) no other job stored.
+
+    Observations cached or shared between jobs are stored by each of them,
+    but only rolled up by the first. Once compaction has deleted the rows of
+    that job, they are rolled up again.
+    """
+    times = {reading["observed_at"] for reading in readings}
+    stored, observed = set(), set()
+    for job_id, city_id, observed_at in CityReading.objects.filter(
+        Q(job=job) | Q(observed_at__in=times),
+        city_id__in={reading["city_id"] for reading in readings},
+    ).values_list("job_id", "city_id", "observed_at"):
+        if job_id == job.pk:
+            stored.add(city_id)
+        else:
+            observed.add((city_id, observed_at))
+    new, unobserved = [], []
+    for reading in readings:
+        if reading["city_id"] in stored:
+            continue
+        stored.add(reading["city_id"])
+        new.append(reading)
+        if (reading["city_id"], reading["observed_at"]) not in observed:
+            unobserved.append(reading)
+    return new, unobserved
+
+
+def save_readings(job, readings, failed_count=0, retried=0, throttled=0):
+    """
+    Appends a batch of readings to the job with a single insert, bumps its
+    progress and upstream call counters and adds the readings to the rollups
+    in the same transaction. Fields of the payload schema that have no
+    column go to the `extra` of the readings.
+
+    Only the readings of cities the job had none of are stored and counted,
+    and only the observations no other job stored are rolled up.
+    """
+    persist = span("persist", job.pk)
+    with persist, metrics.timed(metrics.DB_WRITE_SECONDS), transaction.atomic():
+        readings, unobserved = new_readings(job, readings) if readings else ([], [])
+        CityReading.objects.bulk_create(
+            [reading_row(job, reading) for reading in readings],
+            ignore_conflicts=True,
+        )
+        WeatherData.objects.filter(pk=job.pk).update(
+            done_cities=F("done_cities") + len(readings),
+            failed_cities=F("failed_cities") + failed_count,
+            retried_calls=F("retried_calls") + retried,
+            throttled_calls=F("throttled_calls") + throttled,
+            updated_at=timezone.now(),
+        )
+        update_rollups(PayloadSchema.for_job(job).celsius(unobserved))
+
+
+def save_responses(job, responses, failed_count=0, retried=0, throttled=0):
+    """
+    `save_readings` of a batch of responses, converted to readings together.
+    """
+    save_readings(
+        job, build_readings(job, responses), failed_count, retried, throttled
+    )
+
+
+def finish_job(job, status, error=""):
+    """
+    Marks the job as finished with the given status.
+    """
+    now = timezone.now()
+    WeatherData.objects.filter(pk=job.pk).update(
+        status=status, error=error, finished_at=now, updated_at=now
+    )
+
+
+def count_cache_lookups(job, hits, misses):
+    WeatherData.objects.filter(pk=job.pk).update(
+        cache_hits=F("cache_hits") + hits, cache_misses=F("cache_misses") + misses
+    )
+
+
+async def collect_through_cache(
+    job, cities_ids, limiter=None, cache=None, control=None
+):
+    """
+    Yields the cities with a fresh cached response first, then fetches the
+    rest upstream, adding every successful response to the cache.
+    """
+    if cache is None:
+        async for result in fetch_once(cities_ids, limiter, control):
+            yield result
+        return
+    hits = await sync_to_async(cache.get_many)(cities_ids)
+    await sync_to_async(count_cache_lookups)(
+        job, len(hits), len(cities_ids) - len(hits)
+    )
+    for city_id, response in hits.items():
+        yield cached_result(city_id, response)
+    async for result in fetch_once(
+        [city_id for city_id in cities_ids if city_id not in hits],
+        limiter,
+        control,
+        cache,
+    ):
+        yield result
+
+
+async def fetch_once(cities_ids, limiter=None, control=None, cache=None):
+    """
+    Fetches `cities_ids` upstream, adding every successful response to the
+    cache, except the cities another job is already fetching: with
+    OPEN_WEATHER_SINGLE_FLIGHT this waits for that job's call and yields
+    the same response.
+    """
+    flight = get_single_flight()
+    shared = None if cache is None else get_shared_leases(cache)
+    leading, following = flight.claim(cities_ids) if flight else (cities_ids, {})
+    led = list(leading)
+    remote = []
+    fetched = {}
+    settled = []
+
+    async def flush():
+        nonlocal fetched, settled
+        responses, done = fetched, settled
+        fetched = {}
+        settled = []
+        if cache is not None:
+            await sync_to_async(cache.set_many)(responses)
+        # Followers in other workers only find the responses once cached
+        if shared is not None:
+            await sync_to_async(shared.release)(done)
+
+    async def lead():
+        async for result in collect(leading, limiter=limiter, control=control):
+            if flight is not None:
+                flight.resolve(result)
+            settled.append(result.city_id)
+            if result.error is None:
+                fetched[result.city_id] = cache_entry(result)
+            yield result
+
+    async def wait_remote():
+        async for result in shared.follow(remote):
+            flight.resolve(result)
+            yield result
+
+    try:
+        if shared is not None and leading:
+            leading, remote = await sync_to_async(shared.claim)(leading)
+        streams = [lead()]
+        if following:
+            streams.append(flight.follow(following))
+        if remote:
+            streams.append(wait_remote())
+        async for result in merge(*streams):
+            if len(settled) >= settings.OPEN_WEATHER_BATCH_SIZE:
+                await flush()
+            yield result
+    finally:
+        if settled:
+            await flush()
+        if flight is not None:
+            flight.abandon(led)
+        if shared is not None and leading:
+            await sync_to_async(shared.release)(leading)
+
+
+async def collect_pass(job, cities_ids, limiter=None, retry=False, cache=None):
+    """
+    Fetches `cities_ids` for the job and returns the IDs of the cities that
+    failed. Readings are built and saved behind the fetches, every batch or
+    every OPEN_WEATHER_FLUSH_INTERVAL seconds, and whatever is buffered when
+    the pass ends or fails is saved before it returns.
+
+    With OPEN_WEATHER_RAW_ARCHIVE, the whole responses of the cities are
+    archived too, also those served from the cache or by another job's
+    call, so replay_weather can derive every reading from them again.
+
+    Cities retried by a tail pass were already counted as failed, so a retry
+    pass only moves the cities it recovers from failed to done. Upstream
+    calls retried or throttled are counted on the job with each flush.
+    """
+    failed = []
+    timings = TimingSummary()
+    control = UpstreamControl()
+    stats = control.stats
+
+    archive = RawArchive(job.pk)
+
+    async with WriteBehind(job, save_responses, stats) as buffer, archive:
+        async for result in collect_through_cache(
+            job, cities_ids, limiter, cache, control
+        ):
+            timings.add(result.timing)
+            metrics.CITIES.inc(1, "done" if result.error is None else "failed")
+            if result.error is not None:
+                failed.append(result.city_id)
+                await buffer.add(failed=0 if retry else 1)
+            else:
+                # Fails the pass here rather than the batch in its flush
+                require(result.data)
+                await buffer.add(result.data, failed=-1 if retry else 0)
+                await archive.add(result.raw)
+    if stats.retries or stats.rejected:
+        logger.info(
+            "Job %s retried %d upstream calls (%d throttled), %d were rejected "
+            "by the open circuit breaker",
+            job.pk,
+            stats.retries,
+            stats.throttled,
+            stats.rejected,
+        )
+    if timings.calls:
+        logger.info(
+            "Job %s made %d upstream calls in %.2fs: %d new connections took "
+            "%.2fs to set up, %.2fs was spent waiting on the server",
+            job.pk,
+            timings.calls,
+            timings.total,
+            timings.new_connections,
+            timings.connect,
+            timings.server,
+        )
+    return failed
+
+
+def running_jobs():
+    return WeatherData.objects.filter(status=WeatherData.RUNNING).count()
+
+
+def remaining_cities(job):
+    """
+    Returns the cities of the job that have no stored reading yet.
+    """
+    if not job.done_cities:
+        return list(job.cities_ids)
+    stored = set(job.readings.values_list("city_id", flat=True))
+    return [city_id for city_id in job.cities_ids if city_id not in stored]
+
+
+async def run_job(job, limiter=None, cache=None):
+    """
+    Collects the cities of the job that are not stored yet, then retries the
+    ones that failed in up to OPEN_WEATHER_RETRY_PASSES tail passes.
+
+    Cities with a fresh response in `cache` are served from it instead of
+    going upstream. With OPEN_WEATHER_COMPACT_STORAGE, a job that collected
+    every city is then packed into a compact archive.
+    """
+    # Runs in its own task, so this only tags the spans of this job
+    current_job.set(job.pk)
+    try:
+        cities_ids = await sync_to_async(remaining_cities)(job)
+        failed = await collect_pass(job, cities_ids, limiter, cache=cache)
+        for _ in range(settings.OPEN_WEATHER_RETRY_PASSES):
+            if not failed:
+                break
+            failed = await collect_pass(job, failed, limiter, retry=True, cache=cache)
+    except asyncio.CancelledError:
+        await sync_to_async(finish_job)(job, WeatherData.FAILED, "Interrupted")
+        raise
+    except Exception as exc:
+        logger.exception("Job %s failed", job.pk)
+        await sync_to_async(finish_job)(job, WeatherData.FAILED, repr(exc))
+        return
+    await sync_to_async(finish_job)(job, WeatherData.DONE)
+    try:
+        await sync_to_async(compact_job)(job)
+    except Exception:
+        # The rows are only deleted once the archive is written, so the job
+        # is still readable, just not compacted
+        logger.exception("Job %s could not be compacted", job.pk)
+
+
+def resume_job(job):
+    """
+    Queues an interrupted, failed or partially failed job again so a worker
+    fetches only the cities that are still missing.
+
+    Returns False if the job is still running or has nothing left to fetch.
+    Running jobs count as interrupted once they have not checkpointed for
+    OPEN_WEATHER_JOB_STALE_AFTER seconds, e.g. because their worker died.
+    """
+    stale_before = timezone.now() - dt.timedelta(
+        seconds=settings.OPEN_WEATHER_JOB_STALE_AFTER
+    )
+    # Only jobs that collected every city are compacted
+    if job.archive:
+        return False
+    with transaction.atomic():
+        done_cities = job.readings.count()
+        if done_cities >= job.total_cities:
+            return False
+        resumed = (
+            WeatherData.objects.filter(pk=job.pk)
+            .filter(
+                Q(status__in=WeatherData.FINISHED_STATUSES)
+                | Q(status=WeatherData.RUNNING, updated_at__lt=stale_before)
+            )
+            .update(
+                status=WeatherData.QUEUED,
+                done_cities=done_cities,
+                failed_cities=0,
+                worker="",
+                error="",
+                finished_at=None,
+            )
+        )
+    return bool(resumed)
+
+
+class Worker:
+    """
+    Runs queued jobs concurrently in a single event loop.
+
+    All jobs of a worker share one rate limiter, so running more of them at
+    once never exceeds the configured quota, and one observation cache, so
+    overlapping jobs only fetch each city once per freshness window. With a
+    shared limiter backend the quota also holds across workers, and with
+    OPEN_WEATHER_RATE_LIMIT_FAIR_SHARE each running job of the deployment
+    gets an equal part of it.
+    """
+
+    def __init__(self, concurrency=None, poll_interval=None, name=None):
+        self.concurrency = concurrency or settings.OPEN_WEATHER_WORKER_CONCURRENCY
+        self.poll_interval = poll_interval or settings.OPEN_WEATHER_WORKER_POLL_INTERVAL
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.limiter = build_limiter()
+        self.cache = build_cache()
+        self.tasks = set()
+
+    def job_limiter(self):
+        if settings.OPEN_WEATHER_RATE_LIMIT_FAIR_SHARE:
+            return FairShare(self.limiter, running_jobs)
+        return self.limiter
+
+    async def claim_jobs(self):
+        while len(self.tasks) < self.concurrency:
+            job = await sync_to_async(claim_next_job)(self.name)
+            if job is None:
+                return
+            logger.info("Worker %s running job %s", self.name, job.pk)
+            self.tasks.add(asyncio.ensure_future(run_job(job, self.job_limiter(), self.cache)))
+            metrics.WORKER_JOBS.set(len(self.tasks))
+
+    async def run(self, burst=False):
+        """
+        Polls the queue for jobs until cancelled, or until the queue is empty
+        when `burst` is set. Every poll also deletes the rows of compacted
+        jobs once their grace period is over.
+        """
+        try:
+            while True:
+                await self.claim_jobs()
+                await sync_to_async(spans.flush_if_due)()
+                await sync_to_async(purge_compacted_rows)()
+                if burst and not self.tasks:
+                    return
+                if self.tasks:
+                    done, _ = await asyncio.wait(
+                        self.tasks,
+                        timeout=self.poll_interval,
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+                    self.tasks.difference_update(done)
+                    metrics.WORKER_JOBS.set(len(self.tasks))
+                else:
+                    await asyncio.sleep(self.poll_interval)
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            if self.tasks:
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+            await close_client()
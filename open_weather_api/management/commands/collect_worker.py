@@ -0,0 +1,49 @@
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from open_weather_api import metrics
+from open_weather_api.jobs import Worker
+
+
+class Command(BaseCommand):
+    help = "Runs queued weather collection jobs."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            help="Maximum number of jobs collected at the same time.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            help="Seconds to wait between checks for new jobs.",
+        )
+        parser.add_argument(
+            "--burst",
+            action="store_true",
+            help="Exit once the queue is empty instead of waiting for new jobs.",
+        )
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            help="Port serving the worker's Prometheus metrics (OPEN_WEATHER_METRICS_PORT).",
+        )
+
+    def handle(self, *args, **options):
+        worker = Worker(
+            concurrency=options["concurrency"],
+            poll_interval=options["poll_interval"],
+        )
+        metrics_port = options["metrics_port"]
+        if metrics_port is None:
+            metrics_port = settings.OPEN_WEATHER_METRICS_PORT
+        if metrics_port and metrics.enabled():
+            metrics.start_metrics_server(metrics_port)
+            self.stdout.write(f"Serving metrics on port {metrics_port}")
+        self.stdout.write(f"Worker {worker.name} waiting for jobs")
+        try:
+            async_to_sync(worker.run)(burst=options["burst"])
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,64 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from open_weather_api.export import (
+    COMPRESSIONS,
+    FORMATS,
+    ExportError,
+    export_readings,
+)
+from open_weather_api.models import WeatherData
+
+
+class Command(BaseCommand):
+    help = "Exports the readings of one or many jobs to a file or stdout."
+
+    def add_arguments(self, parser):
+        parser.add_argument("jobs", nargs="+", help="User defined IDs of the jobs.")
+        parser.add_argument("--format", choices=list(FORMATS), default="ndjson")
+        parser.add_argument("--compression", choices=list(COMPRESSIONS))
+        parser.add_argument(
+            "--output",
+            "-o",
+            default="-",
+            help="File to write, stdout by default.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            help="Readings read and encoded at a time (OPEN_WEATHER_EXPORT_BATCH_SIZE).",
+        )
+
+    def handle(self, *args, **options):
+        jobs_ids = options["jobs"]
+        found = set(
+            WeatherData.objects.filter(user_defined_id__in=jobs_ids).values_list(
+                "user_defined_id", flat=True
+            )
+        )
+        missing = [job for job in jobs_ids if job not in found]
+        if missing:
+            raise CommandError(f"Unknown jobs: {', '.join(missing)}")
+        try:
+            chunks = export_readings(
+                jobs_ids,
+                options["format"],
+                options["compression"],
+                options["batch_size"],
+            )
+        except ExportError as exc:
+            raise CommandError(exc)
+
+        if options["output"] == "-":
+            output = getattr(self.stdout, "buffer", None) or sys.stdout.buffer
+            for chunk in chunks:
+                output.write(chunk)
+            output.flush()
+            return
+        size = 0
+        with open(options["output"], "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        self.stderr.write(f"Wrote {size} bytes to {options['output']}")
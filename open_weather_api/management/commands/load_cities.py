@@ -0,0 +1,68 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from more_itertools import chunked
+
+from open_weather_api.cities import read_cities_file
+from open_weather_api.models import City, CitySet
+
+# Rows per insert, below SQLite's limit of query parameters
+CHUNK_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = (
+        "Loads cities into the registry from OpenWeather's city.list.json(.gz) "
+        "or a list of city IDs, optionally as a named city set."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "path",
+            nargs="?",
+            help="Cities file, OPEN_WEATHER_CITIES_FILE by default.",
+        )
+        parser.add_argument(
+            "--set",
+            dest="city_set",
+            help=(
+                "Name of the city set made of the loaded cities, replacing any "
+                "set of that name. Defaults to OPEN_WEATHER_DEFAULT_CITY_SET "
+                "when loading OPEN_WEATHER_CITIES_FILE."
+            ),
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"] or settings.OPEN_WEATHER_CITIES_FILE
+        city_set = options["city_set"]
+        if city_set is None and not options["path"]:
+            city_set = settings.OPEN_WEATHER_DEFAULT_CITY_SET
+        try:
+            cities = read_cities_file(path)
+        except (OSError, ValueError, KeyError) as exc:
+            raise CommandError(f"Could not read {path}: {exc}")
+
+        # Files with bare IDs carry no details, so they must not blank out
+        # the names and coordinates of cities already registered.
+        detailed = any(city.name for city in cities)
+        with transaction.atomic():
+            for chunk in chunked(cities, CHUNK_SIZE):
+                if detailed:
+                    City.objects.bulk_create(
+                        chunk,
+                        update_conflicts=True,
+                        unique_fields=["id"],
+                        update_fields=["name", "state", "country", "lat", "lon"],
+                    )
+                else:
+                    City.objects.bulk_create(chunk, ignore_conflicts=True)
+            if city_set:
+                members, _ = CitySet.objects.get_or_create(name=city_set)
+                members.cities.clear()
+                for chunk in chunked(cities, CHUNK_SIZE):
+                    members.cities.add(*(city.id for city in chunk))
+
+        self.stdout.write(
+            f"Loaded {len(cities)} cities"
+            + (f" into the {city_set!r} set" if city_set else "")
+        )
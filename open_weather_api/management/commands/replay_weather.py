@@ -0,0 +1,83 @@
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from open_weather_api.models import WeatherData
+from open_weather_api.replay import ReplayError, replay_chunks, restore_readings
+
+
+class Command(BaseCommand):
+    help = (
+        "Derives the readings of one or many jobs again from their archived "
+        "upstream responses, without calling OpenWeather."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("jobs", nargs="+", help="User defined IDs of the jobs.")
+        parser.add_argument(
+            "--builder",
+            help=(
+                "Dotted path of a function building a payload from a response, "
+                "instead of the payload schema of each job."
+            ),
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=os.cpu_count(),
+            help="Processes decoding segments in parallel, one per CPU by default.",
+        )
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help=(
+                "Replace the readings the jobs already have with the replayed "
+                "ones, instead of only storing the missing ones."
+            ),
+        )
+        parser.add_argument(
+            "--output",
+            "-o",
+            help=(
+                "Write the payloads to this NDJSON file (- for stdout) instead "
+                "of storing the readings the jobs are missing."
+            ),
+        )
+
+    def handle(self, *args, **options):
+        jobs_ids = options["jobs"]
+        jobs = WeatherData.objects.in_bulk(jobs_ids)
+        missing = [job for job in jobs_ids if job not in jobs]
+        if missing:
+            raise CommandError(f"Unknown jobs: {', '.join(missing)}")
+        try:
+            if options["output"]:
+                self.write_payloads([jobs[job] for job in jobs_ids], options)
+                return
+            for job_id in jobs_ids:
+                restored = restore_readings(
+                    jobs[job_id],
+                    options["builder"],
+                    options["processes"],
+                    rebuild=options["rebuild"],
+                )
+                self.stdout.write(f"Restored {restored} readings of job {job_id}")
+        except ReplayError as exc:
+            raise CommandError(exc)
+
+    def write_payloads(self, jobs, options):
+        if options["output"] == "-":
+            output = getattr(self.stdout, "buffer", None) or sys.stdout.buffer
+            for job in jobs:
+                for chunk in replay_chunks(job, options["builder"], options["processes"]):
+                    output.write(chunk)
+            output.flush()
+            return
+        size = 0
+        with open(options["output"], "wb") as f:
+            for job in jobs:
+                for chunk in replay_chunks(job, options["builder"], options["processes"]):
+                    f.write(chunk)
+                    size += len(chunk)
+        self.stderr.write(f"Wrote {size} bytes to {options['output']}")
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from open_weather_api.fake_upstream import FakeOpenWeatherServer, parse_latency
+
+
+class Command(BaseCommand):
+    help = "Serves a local stand-in for the OpenWeather weather and group endpoints."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8001)
+        parser.add_argument(
+            "--latency",
+            default="lognormal:0.2:0.8",
+            help="constant:<s>, uniform:<low>:<high> or lognormal:<median>:<sigma>.",
+        )
+        parser.add_argument(
+            "--error-rate",
+            type=float,
+            default=0,
+            help="Fraction of calls answered with a 500 error.",
+        )
+        parser.add_argument(
+            "--quota",
+            help="<calls>/<seconds> allowed before answering 429, e.g. 60/60.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            latency = parse_latency(options["latency"])
+            quota = None
+            if options["quota"]:
+                calls, period = options["quota"].split("/")
+                quota = (int(calls), float(period))
+        except ValueError as exc:
+            raise CommandError(exc)
+        server = FakeOpenWeatherServer(
+            (options["host"], options["port"]),
+            latency=latency,
+            error_rate=options["error_rate"],
+            quota=quota,
+        )
+        self.stdout.write(
+            f"Fake OpenWeather listening; set OPEN_WEATHER_API_URL={server.base_url}"
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f"Served {dict(server.stats)}")
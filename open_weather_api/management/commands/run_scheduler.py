@@ -0,0 +1,37 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from open_weather_api.scheduler import run_due_schedules
+
+
+class Command(BaseCommand):
+    help = "Enqueues the recurring collections defined with `schedule_collection`."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            help="Seconds to wait between checks for due schedules.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Enqueue the due schedules once and exit.",
+        )
+
+    def handle(self, *args, **options):
+        poll_interval = (
+            options["poll_interval"] or settings.OPEN_WEATHER_SCHEDULER_POLL_INTERVAL
+        )
+        self.stdout.write("Scheduler waiting for due collections")
+        try:
+            while True:
+                for job in run_due_schedules():
+                    self.stdout.write(f"Enqueued job {job.user_defined_id}")
+                if options["once"]:
+                    return
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,67 @@
+import datetime as dt
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from open_weather_api.models import CitySet, CollectionSchedule
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates, updates, disables or lists the recurring collections run "
+        "by `run_scheduler`."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("name", nargs="?", help="Name of the schedule.")
+        parser.add_argument("--set", dest="city_set", help="City set to collect.")
+        parser.add_argument(
+            "--every",
+            type=int,
+            help="Seconds between two collections, e.g. 900 for every 15 minutes.",
+        )
+        parser.add_argument(
+            "--disable", action="store_true", help="Stop running the schedule."
+        )
+        parser.add_argument(
+            "--delete", action="store_true", help="Delete the schedule."
+        )
+
+    def handle(self, *args, **options):
+        name = options["name"]
+        if not name:
+            for schedule in CollectionSchedule.objects.order_by("name"):
+                self.stdout.write(
+                    f"{schedule.name}: {schedule.city_set_id} every "
+                    f"{schedule.interval}s, next run {schedule.next_run_at.isoformat()}"
+                    + ("" if schedule.enabled else " (disabled)")
+                )
+            return
+        if options["delete"]:
+            CollectionSchedule.objects.filter(name=name).delete()
+            self.stdout.write(f"Deleted schedule {name!r}")
+            return
+
+        schedule = CollectionSchedule.objects.filter(name=name).first()
+        if schedule is None:
+            if not options["city_set"] or not options["every"]:
+                raise CommandError("New schedules need --set and --every")
+            schedule = CollectionSchedule(name=name, next_run_at=timezone.now())
+        if options["city_set"]:
+            if not CitySet.objects.filter(name=options["city_set"]).exists():
+                raise CommandError(f"Unknown city set {options['city_set']!r}")
+            schedule.city_set_id = options["city_set"]
+        if options["every"] is not None:
+            if options["every"] < 1:
+                raise CommandError("--every must be a positive number of seconds")
+            schedule.interval = options["every"]
+        schedule.enabled = not options["disable"]
+        if schedule.enabled and schedule.next_run_at < timezone.now():
+            schedule.next_run_at = timezone.now()
+        schedule.full_clean()
+        schedule.save()
+        self.stdout.write(
+            f"Schedule {name!r} collects {schedule.city_set_id!r} every "
+            f"{dt.timedelta(seconds=schedule.interval)}"
+            + ("" if schedule.enabled else " (disabled)")
+        )
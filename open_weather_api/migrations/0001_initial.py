@@ -0,0 +1,22 @@
+# Generated by Django 4.2.1 on 2026-10-17 15:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WeatherData',
+            fields=[
+                ('user_defined_id', models.CharField(max_length=100, primary_key=True, serialize=False, unique=True)),
+                ('request_datetime', models.DateTimeField()),
+                ('city_info', models.JSONField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.1 on 2026-10-17 15:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_weather_api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CityReading',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('city_id', models.IntegerField()),
+                ('temperature', models.FloatField()),
+                ('humidity', models.IntegerField()),
+                ('observed_at', models.DateTimeField()),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='readings', to='open_weather_api.weatherdata')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['city_id', 'observed_at'], name='reading_city_observed_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='cityreading',
+            constraint=models.UniqueConstraint(fields=('job', 'city_id'), name='unique_reading_per_job_city'),
+        ),
+    ]
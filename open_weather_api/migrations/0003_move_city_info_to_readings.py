@@ -0,0 +1,44 @@
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def move_city_info_to_readings(apps, schema_editor):
+    WeatherData = apps.get_model("open_weather_api", "WeatherData")
+    CityReading = apps.get_model("open_weather_api", "CityReading")
+    for job in WeatherData.objects.iterator():
+        readings = [
+            CityReading(
+                job=job,
+                city_id=info["city_id"],
+                temperature=info["temperature"],
+                humidity=info["humidity"],
+                observed_at=job.request_datetime,
+            )
+            for info in (job.city_info or {}).get("cities_info", [])
+        ]
+        CityReading.objects.bulk_create(
+            readings, batch_size=BATCH_SIZE, ignore_conflicts=True
+        )
+
+
+def move_readings_to_city_info(apps, schema_editor):
+    WeatherData = apps.get_model("open_weather_api", "WeatherData")
+    for job in WeatherData.objects.iterator():
+        job.city_info = {
+            "cities_info": list(
+                job.readings.order_by("id").values("city_id", "temperature", "humidity")
+            )
+        }
+        job.save(update_fields=["city_info"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("open_weather_api", "0002_cityreading"),
+    ]
+
+    operations = [
+        migrations.RunPython(move_city_info_to_readings, move_readings_to_city_info),
+    ]
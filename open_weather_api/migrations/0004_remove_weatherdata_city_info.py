@@ -0,0 +1,17 @@
+# Generated by Django 4.2.1 on 2026-10-17 15:22
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_weather_api', '0003_move_city_info_to_readings'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='weatherdata',
+            name='city_info',
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.1 on 2026-10-17 15:23
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_counters(apps, schema_editor):
+    WeatherData = apps.get_model('open_weather_api', 'WeatherData')
+    # Jobs created so far collected every city of the cities file
+    with open(settings.OPEN_WEATHER_CITIES_FILE) as f:
+        cities_count = len([city_id for city_id in f.read().split(',') if city_id.strip()])
+    for job in WeatherData.objects.annotate(readings_count=Count('readings')).iterator():
+        job.done_cities = job.readings_count
+        job.total_cities = max(cities_count, job.readings_count)
+        job.updated_at = job.request_datetime
+        job.save(update_fields=['done_cities', 'total_cities', 'updated_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_weather_api', '0004_remove_weatherdata_city_info'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='weatherdata',
+            name='done_cities',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='weatherdata',
+            name='failed_cities',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='weatherdata',
+            name='total_cities',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='weatherdata',
+            name='updated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
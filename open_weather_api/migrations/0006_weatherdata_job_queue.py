@@ -0,0 +1,57 @@
+# Generated by Django 4.2.1 on 2026-10-17 15:24
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def mark_existing_jobs_done(apps, schema_editor):
+    # Jobs created before the queue existed were collected inline
+    WeatherData = apps.get_model('open_weather_api', 'WeatherData')
+    WeatherData.objects.update(
+        status='done', started_at=F('request_datetime'), finished_at=F('updated_at')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_weather_api', '0005_weatherdata_progress_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='weatherdata',
+            name='cities_ids',
+            field=models.JSONField(default=list),
+        ),
+        migrations.AddField(
+            model_name='weatherdata',
+            name='error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='weatherdata',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='weatherdata',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='weatherdata',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='weatherdata',
+            name='worker',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddIndex(
+            model_name='weatherdata',
+            index=models.Index(fields=['status', 'request_datetime'], name='job_status_queue_idx'),
+        ),
+        migrations.RunPython(mark_existing_jobs_done, migrations.RunPython.noop),
+    ]
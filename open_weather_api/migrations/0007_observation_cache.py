@@ -0,0 +1,31 @@
+# Generated by Django 4.2.1 on 2026-10-17 15:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_weather_api', '0006_weatherdata_job_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedObservation',
+            fields=[
+                ('city_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('response', models.JSONField()),
+                ('fetched_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='weatherdata',
+            name='cache_hits',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='weatherdata',
+            name='cache_misses',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
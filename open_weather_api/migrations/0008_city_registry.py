@@ -0,0 +1,46 @@
+# Generated by Django 4.2.1 on 2026-10-17 15:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_weather_api', '0007_observation_cache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='City',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('name', models.CharField(blank=True, max_length=200)),
+                ('state', models.CharField(blank=True, max_length=50)),
+                ('country', models.CharField(blank=True, max_length=2)),
+                ('lat', models.FloatField(blank=True, null=True)),
+                ('lon', models.FloatField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'cities',
+            },
+        ),
+        migrations.CreateModel(
+            name='CitySet',
+            fields=[
+                ('name', models.SlugField(max_length=100, primary_key=True, serialize=False)),
+                ('cities', models.ManyToManyField(related_name='sets', to='open_weather_api.city')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='city',
+            index=models.Index(fields=['country', 'name'], name='city_country_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='city',
+            index=models.Index(fields=['name'], name='city_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='city',
+            index=models.Index(fields=['lat', 'lon'], name='city_lat_lon_idx'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.2.1 on 2026-10-17 15:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_weather_api', '0008_city_registry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateLimitState',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('arrival', models.FloatField()),
+            ],
+        ),
+    ]
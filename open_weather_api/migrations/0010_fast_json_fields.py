@@ -0,0 +1,24 @@
+# Generated by Django 4.2.1 on 2026-10-17 15:40
+
+from django.db import migrations
+import open_weather_api.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_weather_api', '0009_rate_limit_state'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cachedobservation',
+            name='response',
+            field=open_weather_api.models.FastJSONField(),
+        ),
+        migrations.AlterField(
+            model_name='weatherdata',
+            name='cities_ids',
+            field=open_weather_api.models.FastJSONField(default=list),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.1 on 2026-10-17 15:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_weather_api', '0010_fast_json_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CityRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('city_id', models.IntegerField()),
+                ('start', models.DateTimeField()),
+                ('count', models.PositiveIntegerField()),
+                ('temperature_min', models.FloatField()),
+                ('temperature_max', models.FloatField()),
+                ('temperature_sum', models.FloatField()),
+                ('humidity_min', models.IntegerField()),
+                ('humidity_max', models.IntegerField()),
+                ('humidity_sum', models.IntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CollectionSchedule',
+            fields=[
+                ('name', models.SlugField(max_length=60, primary_key=True, serialize=False)),
+                ('interval', models.PositiveIntegerField()),
+                ('next_run_at', models.DateTimeField()),
+                ('enabled', models.BooleanField(default=True)),
+                ('last_job', models.CharField(blank=True, max_length=100)),
+                ('city_set', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='schedules', to='open_weather_api.cityset')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='cityrollup',
+            constraint=models.UniqueConstraint(fields=('period', 'city_id', 'start'), name='unique_rollup_bucket'),
+        ),
+        migrations.AddIndex(
+            model_name='collectionschedule',
+            index=models.Index(fields=['enabled', 'next_run_at'], name='schedule_due_idx'),
+        ),
+    ]
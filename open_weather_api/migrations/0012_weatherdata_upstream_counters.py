@@ -0,0 +1,23 @@
+# Generated by Django 4.2.1 on 2026-10-17 15:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_weather_api', '0011_schedules_and_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='weatherdata',
+            name='retried_calls',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='weatherdata',
+            name='throttled_calls',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
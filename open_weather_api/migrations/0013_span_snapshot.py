@@ -0,0 +1,22 @@
+# Generated by Django 4.2.1 on 2026-10-17 15:57
+
+from django.db import migrations, models
+import open_weather_api.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_weather_api', '0012_weatherdata_upstream_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpanSnapshot',
+            fields=[
+                ('process', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('updated_at', models.DateTimeField()),
+                ('spans', open_weather_api.models.FastJSONField(default=dict)),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.1 on 2026-10-17 18:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_weather_api', '0013_span_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='weatherdata',
+            name='archive',
+            field=models.CharField(blank=True, max_length=10),
+        ),
+        migrations.CreateModel(
+            name='ReadingArchive',
+            fields=[
+                ('job', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='open_weather_api.weatherdata')),
+                ('data', models.BinaryField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.1 on 2026-10-17 21:40
+
+from django.db import migrations, models
+import open_weather_api.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_weather_api', '0014_reading_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='weatherdata',
+            name='payload_fields',
+            field=open_weather_api.models.FastJSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='weatherdata',
+            name='units',
+            field=models.CharField(default='metric', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='cityreading',
+            name='extra',
+            field=open_weather_api.models.FastJSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-17 23:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('open_weather_api', '0015_payload_schema'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='weatherdata',
+            name='purge_rows_after',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -1,10 +1,232 @@
+import json
+
 from django.db import models
+from django.db.backends.base.operations import BaseDatabaseOperations
+from django.db.models.fields.json import KeyTransform
+
+from . import fastjson
+
+
+class FastJSONField(models.JSONField):
+    """
+    JSONField encoded and decoded with open_weather_api.fastjson on
+    databases that store JSON as text, such as SQLite.
+    """
+
+    def from_db_value(self, value, expression, connection):
+        if value is None or (
+            isinstance(expression, KeyTransform) and not isinstance(value, str)
+        ):
+            return value
+        try:
+            return fastjson.loads(value)
+        except json.JSONDecodeError:
+            return value
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        # Backends with a native JSON type adapt values themselves
+        if (
+            hasattr(value, "as_sql")
+            or type(connection.ops).adapt_json_value
+            is not BaseDatabaseOperations.adapt_json_value
+        ):
+            return super().get_db_prep_value(value, connection, prepared)
+        return fastjson.dumps(value)
 
 
 class WeatherData(models.Model):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+    FINISHED_STATUSES = (DONE, FAILED)
+
     user_defined_id = models.CharField(max_length=100, unique=True, primary_key=True)
     request_datetime = models.DateTimeField()
-    city_info = models.JSONField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    cities_ids = FastJSONField(default=list)
+    worker = models.CharField(max_length=100, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    total_cities = models.PositiveIntegerField(default=0)
+    done_cities = models.PositiveIntegerField(default=0)
+    failed_cities = models.PositiveIntegerField(default=0)
+    cache_hits = models.PositiveIntegerField(default=0)
+    cache_misses = models.PositiveIntegerField(default=0)
+    # Upstream calls made again after a 429, 5xx or timeout, and 429s
+    retried_calls = models.PositiveIntegerField(default=0)
+    throttled_calls = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(null=True, blank=True)
+    # Where the readings were packed by open_weather_api.compact once the job
+    # was done, replacing its CityReading rows; empty while they are rows
+    archive = models.CharField(max_length=10, blank=True)
+    # When the rows left behind by the compaction may be deleted
+    purge_rows_after = models.DateTimeField(null=True, blank=True, db_index=True)
+    # Payload schema (open_weather_api.schema): fields stored on top of the
+    # temperature and humidity, and the units of every reading
+    payload_fields = FastJSONField(default=list, blank=True)
+    units = models.CharField(max_length=10, default="metric")
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["status", "request_datetime"], name="job_status_queue_idx"
+            ),
+        ]
 
     def __str__(self):
         return self.user_defined_id
+
+
+class CityReading(models.Model):
+    job = models.ForeignKey(
+        WeatherData, on_delete=models.CASCADE, related_name="readings"
+    )
+    city_id = models.IntegerField()
+    temperature = models.FloatField()
+    humidity = models.IntegerField()
+    observed_at = models.DateTimeField()
+    # The other fields of the job's payload schema, by name
+    extra = FastJSONField(default=dict, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["job", "city_id"], name="unique_reading_per_job_city"
+            ),
+        ]
+        indexes = [
+            models.Index(
+                fields=["city_id", "observed_at"], name="reading_city_observed_idx"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.job_id}:{self.city_id}"
+
+
+class ReadingArchive(models.Model):
+    # Readings of a finished job packed by open_weather_api.compact
+    job = models.OneToOneField(
+        WeatherData, on_delete=models.CASCADE, primary_key=True, related_name="+"
+    )
+    data = models.BinaryField()
+
+    def __str__(self):
+        return self.job_id
+
+
+class CachedObservation(models.Model):
+    city_id = models.IntegerField(primary_key=True)
+    response = FastJSONField()
+    fetched_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return str(self.city_id)
+
+
+class City(models.Model):
+    # OpenWeather city ID
+    id = models.IntegerField(primary_key=True)
+    name = models.CharField(max_length=200, blank=True)
+    state = models.CharField(max_length=50, blank=True)
+    country = models.CharField(max_length=2, blank=True)
+    lat = models.FloatField(null=True, blank=True)
+    lon = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = "cities"
+        indexes = [
+            models.Index(fields=["country", "name"], name="city_country_name_idx"),
+            models.Index(fields=["name"], name="city_name_idx"),
+            models.Index(fields=["lat", "lon"], name="city_lat_lon_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.id})" if self.name else str(self.id)
+
+
+class CitySet(models.Model):
+    name = models.SlugField(max_length=100, primary_key=True)
+    cities = models.ManyToManyField(City, related_name="sets")
+
+    def __str__(self):
+        return self.name
+
+
+class RateLimitState(models.Model):
+    # State of a DatabaseRateLimiter, see open_weather_api.ratelimit
+    name = models.CharField(max_length=100, primary_key=True)
+    arrival = models.FloatField()
+
+    def __str__(self):
+        return self.name
+
+
+class CollectionSchedule(models.Model):
+    # Recurring collection of a city set, run by the `run_scheduler` command
+    name = models.SlugField(max_length=60, primary_key=True)
+    city_set = models.ForeignKey(
+        CitySet, on_delete=models.CASCADE, related_name="schedules"
+    )
+    # Seconds between two collections
+    interval = models.PositiveIntegerField()
+    next_run_at = models.DateTimeField()
+    enabled = models.BooleanField(default=True)
+    last_job = models.CharField(max_length=100, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["enabled", "next_run_at"], name="schedule_due_idx"
+            ),
+        ]
+
+    def __str__(self):
+        return self.name
+
+
+class CityRollup(models.Model):
+    HOUR = "hour"
+    DAY = "day"
+    PERIOD_CHOICES = [(HOUR, "Hour"), (DAY, "Day")]
+    PERIOD_SECONDS = {HOUR: 3600, DAY: 86400}
+
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    city_id = models.IntegerField()
+    # Start of the hour or UTC day the readings were observed in
+    start = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    temperature_min = models.FloatField()
+    temperature_max = models.FloatField()
+    temperature_sum = models.FloatField()
+    humidity_min = models.IntegerField()
+    humidity_max = models.IntegerField()
+    humidity_sum = models.IntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["period", "city_id", "start"], name="unique_rollup_bucket"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.period}:{self.city_id}:{self.start.isoformat()}"
+
+
+class SpanSnapshot(models.Model):
+    # Latest spans of one process, see open_weather_api.profiling
+    process = models.CharField(max_length=100, primary_key=True)
+    updated_at = models.DateTimeField()
+    spans = FastJSONField(default=dict)
+
+    def __str__(self):
+        return self.process
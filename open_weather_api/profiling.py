@@ -0,0 +1,404 @@
+"""
+Opt-in profiling of requests and lightweight trace spans of the collection
+stages, to find hot spots in production without redeploying.
+
+Views decorated with `profiled` are run under a profiler when
+OPEN_WEATHER_PROFILE_REQUESTS is set, or when a staff user (or a caller
+holding OPEN_WEATHER_PROFILE_TOKEN) sends an `X-Profile` header. Profiles
+are saved to OPEN_WEATHER_PROFILE_DIR.
+
+Spans time the fetch, parse, persist and stream stages. Each process keeps
+the latest ones in memory and saves a snapshot to the database every
+OPEN_WEATHER_SPAN_FLUSH_INTERVAL seconds, so /debug/spans/ shows the
+workers' spans next to the web processes'.
+"""
+
+import asyncio
+import contextvars
+import cProfile
+import hmac
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+from asgiref.sync import (
+    async_to_sync,
+    iscoroutinefunction,
+    markcoroutinefunction,
+    sync_to_async,
+)
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.utils import timezone
+
+# Job whose collection the running code belongs to, set by run_job
+current_job = contextvars.ContextVar("open_weather_current_job", default=None)
+
+PROCESS = f"{socket.gethostname()}:{os.getpid()}"
+
+# OPEN_WEATHER_TRACE_SPANS, read once: settings lookups cost more than a span
+_spans_enabled = None
+
+
+def spans_enabled():
+    global _spans_enabled
+    if _spans_enabled is None:
+        _spans_enabled = settings.OPEN_WEATHER_TRACE_SPANS
+    return _spans_enabled
+
+
+def reset_spans_enabled(setting, **kwargs):
+    global _spans_enabled
+    if setting == "OPEN_WEATHER_TRACE_SPANS":
+        _spans_enabled = None
+
+
+setting_changed.connect(reset_spans_enabled)
+
+
+class SpanRecorder:
+    """
+    Keeps the last `size` spans of the process and, per stage, how many
+    spans there were, their total and their longest duration.
+    """
+
+    def __init__(self, size=None):
+        self.size = size
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.recent = deque(maxlen=self.size or settings.OPEN_WEATHER_SPAN_BUFFER)
+        self.stages = {}
+        self.flushed_at = time.monotonic()
+        self.dirty = False
+
+    def record(self, name, started, duration, job=None):
+        """
+        Records a span that began at `started` (time.time()) and lasted
+        `duration` seconds, attributed to `job` or the current job.
+        """
+        if not spans_enabled():
+            return
+        job = job or current_job.get()
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = [0, 0.0, 0.0]
+            stage[0] += 1
+            stage[1] += duration
+            stage[2] = max(stage[2], duration)
+            self.recent.append((name, job, started, duration))
+            self.dirty = True
+
+    def snapshot(self):
+        with self.lock:
+            stages = {name: list(stage) for name, stage in self.stages.items()}
+            recent = list(self.recent)
+        return {
+            "stages": {
+                name: {
+                    "count": count,
+                    "total_ms": round(total * 1000, 3),
+                    "avg_ms": round(total / count * 1000, 3),
+                    "max_ms": round(longest * 1000, 3),
+                }
+                for name, (count, total, longest) in sorted(stages.items())
+            },
+            "recent": [
+                {
+                    "name": name,
+                    "job": job,
+                    "started_at": round(started, 6),
+                    "duration_ms": round(duration * 1000, 3),
+                }
+                for name, job, started, duration in reversed(recent)
+            ],
+        }
+
+    def flush(self):
+        from .models import SpanSnapshot
+
+        self.flushed_at = time.monotonic()
+        self.dirty = False
+        SpanSnapshot.objects.update_or_create(
+            process=PROCESS,
+            defaults={"updated_at": timezone.now(), "spans": self.snapshot()},
+        )
+
+    def due(self):
+        """
+        Whether spans were recorded since the last snapshot and
+        OPEN_WEATHER_SPAN_FLUSH_INTERVAL has passed.
+        """
+        return (
+            self.dirty
+            and time.monotonic() - self.flushed_at
+            >= settings.OPEN_WEATHER_SPAN_FLUSH_INTERVAL
+        )
+
+    def flush_if_due(self):
+        """
+        Saves the snapshot of the process if it is due.
+        """
+        if self.due():
+            self.flush()
+
+
+spans = SpanRecorder()
+
+
+class span:
+    """
+    Context manager recording the duration of its block as a span.
+    """
+
+    __slots__ = ("name", "job", "started", "wall")
+
+    def __init__(self, name, job=None):
+        self.name = name
+        self.job = job
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        spans.record(self.name, self.wall, time.perf_counter() - self.started, self.job)
+
+
+def traced_stream(chunks, name, job=None):
+    """
+    Yields the chunks of a streaming response, recording the time spent
+    producing each one as a span.
+    """
+    chunks = iter(chunks)
+    while True:
+        with span(name, job):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+async def traced_async_stream(chunks, name, job=None):
+    """
+    `traced_stream` for the async iterators streamed under ASGI.
+    """
+    chunks = chunks.__aiter__()
+    while True:
+        with span(name, job):
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                return
+        yield chunk
+
+
+class CProfiler:
+    extension = "prof"
+
+    def run(self, func, *args, **kwargs):
+        self.profile = cProfile.Profile()
+        return self.profile.runcall(func, *args, **kwargs)
+
+    async def arun(self, func, *args, **kwargs):
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            self.profile.disable()
+
+    def save(self, path):
+        self.profile.dump_stats(path)
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler from the optional pyinstrument package, much cheaper
+    than cProfile on long requests. Saves an HTML report.
+    """
+
+    extension = "html"
+
+    def __init__(self):
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise ImproperlyConfigured(
+                "The sampling profiler requires the pyinstrument package"
+            )
+        self.profiler = Profiler()
+
+    def run(self, func, *args, **kwargs):
+        self.profiler.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.profiler.stop()
+
+    async def arun(self, func, *args, **kwargs):
+        self.profiler.start()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            self.profiler.stop()
+
+    def save(self, path):
+        with open(path, "w") as f:
+            f.write(self.profiler.output_html())
+
+
+PROFILERS = {"cprofile": CProfiler, "sampling": SamplingProfiler}
+
+
+def profiled(view):
+    """
+    Class decorator letting ProfilingMiddleware profile requests to a view.
+    """
+    view.profiled = True
+    return view
+
+
+def token_matches(supplied, token):
+    # compare_digest only takes ASCII str, and headers may be anything
+    return hmac.compare_digest(
+        supplied.encode("utf-8", "surrogatepass"), token.encode("utf-8")
+    )
+
+
+def requested_profiler(request):
+    """
+    Returns the name of the profiler to run the request under, or None.
+
+    `X-Profile` (1, cprofile or sampling) is only honoured for staff users
+    or along with an `X-Profile-Token` matching OPEN_WEATHER_PROFILE_TOKEN,
+    so anonymous callers cannot slow the service down.
+    """
+    header = request.headers.get("X-Profile")
+    if header:
+        token = settings.OPEN_WEATHER_PROFILE_TOKEN
+        user = getattr(request, "user", None)
+        if (user is not None and user.is_staff) or (
+            token and token_matches(request.headers.get("X-Profile-Token", ""), token)
+        ):
+            return header if header in PROFILERS else settings.OPEN_WEATHER_PROFILER
+    if settings.OPEN_WEATHER_PROFILE_REQUESTS:
+        return settings.OPEN_WEATHER_PROFILER
+    return None
+
+
+def list_profiles():
+    """
+    Returns the file names of the saved profiles, newest first.
+    """
+    directory = settings.OPEN_WEATHER_PROFILE_DIR
+    if not os.path.isdir(directory):
+        return []
+    names = [
+        name
+        for name in os.listdir(directory)
+        if name.rsplit(".", 1)[-1] in ("prof", "html")
+    ]
+    return sorted(names, reverse=True)
+
+
+class ProfilingMiddleware:
+    """
+    Profiles requests to `profiled` views when asked to, and saves the span
+    snapshot of the process when due.
+
+    Under ASGI it runs on the event loop, so requests to async views are not
+    moved to a thread for its sake, and only goes to a thread to save spans
+    or to check who asked for a profile.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+            # Django would run a synchronous process_view in a thread
+            self.process_view = self.aprocess_view
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        response = self.get_response(request)
+        spans.flush_if_due()
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        if spans.due():
+            await sync_to_async(spans.flush)()
+        return response
+
+    def view_profiler(self, request, view_func):
+        """
+        Returns the profiler to run a request to `view_func` under, or None.
+        """
+        view = getattr(view_func, "view_class", view_func)
+        if not getattr(view, "profiled", False):
+            return None
+        name = requested_profiler(request)
+        if name is None:
+            return None
+        if name not in PROFILERS:
+            raise ImproperlyConfigured(
+                f"Unknown OPEN_WEATHER_PROFILER {name!r}, "
+                f"expected one of {', '.join(PROFILERS)}"
+            )
+        return PROFILERS[name]()
+
+    def save_profile(self, view_func, profiler, response):
+        view = getattr(view_func, "view_class", view_func)
+        os.makedirs(settings.OPEN_WEATHER_PROFILE_DIR, exist_ok=True)
+        filename = (
+            f"{timezone.now():%Y%m%dT%H%M%S%f}-{view.__name__}-{os.getpid()}"
+            f".{profiler.extension}"
+        )
+        profiler.save(os.path.join(settings.OPEN_WEATHER_PROFILE_DIR, filename))
+        response["X-Profile"] = filename
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        profiler = self.view_profiler(request, view_func)
+        if profiler is None:
+            return None
+        view = getattr(view_func, "view_class", view_func)
+        with span(f"request:{view.__name__}"):
+            if asyncio.iscoroutinefunction(view_func):
+                # Profiles the event loop thread the async view runs in
+                response = async_to_sync(profiler.arun)(
+                    view_func, request, *view_args, **view_kwargs
+                )
+            else:
+                response = profiler.run(view_func, request, *view_args, **view_kwargs)
+        return self.save_profile(view_func, profiler, response)
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        if not request.headers.get("X-Profile") and not settings.OPEN_WEATHER_PROFILE_REQUESTS:
+            return None
+        # Checking a staff user may load the session and user from the database
+        profiler = await sync_to_async(self.view_profiler)(request, view_func)
+        if profiler is None:
+            return None
+        view = getattr(view_func, "view_class", view_func)
+        with span(f"request:{view.__name__}"):
+            if asyncio.iscoroutinefunction(view_func):
+                response = await profiler.arun(
+                    view_func, request, *view_args, **view_kwargs
+                )
+            else:
+                response = await sync_to_async(profiler.run)(
+                    view_func, request, *view_args, **view_kwargs
+                )
+        return await sync_to_async(self.save_profile)(view_func, profiler, response)
@@ -0,0 +1,275 @@
+import asyncio
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from . import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Thread of the blocking calls of the limiters, with its own database
+# connection: on the thread shared by sync_to_async they would queue behind
+# the write-behind flushes, making fetches wait on database writes again.
+# A single thread keeps the reservations of a process in order.
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ratelimit")
+
+
+def off_flushes(func):
+    return sync_to_async(func, thread_sensitive=False, executor=executor)
+
+
+class RateLimiter:
+    """
+    Base class of the limiters allowing `calls` upstream requests every
+    `period` seconds.
+
+    `reserve` takes one call and returns how many seconds to wait before
+    making it. Limiters whose state lives outside the process (`shared`)
+    reserve from a thread, since they do blocking I/O.
+    """
+
+    shared = False
+
+    def __init__(self, calls, period):
+        self.calls = calls
+        self.period = period
+
+    def reserve(self):
+        raise NotImplementedError
+
+    def utilization(self):
+        """
+        Returns the share of the quota currently in use: 0 when idle, 1 when
+        the whole burst is spent, above 1 when callers are queued.
+        """
+        raise NotImplementedError
+
+    async def acquire(self):
+        if self.shared:
+            delay = await off_flushes(self.reserve)()
+        else:
+            delay = self.reserve()
+        if delay:
+            metrics.SLEEP_SECONDS.observe(delay, "rate_limit")
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        return {
+            "backend": type(self).__name__,
+            "shared": self.shared,
+            "calls": self.calls,
+            "period": self.period,
+            "utilization": round(self.utilization(), 3),
+        }
+
+
+class TokenBucket(RateLimiter):
+    """
+    Continuous token bucket allowing `calls` requests every `period` seconds.
+
+    Tokens refill evenly over the period instead of all at once, so a slow
+    upstream call never wastes the rest of the window. Callers that find the
+    bucket empty reserve a future token and sleep until it is due, which keeps
+    waiters in FIFO order without needing a lock.
+
+    The bucket only coordinates the callers of one process.
+    """
+
+    def __init__(self, calls, period, clock=time.monotonic):
+        super().__init__(calls, period)
+        self.capacity = calls
+        self.rate = calls / period
+        self.clock = clock
+        self._tokens = float(calls)
+        self._updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def set_rate(self, calls):
+        """
+        Changes how many calls are allowed per period from now on.
+        """
+        self._refill()
+        self.capacity = calls
+        self.rate = calls / self.period
+        self._tokens = min(self._tokens, calls)
+
+    def reserve(self):
+        """
+        Takes one token and returns how many seconds to wait before using it.
+        """
+        self._refill()
+        self._tokens -= 1
+        return max(0.0, -self._tokens / self.rate)
+
+    def utilization(self):
+        self._refill()
+        return (self.capacity - self._tokens) / self.capacity
+
+
+class SharedRateLimiter(RateLimiter):
+    """
+    Base class of the limiters shared by every process of a deployment.
+
+    The state is a single "theoretical arrival time" (GCRA): the time at
+    which the bucket would be full again. Each call pushes it one interval
+    further, so the same number works as a token bucket of `calls` tokens
+    and can be updated atomically by whichever backend stores it. Times are
+    wall-clock, as they are compared across processes.
+    """
+
+    shared = True
+
+    def __init__(self, calls, period, name="default", clock=time.time):
+        super().__init__(calls, period)
+        self.name = name
+        self.clock = clock
+        self.interval = period / calls
+
+    def next_arrival(self, arrival, now):
+        """
+        Returns the new arrival time after one call and the delay before
+        that call may be made.
+        """
+        arrival = max(arrival, now) + self.interval
+        return arrival, max(0.0, arrival - self.period - now)
+
+    def utilization(self):
+        arrival = self.load()
+        return max(0.0, arrival - self.clock()) / self.period
+
+    def load(self):
+        raise NotImplementedError
+
+
+class DatabaseRateLimiter(SharedRateLimiter):
+    """
+    Keeps the limiter state in a RateLimitState row of the default database,
+    shared by every worker and host using it. Reservations are a conditional
+    update against the last state seen, retried with a fresh read when
+    another process moved the row first.
+    """
+
+    def __init__(self, calls, period, name="default", clock=time.time):
+        super().__init__(calls, period, name, clock)
+        self._arrival = None
+
+    def load(self):
+        from .models import RateLimitState
+
+        state = RateLimitState.objects.filter(name=self.name).first()
+        return state.arrival if state else 0.0
+
+    def reserve(self):
+        from .models import RateLimitState
+
+        while True:
+            now = self.clock()
+            if self._arrival is None:
+                state, _ = RateLimitState.objects.get_or_create(
+                    name=self.name, defaults={"arrival": now}
+                )
+                self._arrival = state.arrival
+            arrival, delay = self.next_arrival(self._arrival, now)
+            if RateLimitState.objects.filter(
+                name=self.name, arrival=self._arrival
+            ).update(arrival=arrival):
+                self._arrival = arrival
+                return delay
+            self._arrival = None
+
+
+class FileRateLimiter(SharedRateLimiter):
+    """
+    Keeps the limiter state in a file locked with flock, shared by every
+    process of a single host without touching the database.
+    """
+
+    def __init__(self, calls, period, name="default", clock=time.time, path=None):
+        super().__init__(calls, period, name, clock)
+        if fcntl is None:
+            raise OSError("FileRateLimiter needs fcntl, which this platform lacks")
+        self.path = path or settings.OPEN_WEATHER_RATE_LIMIT_FILE.format(name=name)
+
+    def _locked(self, update):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            raw = os.pread(fd, 8, 0)
+            arrival = struct.unpack("d", raw)[0] if len(raw) == 8 else 0.0
+            result = update(arrival)
+            if result is not None:
+                os.pwrite(fd, struct.pack("d", result[0]), 0)
+            return arrival, result
+        finally:
+            os.close(fd)
+
+    def load(self):
+        arrival, _ = self._locked(lambda arrival: None)
+        return arrival
+
+    def reserve(self):
+        _, (_, delay) = self._locked(
+            lambda arrival: self.next_arrival(arrival, self.clock())
+        )
+        return delay
+
+
+class FairShare(RateLimiter):
+    """
+    Limits one job to an equal share of the quota among the running jobs,
+    before taking its calls from the shared `limiter`.
+
+    Without it, a job with many requests in flight crowds out the others.
+    `active_jobs` returns the number of running jobs; it is called again
+    every `refresh` seconds so the share follows jobs starting and ending.
+    """
+
+    def __init__(self, limiter, active_jobs, refresh=5, clock=time.monotonic):
+        super().__init__(limiter.calls, limiter.period)
+        self.limiter = limiter
+        self.active_jobs = active_jobs
+        self.refresh = refresh
+        self.clock = clock
+        self.bucket = TokenBucket(limiter.calls, limiter.period, clock=clock)
+        self._refreshed = None
+
+    async def update_share(self):
+        now = self.clock()
+        if self._refreshed is not None and now - self._refreshed < self.refresh:
+            return
+        self._refreshed = now
+        jobs = max(1, await off_flushes(self.active_jobs)())
+        self.bucket.set_rate(max(1, self.calls / jobs))
+
+    async def acquire(self):
+        await self.update_share()
+        await self.bucket.acquire()
+        await self.limiter.acquire()
+
+    def utilization(self):
+        return self.limiter.utilization()
+
+
+def build_limiter():
+    """
+    Returns the limiter configured by OPEN_WEATHER_RATE_LIMIT_BACKEND and the
+    rate limit settings.
+    """
+    return import_string(settings.OPEN_WEATHER_RATE_LIMIT_BACKEND)(
+        settings.OPEN_WEATHER_RATE_LIMIT_CALLS,
+        settings.OPEN_WEATHER_RATE_LIMIT_PERIOD,
+    )
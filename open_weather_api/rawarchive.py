@@ -0,0 +1,239 @@
+"""
+Append-only archive of the raw upstream responses of every job, as
+compressed NDJSON segments on local disk, so readings can be derived again
+(`manage.py replay_weather`) without calling OpenWeather.
+
+The segments of a job live in a directory of OPEN_WEATHER_RAW_ARCHIVE_DIR
+named after a hash of its ID. Every flush appends a complete gzip member or
+zstd frame to the current segment, so a worker that dies only loses the
+flush in progress, and a new segment is started every
+OPEN_WEATHER_RAW_ARCHIVE_SEGMENT_SIZE responses.
+
+Cities served from the observation cache or by another job's call are
+archived by every job they serve, as the cache keeps whole responses while
+they are archived (see collector.cache_entry).
+"""
+
+import asyncio
+import gzip
+import hashlib
+import io
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import fastjson
+
+logger = logging.getLogger(__name__)
+
+# Thread of the segment writes: on the thread shared by sync_to_async they
+# would queue behind the write-behind flushes, making fetches wait on the
+# database again. A single thread writes the flushes of a job in order.
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rawarchive")
+
+
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImproperlyConfigured(
+            "OPEN_WEATHER_RAW_ARCHIVE=zstd requires the zstandard package"
+        )
+    return zstandard
+
+
+def zstd_compress(data):
+    return import_zstandard().ZstdCompressor().compress(data)
+
+
+def gzip_lines(f):
+    try:
+        yield from gzip.GzipFile(fileobj=f)
+    except (EOFError, gzip.BadGzipFile) as exc:
+        logger.warning("Skipped the truncated end of %s: %s", f.name, exc)
+
+
+def zstd_lines(f):
+    zstandard = import_zstandard()
+    reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+    try:
+        yield from io.BufferedReader(reader)
+    except zstandard.ZstdError as exc:
+        logger.warning("Skipped the truncated end of %s: %s", f.name, exc)
+
+
+# Compression: (compressor of a flush, line reader of a segment, extension)
+COMPRESSIONS = {
+    "gzip": (gzip.compress, gzip_lines, "ndjson.gz"),
+    "zstd": (zstd_compress, zstd_lines, "ndjson.zst"),
+}
+
+
+def get_compression(name):
+    if name not in COMPRESSIONS:
+        raise ImproperlyConfigured(
+            f"Unknown OPEN_WEATHER_RAW_ARCHIVE {name!r}, "
+            f"expected one of {', '.join(COMPRESSIONS)} or an empty value"
+        )
+    if name == "zstd":
+        import_zstandard()
+    return COMPRESSIONS[name]
+
+
+def job_directory(job_id):
+    # Job IDs are chosen by clients, so they never become paths
+    digest = hashlib.sha256(job_id.encode()).hexdigest()
+    return os.path.join(settings.OPEN_WEATHER_RAW_ARCHIVE_DIR, digest)
+
+
+def segment_compression(path):
+    for name, (_, _, extension) in COMPRESSIONS.items():
+        if path.endswith(f".{extension}"):
+            return name
+    return None
+
+
+def job_segments(job_id):
+    """
+    Returns the paths of the segments of a job, oldest first.
+    """
+    directory = job_directory(job_id)
+    if not os.path.isdir(directory):
+        return []
+    return [
+        os.path.join(directory, name)
+        for name in sorted(os.listdir(directory))
+        if segment_compression(name)
+    ]
+
+
+def read_segment(path):
+    """
+    Yields the responses of a segment. A segment cut short while a flush
+    was written yields the responses flushed before it.
+    """
+    lines = COMPRESSIONS[segment_compression(path)][1]
+    with open(path, "rb") as f:
+        for line in lines(f):
+            yield fastjson.loads(line)
+
+
+class RawArchive:
+    """
+    Buffers the raw responses of a job pass and appends them to its segments
+    every OPEN_WEATHER_BATCH_SIZE responses, writing in the background from
+    the archive's own thread. Does nothing unless OPEN_WEATHER_RAW_ARCHIVE
+    names a compression.
+
+    Adding only waits when OPEN_WEATHER_WRITE_BUFFER_MAX responses are not
+    written yet, i.e. when the disk cannot keep up. Use it as an async
+    context manager: leaving it writes what is left and waits for it.
+    Failed writes are logged and dropped rather than failing the job, as
+    its readings are still stored.
+    """
+
+    def __init__(
+        self,
+        job_id,
+        compression=None,
+        segment_size=None,
+        batch_size=None,
+        max_pending=None,
+    ):
+        if compression is None:
+            compression = settings.OPEN_WEATHER_RAW_ARCHIVE
+        self.job_id = job_id
+        self.enabled = bool(compression)
+        if self.enabled:
+            self.compress, _, self.extension = get_compression(compression)
+        self.segment_size = (
+            segment_size or settings.OPEN_WEATHER_RAW_ARCHIVE_SEGMENT_SIZE
+        )
+        self.batch_size = batch_size or settings.OPEN_WEATHER_BATCH_SIZE
+        self.max_pending = max_pending or settings.OPEN_WEATHER_WRITE_BUFFER_MAX
+        self.lines = []
+        # (write task, number of responses) of the flushes not written yet
+        self.writes = deque()
+        self.unwritten = 0
+        self.path = None
+        self.written = 0
+        self.segments = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.flush()
+
+    async def add(self, response):
+        if not self.enabled or response is None:
+            return
+        self.lines.append(fastjson.dumps(response))
+        if len(self.lines) >= self.batch_size:
+            self.flush_behind()
+        while self.unwritten >= self.max_pending:
+            await self.wait_oldest()
+
+    def flush_behind(self):
+        """
+        Starts writing the buffered responses without waiting for them.
+        """
+        lines, self.lines = self.lines, []
+        if not lines:
+            return
+        write = sync_to_async(
+            self.write_logged, thread_sensitive=False, executor=executor
+        )
+        self.writes.append((asyncio.ensure_future(write(lines)), len(lines)))
+        self.unwritten += len(lines)
+
+    async def wait_oldest(self):
+        task, count = self.writes[0]
+        try:
+            await task
+        finally:
+            if self.writes and self.writes[0][0] is task:
+                self.writes.popleft()
+                self.unwritten -= count
+
+    async def flush(self):
+        """
+        Writes the buffered responses and waits for every write started.
+        """
+        self.flush_behind()
+        while self.writes:
+            await self.wait_oldest()
+
+    def write_logged(self, lines):
+        try:
+            self.write(lines)
+        except OSError:
+            logger.exception(
+                "Could not archive %d responses of job %s", len(lines), self.job_id
+            )
+
+    def new_segment(self):
+        directory = job_directory(self.job_id)
+        os.makedirs(directory, exist_ok=True)
+        # Named by creation time so segments list in the order they were written
+        name = f"{time.time_ns():020d}-{os.getpid()}-{self.segments}.{self.extension}"
+        self.segments += 1
+        return os.path.join(directory, name)
+
+    def write(self, lines):
+        while lines:
+            if self.path is None or self.written >= self.segment_size:
+                self.path = self.new_segment()
+                self.written = 0
+            count = self.segment_size - self.written
+            block, lines = lines[:count], lines[count:]
+            data = self.compress(("\n".join(block) + "\n").encode())
+            with open(self.path, "ab") as f:
+                f.write(data)
+            self.written += len(block)
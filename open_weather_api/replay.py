@@ -0,0 +1,167 @@
+"""
+Derives the readings of a job again from its archived raw responses (see
+rawarchive), with the job's payload schema or another payload builder, so
+backfills and new fields cost no upstream calls.
+
+Segments are decoded and built in worker processes and come back newest
+first, one segment at a time, so memory is bounded by
+OPEN_WEATHER_RAW_ARCHIVE_SEGMENT_SIZE and the set of cities seen, whatever
+the size of the job. A city archived more than once (by a retried or resumed
+pass) is replayed from its last response only.
+"""
+
+import multiprocessing
+
+import django
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils.module_loading import import_string
+from more_itertools import chunked
+
+from . import fastjson
+from .jobs import READING_COLUMNS, observed_at, reading_row, save_readings
+from .models import CityReading, WeatherData
+from .rawarchive import job_segments, read_segment
+from .schema import PayloadSchema
+
+
+class ReplayError(ValueError):
+    pass
+
+
+def load_builder(path):
+    try:
+        return import_string(path)
+    except ImportError as exc:
+        raise ReplayError(f"Unknown payload builder {path!r}: {exc}")
+
+
+def replay_segment(task):
+    """
+    Returns the cities of a segment and the payloads built from their
+    responses, with their observation time, the last response of each city
+    winning. Without a `builder`, the segment is built at once with the
+    schema of the job.
+    """
+    path, builder, default, fields, units = task
+    responses = list({response["id"]: response for response in read_segment(path)}.values())
+    if builder is None:
+        payloads = PayloadSchema(fields, units).build(responses)
+    else:
+        build = load_builder(builder)
+        payloads = [build(response) for response in responses]
+    for payload, response in zip(payloads, responses):
+        payload["observed_at"] = observed_at(response, default)
+    return [response["id"] for response in responses], payloads
+
+
+def replay_payloads(job, builder=None, processes=1):
+    """
+    Yields a list of payloads per archived segment of the job, newest
+    segment first, built in up to `processes` processes. Each city is
+    yielded once, from its last archived response.
+    """
+    seen = set()
+    for cities, payloads in replay_segments(job, builder, processes):
+        yield [
+            payload
+            for city_id, payload in zip(cities, payloads)
+            if city_id not in seen
+        ]
+        seen.update(cities)
+
+
+def replay_segments(job, builder=None, processes=1):
+    if builder is not None:
+        load_builder(builder)
+    tasks = [
+        (path, builder, job.request_datetime, job.payload_fields, job.units)
+        for path in reversed(job_segments(job.pk))
+    ]
+    if processes <= 1 or len(tasks) <= 1:
+        yield from map(replay_segment, tasks)
+        return
+    # Forked workers must not inherit the connections of this process
+    connections.close_all()
+    with multiprocessing.Pool(min(processes, len(tasks)), django.setup) as pool:
+        yield from pool.imap(replay_segment, tasks)
+
+
+def replay_chunks(job, builder=None, processes=1):
+    """
+    Yields the replayed payloads of the job as NDJSON, a chunk per segment.
+    """
+    for payloads in replay_payloads(job, builder, processes):
+        yield "".join(
+            fastjson.dumps(
+                {
+                    "user_defined_id": job.pk,
+                    **payload,
+                    "observed_at": payload["observed_at"].isoformat(),
+                }
+            )
+            + "\n"
+            for payload in payloads
+        ).encode()
+
+
+def rebuild_readings(job, payloads):
+    """
+    Replaces the stored readings of the cities of `payloads` with them, and
+    returns the payloads of the cities the job has no reading of.
+
+    The rollups keep the values the readings were first stored with: they
+    only hold sums and extremes, which cannot be taken back.
+    """
+    stored = dict(
+        job.readings.filter(
+            city_id__in={payload["city_id"] for payload in payloads}
+        ).values_list("city_id", "pk")
+    )
+    rows, missing = [], []
+    for payload in payloads:
+        if payload["city_id"] not in stored:
+            missing.append(payload)
+            continue
+        row = reading_row(job, payload)
+        row.pk = stored[payload["city_id"]]
+        rows.append(row)
+    CityReading.objects.bulk_update(rows, [*READING_COLUMNS, "extra"])
+    return missing
+
+
+def restore_readings(job, builder=None, processes=1, rebuild=False):
+    """
+    Stores the replayed readings of the cities the job has no reading for,
+    with their rollups, as a worker would have, and returns how many were
+    restored. Readings already stored are kept as they are, unless
+    `rebuild` replaces them with the replayed ones (see rebuild_readings).
+    """
+    if job.archive:
+        raise ReplayError(
+            f"Job {job.pk} is compacted, its readings can only be replayed to a file"
+        )
+    stored = set(job.readings.values_list("city_id", flat=True))
+    restored = 0
+    for payloads in replay_payloads(job, builder, processes):
+        if not rebuild:
+            payloads = [
+                payload for payload in payloads if payload["city_id"] not in stored
+            ]
+        absent = set(READING_COLUMNS) - set(payloads[0]) if payloads else ()
+        if absent:
+            raise ReplayError(
+                f"{builder} builds no {', '.join(sorted(absent))}, "
+                "replay it to a file instead"
+            )
+        for batch in chunked(payloads, settings.OPEN_WEATHER_BATCH_SIZE):
+            with transaction.atomic():
+                missing = rebuild_readings(job, batch) if rebuild else batch
+                if missing:
+                    save_readings(job, missing)
+            stored.update(payload["city_id"] for payload in batch)
+            restored += len(batch)
+    if restored:
+        # Readings deleted by hand were counted when they were first stored
+        WeatherData.objects.filter(pk=job.pk).update(done_cities=job.readings.count())
+    return restored
@@ -0,0 +1,159 @@
+"""
+Hourly and daily min/max/avg of the readings of every city, kept up to date
+as readings are stored so dashboards never scan raw readings.
+
+Each stored batch is aggregated with NumPy into one row per city and
+period, then merged into the CityRollup rows it falls into. Rollups keep
+sums and counts rather than averages so batches merge exactly.
+"""
+
+import datetime as dt
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Q
+
+from .models import CityRollup
+
+MERGED_FIELDS = (
+    "count",
+    "temperature_min",
+    "temperature_max",
+    "temperature_sum",
+    "humidity_min",
+    "humidity_max",
+    "humidity_sum",
+)
+
+
+def rollup_periods():
+    """
+    Returns the periods configured in OPEN_WEATHER_ROLLUP_PERIODS.
+    """
+    return [
+        period
+        for period in settings.OPEN_WEATHER_ROLLUP_PERIODS.split(",")
+        if period in CityRollup.PERIOD_SECONDS
+    ]
+
+
+def aggregate(readings, seconds):
+    """
+    Groups readings by city and by the `seconds` long bucket they were
+    observed in, and returns a dict of arrays with one entry per group:
+    city_id, start (epoch seconds) and the MERGED_FIELDS.
+    """
+    size = len(readings)
+    city_id = np.fromiter((r["city_id"] for r in readings), np.int64, size)
+    start = np.fromiter(
+        (r["observed_at"].timestamp() for r in readings), np.float64, size
+    )
+    start = (start // seconds).astype(np.int64) * seconds
+    temperature = np.fromiter((r["temperature"] for r in readings), np.float64, size)
+    humidity = np.fromiter((r["humidity"] for r in readings), np.int64, size)
+
+    order = np.lexsort((start, city_id))
+    city_id, start = city_id[order], start[order]
+    temperature, humidity = temperature[order], humidity[order]
+    # Index of the first reading of every (city, bucket) group
+    first = np.flatnonzero(
+        np.concatenate(
+            ([True], (np.diff(city_id) != 0) | (np.diff(start) != 0))
+        )
+    )
+    return {
+        "city_id": city_id[first],
+        "start": start[first],
+        "count": np.diff(np.append(first, size)),
+        "temperature_min": np.minimum.reduceat(temperature, first),
+        "temperature_max": np.maximum.reduceat(temperature, first),
+        "temperature_sum": np.add.reduceat(temperature, first),
+        "humidity_min": np.minimum.reduceat(humidity, first),
+        "humidity_max": np.maximum.reduceat(humidity, first),
+        "humidity_sum": np.add.reduceat(humidity, first),
+    }
+
+
+def merge(row, group):
+    row.count += group["count"]
+    row.temperature_min = min(row.temperature_min, group["temperature_min"])
+    row.temperature_max = max(row.temperature_max, group["temperature_max"])
+    row.temperature_sum += group["temperature_sum"]
+    row.humidity_min = min(row.humidity_min, group["humidity_min"])
+    row.humidity_max = max(row.humidity_max, group["humidity_max"])
+    row.humidity_sum += group["humidity_sum"]
+
+
+def update_rollups(readings):
+    """
+    Adds a batch of readings (dicts with city_id, temperature, humidity and
+    observed_at) to the rollups of every configured period.
+
+    Meant to run in the transaction storing the readings: the rows touched
+    are locked while they are merged, and written back with one upsert per
+    period.
+    """
+    if not readings:
+        return
+    for period in rollup_periods():
+        groups = aggregate(readings, CityRollup.PERIOD_SECONDS[period])
+        groups = [
+            dict(zip(groups, values))
+            for values in zip(*(array.tolist() for array in groups.values()))
+        ]
+        for group in groups:
+            group["start"] = dt.datetime.fromtimestamp(group["start"], tz=dt.timezone.utc)
+        existing = {
+            (row.city_id, row.start): row
+            for row in CityRollup.objects.select_for_update().filter(
+                period=period,
+                city_id__in={group["city_id"] for group in groups},
+                start__in={group["start"] for group in groups},
+            )
+        }
+        rows = []
+        for group in groups:
+            row = existing.get((group["city_id"], group["start"]))
+            if row is None:
+                row = CityRollup(period=period, **group)
+            else:
+                merge(row, group)
+            rows.append(row)
+        CityRollup.objects.bulk_create(
+            rows,
+            update_conflicts=True,
+            unique_fields=["period", "city_id", "start"],
+            update_fields=list(MERGED_FIELDS),
+        )
+
+
+def rollup_after(cursor):
+    """
+    Returns the filter of the rollups that come after `cursor`, a
+    "city_id:start" pair in epoch seconds, in (city_id, start) order.
+    """
+    city_id, start = (int(part) for part in cursor.split(":"))
+    start = dt.datetime.fromtimestamp(start, tz=dt.timezone.utc)
+    return Q(city_id__gt=city_id) | Q(city_id=city_id, start__gt=start)
+
+
+def rollup_cursor(row):
+    return f"{row.city_id}:{int(row.start.timestamp())}"
+
+
+def serialize_rollup(row):
+    return {
+        "city_id": row.city_id,
+        "start": row.start.isoformat(),
+        "count": row.count,
+        "temperature": {
+            "min": row.temperature_min,
+            "max": row.temperature_max,
+            "avg": round(row.temperature_sum / row.count, 2),
+        },
+        "humidity": {
+            "min": row.humidity_min,
+            "max": row.humidity_max,
+            "avg": round(row.humidity_sum / row.count, 2),
+        },
+    }
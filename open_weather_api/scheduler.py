@@ -0,0 +1,66 @@
+"""
+Recurring collections: every CollectionSchedule enqueues a job for its city
+set each `interval` seconds, picked up by the `collect_worker` processes
+like any other job.
+"""
+
+import datetime as dt
+import logging
+import math
+
+from django.db import transaction
+from django.utils import timezone
+
+from .cities import city_set_ids
+from .jobs import enqueue_job
+from .models import CollectionSchedule
+
+logger = logging.getLogger(__name__)
+
+
+def next_run(schedule, now):
+    """
+    Returns the first run of the schedule after `now`. Runs missed while no
+    scheduler was up are skipped rather than caught up.
+    """
+    interval = dt.timedelta(seconds=schedule.interval)
+    missed = math.floor((now - schedule.next_run_at) / interval)
+    return schedule.next_run_at + (missed + 1) * interval
+
+
+def schedule_job_id(schedule):
+    return f"{schedule.name}-{schedule.next_run_at:%Y%m%dT%H%M%S}"
+
+
+def run_due_schedules(now=None):
+    """
+    Enqueues a job for every enabled schedule that is due and returns them.
+
+    Each run is claimed by moving `next_run_at` forward with a conditional
+    update, so several schedulers never enqueue the same run twice.
+    """
+    now = now or timezone.now()
+    jobs = []
+    due = CollectionSchedule.objects.filter(enabled=True, next_run_at__lte=now)
+    for schedule in due:
+        with transaction.atomic():
+            claimed = CollectionSchedule.objects.filter(
+                pk=schedule.pk, next_run_at=schedule.next_run_at
+            ).update(next_run_at=next_run(schedule, now))
+            if not claimed:
+                continue
+            cities_ids = city_set_ids(schedule.city_set_id)
+            if not cities_ids:
+                logger.warning(
+                    "Schedule %s skipped: city set %s is empty",
+                    schedule.name,
+                    schedule.city_set_id,
+                )
+                continue
+            job = enqueue_job(schedule_job_id(schedule), cities_ids)
+            CollectionSchedule.objects.filter(pk=schedule.pk).update(
+                last_job=job.user_defined_id
+            )
+        logger.info("Schedule %s enqueued job %s", schedule.name, job.pk)
+        jobs.append(job)
+    return jobs
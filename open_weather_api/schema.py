@@ -0,0 +1,218 @@
+"""
+Payload schemas: which OpenWeather fields a job stores next to the
+temperature and humidity of every city, and in which units.
+
+Responses are projected to the fields of FIELDS as they arrive, so cached
+and shared responses serve jobs of any schema. Each job then builds its
+payloads a city at a time, with the accessors and conversions of its schema
+resolved once. Upstream is always asked for its standard units (Kelvin and m/s), so
+responses stay interchangeable between jobs.
+"""
+
+from collections import namedtuple
+
+Field = namedtuple("Field", ["path", "quantity"])
+
+# Payload field: its path in a response and the quantity its units follow
+FIELDS = {
+    "temperature": Field(("main", "temp"), "temperature"),
+    "humidity": Field(("main", "humidity"), None),
+    "feels_like": Field(("main", "feels_like"), "temperature"),
+    "temp_min": Field(("main", "temp_min"), "temperature"),
+    "temp_max": Field(("main", "temp_max"), "temperature"),
+    "pressure": Field(("main", "pressure"), None),
+    "wind_speed": Field(("wind", "speed"), "speed"),
+    "wind_deg": Field(("wind", "deg"), None),
+    "wind_gust": Field(("wind", "gust"), "speed"),
+    "clouds": Field(("clouds", "all"), None),
+    "visibility": Field(("visibility",), None),
+    "rain_1h": Field(("rain", "1h"), None),
+    "snow_1h": Field(("snow", "1h"), None),
+    "lat": Field(("coord", "lat"), None),
+    "lon": Field(("coord", "lon"), None),
+}
+# Stored by every job: rollups, results filters and compaction rely on them
+CORE_FIELDS = ("temperature", "humidity")
+
+
+def kelvin_to_celsius(kelvin):
+    return kelvin - 273.15
+
+
+def kelvin_to_fahrenheit(kelvin):
+    return (kelvin - 273.15) * 1.8 + 32
+
+
+def fahrenheit_to_celsius(fahrenheit):
+    return (fahrenheit - 32) / 1.8
+
+
+def celsius_to_celsius(celsius):
+    return celsius
+
+
+def mps_to_mph(speed):
+    return speed * 2.2369362920544
+
+
+# Units: conversions from the standard units by quantity, and back from the
+# temperature unit to Celsius, which rollups keep whatever the job's units
+UNITS = {
+    "standard": ({}, kelvin_to_celsius),
+    "metric": ({"temperature": kelvin_to_celsius}, celsius_to_celsius),
+    "imperial": (
+        {"temperature": kelvin_to_fahrenheit, "speed": mps_to_mph},
+        fahrenheit_to_celsius,
+    ),
+}
+DEFAULT_UNITS = "metric"
+
+
+class SchemaError(ValueError):
+    pass
+
+
+def lookup(response, path, required=False):
+    """
+    Returns the value at `path` in a response, None if it has none. Raises
+    KeyError instead if the value is `required`.
+    """
+    if required:
+        for key in path:
+            response = response[key]
+        return response
+    for key in path:
+        if not isinstance(response, dict) or key not in response:
+            return None
+        response = response[key]
+    return response
+
+
+def accessor(path, required=False):
+    """
+    Returns a function of a response doing `lookup` of `path`, unrolled for
+    the paths of FIELDS as it runs for every field of every city.
+    """
+    if len(path) == 1:
+        (key,) = path
+        if required:
+            return lambda response: response[key]
+        return lambda response: response.get(key)
+    if len(path) == 2:
+        parent, key = path
+        if required:
+            return lambda response: response[parent][key]
+        return lambda response: (response.get(parent) or {}).get(key)
+    return lambda response: lookup(response, path, required)
+
+
+def require(response):
+    """
+    Raises KeyError if a response lacks the temperature or humidity.
+    """
+    for name in CORE_FIELDS:
+        lookup(response, FIELDS[name].path, required=True)
+
+
+def project(response):
+    """
+    Keeps only the fields of an OpenWeather response that payloads are built
+    from, so results in flight and cached observations don't carry the rest
+    of it. Raises KeyError if the temperature or humidity is missing.
+    """
+    main = response["main"]
+    projected = {
+        "id": response["id"],
+        "main": {"temp": main["temp"], "humidity": main["humidity"]},
+    }
+    if "dt" in response:
+        projected["dt"] = response["dt"]
+    for name, field in FIELDS.items():
+        value = lookup(response, field.path)
+        if value is None or name in CORE_FIELDS:
+            continue
+        parent = projected
+        for key in field.path[:-1]:
+            parent = parent.setdefault(key, {})
+        parent[field.path[-1]] = value
+    return projected
+
+
+def convert(values, conversion):
+    """
+    Converts a column of values, None where a response lacks the field, and
+    rounds them to two decimals.
+    """
+    return [None if value is None else round(conversion(value), 2) for value in values]
+
+
+class PayloadSchema:
+    """
+    The fields a job stores on top of CORE_FIELDS and their units. Raises
+    SchemaError, with a message for the client, for unknown ones.
+    """
+
+    def __init__(self, fields=(), units=None):
+        fields = fields or ()
+        if not isinstance(fields, (list, tuple)) or not all(
+            isinstance(field, str) for field in fields
+        ):
+            raise SchemaError("fields must be a list of field names")
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise SchemaError(
+                f"Unknown fields {', '.join(sorted(unknown))}, "
+                f"expected some of {', '.join(FIELDS)}"
+            )
+        units = units or DEFAULT_UNITS
+        if units not in UNITS:
+            raise SchemaError(
+                f"Unknown units {units!r}, expected one of {', '.join(UNITS)}"
+            )
+        self.fields = [field for field in dict.fromkeys(fields) if field not in CORE_FIELDS]
+        self.units = units
+        conversions = UNITS[units][0]
+        # (name, accessor, conversion or None) of every field a payload has
+        self.columns = [
+            (
+                name,
+                accessor(FIELDS[name].path, name in CORE_FIELDS),
+                conversions.get(FIELDS[name].quantity),
+            )
+            for name in (*CORE_FIELDS, *self.fields)
+        ]
+
+    @classmethod
+    def for_job(cls, job):
+        return cls(job.payload_fields, job.units)
+
+    def build(self, responses):
+        """
+        Returns the payloads of a batch of responses: the city ID, the core
+        fields and the schema's fields, in the schema's units. Raises
+        KeyError if a response lacks a core field.
+        """
+        payloads = []
+        for response in responses:
+            payload = {"city_id": response["id"]}
+            for name, get, conversion in self.columns:
+                value = get(response)
+                if conversion is not None and value is not None:
+                    value = round(conversion(value), 2)
+                payload[name] = value
+            payloads.append(payload)
+        return payloads
+
+    def celsius(self, readings):
+        """
+        Returns the readings with their temperature in Celsius, as rollups
+        aggregate readings of every job together.
+        """
+        to_celsius = UNITS[self.units][1]
+        if to_celsius is celsius_to_celsius:
+            return readings
+        temperatures = convert([reading["temperature"] for reading in readings], to_celsius)
+        return [
+            dict(reading, temperature=temperature)
+            for reading, temperature in zip(readings, temperatures)
+        ]
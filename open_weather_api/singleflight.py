@@ -0,0 +1,223 @@
+"""
+Single-flight coalescing of upstream calls: when several jobs need the same
+city at the same time, one of them (the leader) fetches it and the others
+wait for its result, so upstream calls scale with unique cities rather than
+jobs x cities. Every job still stores its own reading.
+
+OPEN_WEATHER_SINGLE_FLIGHT is "local" to coalesce the jobs of a worker's
+event loop, "shared" to also coalesce across workers through leases in the
+Django cache and results in a shared observation cache, or empty to turn
+coalescing off.
+"""
+
+import asyncio
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+
+from . import metrics
+from .collector import CityResult, cached_result
+
+_flights = weakref.WeakKeyDictionary()
+
+COALESCED = metrics.Counter(
+    "open_weather_coalesced_cities_total",
+    "Cities served by another job's upstream call instead of a new one.",
+    ["scope"],
+)
+
+
+class FetchAbandoned(Exception):
+    """
+    The job fetching a city for others stopped before it got a result.
+    """
+
+
+class SingleFlight:
+    """
+    The cities being fetched by the jobs of one event loop, each with the
+    future its followers wait on.
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    def claim(self, cities_ids):
+        """
+        Splits `cities_ids` into the cities the caller now leads, and a dict
+        of the futures of cities another job is already fetching.
+        """
+        loop = asyncio.get_running_loop()
+        leading = []
+        following = {}
+        for city_id in cities_ids:
+            future = self.calls.get(city_id)
+            if future is None:
+                self.calls[city_id] = loop.create_future()
+                leading.append(city_id)
+            else:
+                following[city_id] = future
+        return leading, following
+
+    def resolve(self, result):
+        future = self.calls.pop(result.city_id, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def abandon(self, cities_ids):
+        """
+        Fails the cities the caller led but never resolved, so their
+        followers retry them instead of waiting forever.
+        """
+        for city_id in cities_ids:
+            if city_id in self.calls:
+                self.resolve(CityResult(city_id, None, FetchAbandoned()))
+
+    async def follow(self, following):
+        """
+        Yields the results of the followed cities as their leaders get them.
+        """
+        if following:
+            COALESCED.inc(len(following), "local")
+        for future in asyncio.as_completed(list(following.values())):
+            yield await future
+
+
+class SharedLeases:
+    """
+    Cross-process leases on the cities being fetched, as keys added to the
+    Django cache OPEN_WEATHER_CACHE_ALIAS. Followers poll the shared
+    observation cache for the leader's result while its lease lasts.
+    """
+
+    key = "open_weather:inflight:{}"
+
+    def __init__(self, observation_cache, alias=None, lease=None, poll_interval=None):
+        self.observation_cache = observation_cache
+        self.cache = caches[alias or settings.OPEN_WEATHER_CACHE_ALIAS]
+        self.lease = lease or settings.OPEN_WEATHER_SINGLE_FLIGHT_LEASE
+        self.poll_interval = (
+            poll_interval or settings.OPEN_WEATHER_SINGLE_FLIGHT_POLL_INTERVAL
+        )
+
+    def claim(self, cities_ids):
+        """
+        Returns the cities whose lease the caller got, and those leased by
+        another process.
+        """
+        leading = []
+        following = []
+        for city_id in cities_ids:
+            if self.cache.add(self.key.format(city_id), 1, timeout=self.lease):
+                leading.append(city_id)
+            else:
+                following.append(city_id)
+        return leading, following
+
+    def release(self, cities_ids):
+        self.cache.delete_many([self.key.format(city_id) for city_id in cities_ids])
+
+    def leased(self, cities_ids):
+        keys = {self.key.format(city_id): city_id for city_id in cities_ids}
+        return {keys[key] for key in self.cache.get_many(list(keys))}
+
+    async def follow(self, cities_ids):
+        """
+        Yields the results of cities leased by other processes as they reach
+        the observation cache. Cities whose lease ends without a result
+        failed for the leader, and fail here too so a later pass retries
+        them.
+        """
+        if cities_ids:
+            COALESCED.inc(len(cities_ids), "shared")
+        pending = set(cities_ids)
+        deadline = time.monotonic() + self.lease
+        while pending:
+            await asyncio.sleep(self.poll_interval)
+            found = await sync_to_async(self.observation_cache.lookup)(list(pending))
+            for city_id, response in found.items():
+                pending.discard(city_id)
+                yield cached_result(city_id, response)
+            if not pending:
+                return
+            leased = await sync_to_async(self.leased)(pending)
+            for city_id in list(pending):
+                if city_id not in leased or time.monotonic() > deadline:
+                    pending.discard(city_id)
+                    yield CityResult(city_id, None, FetchAbandoned())
+
+
+def get_single_flight():
+    """
+    Returns the single-flight registry of the running event loop, or None
+    when coalescing is off.
+    """
+    if settings.OPEN_WEATHER_SINGLE_FLIGHT not in ("local", "shared"):
+        if settings.OPEN_WEATHER_SINGLE_FLIGHT:
+            raise ImproperlyConfigured(
+                f"Unknown OPEN_WEATHER_SINGLE_FLIGHT "
+                f"{settings.OPEN_WEATHER_SINGLE_FLIGHT!r}, expected local, shared "
+                f"or an empty value"
+            )
+        return None
+    loop = asyncio.get_running_loop()
+    flight = _flights.get(loop)
+    if flight is None:
+        flight = _flights[loop] = SingleFlight()
+    return flight
+
+
+def get_shared_leases(observation_cache):
+    """
+    Returns the cross-process leases when OPEN_WEATHER_SINGLE_FLIGHT is
+    "shared", which needs an observation cache shared by the workers.
+    """
+    if settings.OPEN_WEATHER_SINGLE_FLIGHT != "shared":
+        return None
+    from .cache import LocalObservationCache
+
+    if observation_cache is None or isinstance(
+        observation_cache, LocalObservationCache
+    ):
+        raise ImproperlyConfigured(
+            "OPEN_WEATHER_SINGLE_FLIGHT=shared needs a shared observation cache "
+            "(DjangoObservationCache or DatabaseObservationCache)"
+        )
+    return SharedLeases(observation_cache)
+
+
+async def merge(*streams):
+    """
+    Yields the items of several async iterators as each one produces them.
+    """
+    queue = asyncio.Queue()
+    finished = object()
+
+    async def pump(stream):
+        try:
+            async for item in stream:
+                await queue.put((item, None))
+        except Exception as exc:
+            await queue.put((None, exc))
+        finally:
+            await queue.put((finished, None))
+
+    tasks = [asyncio.ensure_future(pump(stream)) for stream in streams]
+    running = len(tasks)
+    try:
+        while running:
+            item, error = await queue.get()
+            if error is not None:
+                raise error
+            if item is finished:
+                running -= 1
+                continue
+            yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
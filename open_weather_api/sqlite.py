@@ -0,0 +1,38 @@
+"""
+Pragmas applied to every new SQLite connection, so the processes sharing
+the database file can write concurrently.
+"""
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+JOURNAL_MODES = ("delete", "truncate", "persist", "memory", "wal", "off")
+SYNCHRONOUS = ("off", "normal", "full", "extra")
+
+
+def sqlite_pragmas():
+    """
+    Returns the pragma statements configured by OPEN_WEATHER_SQLITE_*.
+    """
+    pragmas = []
+    for name, setting, allowed in (
+        ("journal_mode", "OPEN_WEATHER_SQLITE_JOURNAL_MODE", JOURNAL_MODES),
+        ("synchronous", "OPEN_WEATHER_SQLITE_SYNCHRONOUS", SYNCHRONOUS),
+    ):
+        value = getattr(settings, setting).lower()
+        if not value:
+            continue
+        if value not in allowed:
+            raise ImproperlyConfigured(
+                f"Unknown {setting} {value!r}, expected one of {', '.join(allowed)}"
+            )
+        pragmas.append(f"PRAGMA {name}={value}")
+    return pragmas
+
+
+def configure_connection(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for pragma in sqlite_pragmas():
+            cursor.execute(pragma)
@@ -1,5 +1,7 @@
 from drf_yasg import openapi
 
+from .schema import FIELDS
+
 
 def post_request():
     return openapi.Schema(
@@ -8,12 +10,98 @@ def post_request():
             "user_defined_id": openapi.Schema(
                 type=openapi.TYPE_STRING, description="ID defined by the user."
             ),
+            "cities_ids": openapi.Schema(
+                type=openapi.TYPE_ARRAY,
+                items=openapi.Schema(type=openapi.TYPE_INTEGER),
+                description="OpenWeather IDs of the cities to collect.",
+            ),
+            "city_set": openapi.Schema(
+                type=openapi.TYPE_STRING,
+                description="Name of a city set loaded with `load_cities --set`.",
+            ),
+            "filter": openapi.Schema(
+                type=openapi.TYPE_OBJECT,
+                properties={
+                    "country": openapi.Schema(
+                        type=openapi.TYPE_STRING, description="ISO country code."
+                    ),
+                    "name": openapi.Schema(
+                        type=openapi.TYPE_STRING, description="Prefix of the city name."
+                    ),
+                    "bbox": openapi.Schema(
+                        type=openapi.TYPE_ARRAY,
+                        items=openapi.Schema(type=openapi.TYPE_NUMBER),
+                        description="[min_lon, min_lat, max_lon, max_lat]",
+                    ),
+                },
+                description="Selects the registered cities matching every given criterion.",
+            ),
+            "fields": openapi.Schema(
+                type=openapi.TYPE_ARRAY,
+                items=openapi.Schema(type=openapi.TYPE_STRING),
+                description=(
+                    "OpenWeather fields stored on top of the temperature and "
+                    f"humidity, from {', '.join(FIELDS)}."
+                ),
+            ),
+            "units": openapi.Schema(
+                type=openapi.TYPE_STRING,
+                description="Units of the readings: standard, metric (default) or imperial.",
+            ),
         },
+        description=(
+            "At most one of cities_ids, city_set or filter; the default city "
+            "set is collected when none is given."
+        ),
         required=["user_defined_id"],
     )
 
 
 def post_response():
+    return openapi.Schema(
+        type=openapi.TYPE_OBJECT,
+        properties={
+            "user_defined_id": openapi.Schema(
+                type=openapi.TYPE_STRING, description="ID defined by the user."
+            ),
+            "status": openapi.Schema(
+                type=openapi.TYPE_STRING, description="State of the queued job."
+            ),
+            "total": openapi.Schema(
+                type=openapi.TYPE_INTEGER, description="Number of cities in the job."
+            ),
+            "progress_url": openapi.Schema(
+                type=openapi.TYPE_STRING, description="Where to poll the job progress."
+            ),
+            "stream_url": openapi.Schema(
+                type=openapi.TYPE_STRING,
+                description="Where to stream the readings as they are collected.",
+            ),
+            "results_url": openapi.Schema(
+                type=openapi.TYPE_STRING,
+                description="Where to page through the collected readings.",
+            ),
+        },
+        required=["user_defined_id", "status", "progress_url", "stream_url"],
+    )
+
+
+def stream_mode_parameter():
+    return openapi.Parameter(
+        "mode",
+        openapi.IN_QUERY,
+        type=openapi.TYPE_STRING,
+        enum=["sse", "ndjson", "legacy"],
+        description=(
+            "sse: one server-sent event per city plus progress and heartbeat "
+            "events; ndjson: the same events as JSON lines; legacy: the whole "
+            "job as the single JSON document below. Defaults to the Accept "
+            "header, then sse."
+        ),
+    )
+
+
+def stream_response():
     return openapi.Schema(
         type=openapi.TYPE_OBJECT,
         properties={
@@ -62,6 +150,257 @@ def get_response():
                 type=openapi.TYPE_STRING,
                 description="Progress percentage for the specified user-defined ID.",
             ),
+            "state": openapi.Schema(
+                type=openapi.TYPE_STRING,
+                description="Job state: queued, running, done or failed.",
+            ),
+            "total": openapi.Schema(
+                type=openapi.TYPE_INTEGER, description="Number of cities in the job."
+            ),
+            "done": openapi.Schema(
+                type=openapi.TYPE_INTEGER, description="Number of cities collected."
+            ),
+            "failed": openapi.Schema(
+                type=openapi.TYPE_INTEGER,
+                description=(
+                    "Number of cities whose upstream call failed after every "
+                    "retry, i.e. dropped unless the job is resumed."
+                ),
+            ),
+            "cache_hits": openapi.Schema(
+                type=openapi.TYPE_INTEGER,
+                description="Number of cities served from the observation cache.",
+            ),
+            "cache_misses": openapi.Schema(
+                type=openapi.TYPE_INTEGER,
+                description="Number of cities that had to be fetched upstream.",
+            ),
+            "retried_calls": openapi.Schema(
+                type=openapi.TYPE_INTEGER,
+                description="Upstream calls made again after a 429, 5xx or timeout.",
+            ),
+            "throttled_calls": openapi.Schema(
+                type=openapi.TYPE_INTEGER,
+                description="Upstream calls answered with 429 Too Many Requests.",
+            ),
+            "cities_per_second": openapi.Schema(
+                type=openapi.TYPE_NUMBER, description="Observed throughput of the job."
+            ),
+            "eta_seconds": openapi.Schema(
+                type=openapi.TYPE_NUMBER,
+                description="Estimated seconds until the job is finished.",
+            ),
         },
         required=["user_defined_id", "Status"],
     )
+
+
+def rate_limit_response():
+    return openapi.Schema(
+        type=openapi.TYPE_OBJECT,
+        properties={
+            "backend": openapi.Schema(
+                type=openapi.TYPE_STRING, description="Rate limiter in use."
+            ),
+            "shared": openapi.Schema(
+                type=openapi.TYPE_BOOLEAN,
+                description="Whether the quota is shared with the workers. If not, "
+                "the figures only describe this process.",
+            ),
+            "calls": openapi.Schema(
+                type=openapi.TYPE_INTEGER, description="Calls allowed per period."
+            ),
+            "period": openapi.Schema(
+                type=openapi.TYPE_NUMBER, description="Length of the period in seconds."
+            ),
+            "utilization": openapi.Schema(
+                type=openapi.TYPE_NUMBER,
+                description="0 when idle, 1 when the quota is fully used, above 1 "
+                "when calls are queued.",
+            ),
+            "running_jobs": openapi.Schema(
+                type=openapi.TYPE_INTEGER,
+                description="Jobs currently sharing the quota.",
+            ),
+        },
+    )
+
+
+def results_parameters():
+    def parameter(name, value_type, description):
+        return openapi.Parameter(
+            name, openapi.IN_QUERY, type=value_type, description=description
+        )
+
+    return [
+        parameter(
+            "fields",
+            openapi.TYPE_STRING,
+            "Comma separated fields to return among city_id, temperature, "
+            "humidity, observed_at and the fields the job was created with. "
+            "All of them by default.",
+        ),
+        parameter("city_id", openapi.TYPE_STRING, "Comma separated city IDs."),
+        parameter("temperature_min", openapi.TYPE_NUMBER, "Minimum temperature, in the job's units."),
+        parameter("temperature_max", openapi.TYPE_NUMBER, "Maximum temperature, in the job's units."),
+        parameter("humidity_min", openapi.TYPE_NUMBER, "Minimum humidity."),
+        parameter("humidity_max", openapi.TYPE_NUMBER, "Maximum humidity."),
+        parameter(
+            "cursor",
+            openapi.TYPE_INTEGER,
+            "Where the page starts, as given in the `next` link of the previous one.",
+        ),
+        parameter("limit", openapi.TYPE_INTEGER, "Readings per page."),
+    ]
+
+
+def results_response():
+    return openapi.Schema(
+        type=openapi.TYPE_OBJECT,
+        properties={
+            "user_defined_id": openapi.Schema(
+                type=openapi.TYPE_STRING, description="ID defined by the user."
+            ),
+            "status": openapi.Schema(
+                type=openapi.TYPE_STRING,
+                description="Job state: queued, running, done or failed.",
+            ),
+            "units": openapi.Schema(
+                type=openapi.TYPE_STRING,
+                description="Units of the readings: standard, metric or imperial.",
+            ),
+            "total": openapi.Schema(
+                type=openapi.TYPE_INTEGER, description="Number of cities in the job."
+            ),
+            "count": openapi.Schema(
+                type=openapi.TYPE_INTEGER, description="Number of readings in this page."
+            ),
+            "next": openapi.Schema(
+                type=openapi.TYPE_STRING,
+                description="Link to the next page, null on the last one.",
+            ),
+            "results": openapi.Schema(
+                type=openapi.TYPE_ARRAY,
+                items=openapi.Schema(
+                    type=openapi.TYPE_OBJECT,
+                    properties={
+                        "city_id": openapi.Schema(type=openapi.TYPE_INTEGER),
+                        "temperature": openapi.Schema(type=openapi.TYPE_NUMBER),
+                        "humidity": openapi.Schema(type=openapi.TYPE_NUMBER),
+                        "observed_at": openapi.Schema(
+                            type=openapi.TYPE_STRING, format=openapi.FORMAT_DATETIME
+                        ),
+                    },
+                ),
+                description="Readings with the requested fields.",
+            ),
+        },
+    )
+
+
+def export_parameters():
+    return [
+        openapi.Parameter(
+            "jobs",
+            openapi.IN_QUERY,
+            type=openapi.TYPE_STRING,
+            required=True,
+            description="Comma separated user defined IDs of the jobs to export.",
+        ),
+        openapi.Parameter(
+            "format",
+            openapi.IN_QUERY,
+            type=openapi.TYPE_STRING,
+            enum=["ndjson", "csv", "parquet", "arrow"],
+            description="File format, ndjson by default. Parquet and Arrow need pyarrow.",
+        ),
+        openapi.Parameter(
+            "compression",
+            openapi.IN_QUERY,
+            type=openapi.TYPE_STRING,
+            enum=["gzip", "zstd"],
+            description="Compresses the file. zstd needs the zstandard package.",
+        ),
+    ]
+
+
+def rollups_parameters():
+    def parameter(name, value_type, description, **kwargs):
+        return openapi.Parameter(
+            name, openapi.IN_QUERY, type=value_type, description=description, **kwargs
+        )
+
+    return [
+        parameter(
+            "period",
+            openapi.TYPE_STRING,
+            "Length of the rollups, hour by default.",
+            enum=["hour", "day"],
+        ),
+        parameter("city_id", openapi.TYPE_STRING, "Comma separated city IDs."),
+        parameter("city_set", openapi.TYPE_STRING, "Name of a city set."),
+        parameter(
+            "start",
+            openapi.TYPE_STRING,
+            "First period to return, as an ISO 8601 datetime (UTC if naive).",
+        ),
+        parameter(
+            "end",
+            openapi.TYPE_STRING,
+            "Periods starting at or after this ISO 8601 datetime are left out.",
+        ),
+        parameter(
+            "cursor",
+            openapi.TYPE_STRING,
+            "Where the page starts, as given in the `next` link of the previous one.",
+        ),
+        parameter("limit", openapi.TYPE_INTEGER, "Rollups per page."),
+    ]
+
+
+def rollups_response():
+    def summary(description):
+        return openapi.Schema(
+            type=openapi.TYPE_OBJECT,
+            properties={
+                "min": openapi.Schema(type=openapi.TYPE_NUMBER),
+                "max": openapi.Schema(type=openapi.TYPE_NUMBER),
+                "avg": openapi.Schema(type=openapi.TYPE_NUMBER),
+            },
+            description=description,
+        )
+
+    return openapi.Schema(
+        type=openapi.TYPE_OBJECT,
+        properties={
+            "period": openapi.Schema(
+                type=openapi.TYPE_STRING, description="hour or day."
+            ),
+            "count": openapi.Schema(
+                type=openapi.TYPE_INTEGER, description="Number of rollups in this page."
+            ),
+            "next": openapi.Schema(
+                type=openapi.TYPE_STRING,
+                description="Link to the next page, null on the last one.",
+            ),
+            "results": openapi.Schema(
+                type=openapi.TYPE_ARRAY,
+                items=openapi.Schema(
+                    type=openapi.TYPE_OBJECT,
+                    properties={
+                        "city_id": openapi.Schema(type=openapi.TYPE_INTEGER),
+                        "start": openapi.Schema(
+                            type=openapi.TYPE_STRING, format=openapi.FORMAT_DATETIME
+                        ),
+                        "count": openapi.Schema(
+                            type=openapi.TYPE_INTEGER,
+                            description="Readings in the period.",
+                        ),
+                        "temperature": summary("Temperature in Celsius."),
+                        "humidity": summary("Humidity in %."),
+                    },
+                ),
+                description="Rollups by city ID, then start.",
+            ),
+        },
+    )
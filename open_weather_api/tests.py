@@ -1,13 +1,124 @@
-from django.test import TestCase, RequestFactory
-from unittest.mock import patch, MagicMock
-from .views import WeatherDataView, ProgressView, kelvin_to_celsius
-from .models import WeatherData
+import asyncio
+import csv
+import datetime as dt
+import email.utils
+import gzip
+import importlib.util
 import json
+import os
+import pstats
+import tempfile
+import threading
+import unittest
+import warnings
+from io import BytesIO, StringIO
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import httpx
+from asgiref.sync import async_to_sync
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signals
+from django.core.exceptions import ImproperlyConfigured
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import close_old_connections, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import (
+    AsyncClient,
+    AsyncRequestFactory,
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
+from . import fastjson, metrics
+from .adaptive import (
+    AIMDConcurrency,
+    CircuitBreaker,
+    CircuitOpenError,
+    UpstreamControl,
+    retry_after,
+)
+from .cache import (
+    DatabaseObservationCache,
+    DjangoObservationCache,
+    LocalObservationCache,
+    build_cache,
+)
+from .cities import read_cities_file
+from .client import RequestTiming, TimingSummary, close_client
+from .collector import CityResult, collect, get_strategy, iter_collect
+from .compact import (
+    FIELDS_V1,
+    HEADER,
+    MAGIC,
+    FileArchive,
+    arrays_from_rows,
+    compact_job,
+    filter_arrays,
+    load_arrays,
+    open_archive,
+    pack,
+    purge_compacted_rows,
+    unpack,
+)
+from .export import ExportError, export_readings
+from .fake_upstream import FakeOpenWeatherServer, SlidingWindowQuota, parse_latency
+from .jobs import (
+    claim_next_job,
+    enqueue_job,
+    finish_job,
+    resume_job,
+    run_job,
+    save_readings,
+    save_responses,
+)
+from .models import (
+    CachedObservation,
+    City,
+    CityReading,
+    CityRollup,
+    CitySet,
+    CollectionSchedule,
+    RateLimitState,
+    ReadingArchive,
+    SpanSnapshot,
+    WeatherData,
+)
+from .profiling import ProfilingMiddleware, SpanRecorder, spans
+from .ratelimit import DatabaseRateLimiter, FairShare, FileRateLimiter, TokenBucket
+from .rawarchive import RawArchive, job_segments, read_segment
+from .replay import ReplayError, restore_readings
+from .rollups import aggregate
+from .scheduler import run_due_schedules
+from .schema import PayloadSchema, SchemaError, kelvin_to_celsius, project
+from .singleflight import (
+    FetchAbandoned,
+    SharedLeases,
+    SingleFlight,
+    get_shared_leases,
+    get_single_flight,
+)
+from .sqlite import sqlite_pragmas
+from .views import (
+    ExportView,
+    JobResumeView,
+    JobStreamView,
+    MetricsView,
+    ProgressView,
+    RateLimitView,
+    ResultsView,
+    RollupsView,
+    WeatherDataView,
+)
+from .writebehind import WriteBehind
 
-CITIES_IDS = settings.CITIES_IDS
+CITIES_IDS = [city.id for city in read_cities_file(settings.OPEN_WEATHER_CITIES_FILE)]
 
 
 class KelvinToCelsiusTestCase(TestCase):
@@ -41,27 +152,34 @@ class WeatherDataViewTestCase(TestCase):
         self.factory = RequestFactory()
 
     @patch("open_weather_api.views.WeatherData.objects.filter")
-    def test_call_weather_api(self, mock_filter):
+    def test_post_returns_job_handle(self, mock_filter):
         """
-        Test for the call_weather_api method of WeatherDataView.
+        Test that a POST enqueues the job and returns its handle right away.
 
         Args:
             mock_filter (MagicMock): Mocked version of the filter method for WeatherData objects.
         """      
         # Create a mock QuerySet object
         mock_query_set = MagicMock()
-        mock_query_set.first.return_value = None  # Indicates user doesn't exist in the database
+        mock_query_set.afirst = AsyncMock(return_value=None)  # Indicates user doesn't exist in the database
         mock_filter.return_value = mock_query_set
 
         view = WeatherDataView()
         request = self.factory.post('/', data={'user_defined_id': 'some-id'}, content_type='application/json')
-        response = view.post(request)
-        self.assertEqual(response.status_code, 200)
+        response = async_to_sync(view.post)(request)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(json.loads(response.content), {
+            "user_defined_id": "some-id",
+            "status": "queued",
+            "total": len(CITIES_IDS),
+            "progress_url": "/progress/some-id/",
+            "stream_url": "/collect/some-id/stream/",
+            "results_url": "/results/some-id/",
+        })
 
 
     def test_build_payload(self):
-        """Test for the build_payload method of WeatherDataView."""      
-        view = WeatherDataView()
+        """Test for the payloads built by the default schema."""      
         mock_response = {
             "id": 123,
             "main": {
@@ -74,14 +192,29 @@ class WeatherDataViewTestCase(TestCase):
             "temperature": -241.15,
             "humidity": 80
         }
-        self.assertEqual(view.build_payload(mock_response), expected_payload)
+        self.assertEqual(PayloadSchema().build([mock_response]), [expected_payload])
+
+
+    def test_post_with_payload_schema(self):
+        """Test that a POST picks the fields and units of the job, and rejects unknown ones."""
+        view = WeatherDataView()
+        body = {'user_defined_id': 'some-id', 'cities_ids': [1, 2], 'fields': ['wind_speed', 'temperature'], 'units': 'imperial'}
+        response = async_to_sync(view.post)(self.factory.post('/', data=body, content_type='application/json'))
+
+        self.assertEqual(response.status_code, 202)
+        job = WeatherData.objects.get(pk='some-id')
+        self.assertEqual((job.payload_fields, job.units), (['wind_speed'], 'imperial'))
 
+        for schema in [{'fields': ['ozone']}, {'fields': 'wind_speed'}, {'units': 'kelvin'}]:
+            body = dict({'user_defined_id': 'other-id', 'cities_ids': [1]}, **schema)
+            response = async_to_sync(view.post)(self.factory.post('/', data=body, content_type='application/json'))
+            self.assertEqual(response.status_code, 400, schema)
 
     def test_non_post_request(self):
         """Test for handling non-POST requests in the WeatherDataView."""    
         view = WeatherDataView()
         request = self.factory.get('/')
-        response = view.post(request)
+        response = async_to_sync(view.post)(request)
         
         self.assertEqual(response.status_code, 400)
         response_content = json.loads(response.content)
@@ -91,39 +224,42 @@ class WeatherDataViewTestCase(TestCase):
         """Test for handling requests with missing user-defined IDs in the WeatherDataView."""       
         view = WeatherDataView()
         request = self.factory.post('/', data={}, content_type='application/json')
-        response = view.post(request)
+        response = async_to_sync(view.post)(request)
         
         self.assertEqual(response.status_code, 400)
         response_content = json.loads(response.content)
         self.assertEqual(response_content, {"Error": "User ID not provided"})
 
-    @patch.object(WeatherDataView, 'call_weather_api', side_effect=Exception("API Call failed"))
-    def test_api_call_failure(self, mock_call_weather_api):
+    @patch('open_weather_api.views.enqueue_job', side_effect=Exception("Enqueue failed"))
+    def test_enqueue_failure(self, mock_enqueue_job):
         """
-        Test for handling API call failures in the WeatherDataView.
+        Test for handling failures to enqueue the job in the WeatherDataView.
 
         Args:
-            mock_call_weather_api (MagicMock): Mocked version of the call_weather_api method of WeatherDataView.
+            mock_enqueue_job (MagicMock): Mocked version of the enqueue_job function.
         """       
         view = WeatherDataView()
         request = self.factory.post('/', data={'user_defined_id': 'some-id'}, content_type='application/json')
         with self.assertRaises(Exception) as context:
-            view.post(request)
-        self.assertEqual(str(context.exception), "API Call failed")
+            async_to_sync(view.post)(request)
+        self.assertEqual(str(context.exception), "Enqueue failed")
 
     def test_valid_post_request(self):
         """Test for handling valid POST requests in the WeatherDataView."""      
         view = WeatherDataView()
         request = self.factory.post('/', data={'user_defined_id': 'some-id'}, content_type='application/json')
-        response = view.post(request)
-        self.assertEqual(response.status_code, 200)
+        response = async_to_sync(view.post)(request)
+        self.assertEqual(response.status_code, 202)
+        job = WeatherData.objects.get(user_defined_id='some-id')
+        self.assertEqual(job.status, WeatherData.QUEUED)
+        self.assertEqual(job.cities_ids, [int(city_id) for city_id in CITIES_IDS])
 
     def test_invalid_json_body(self):
         """Test for handling requests with invalid JSON body in the WeatherDataView."""
         view = WeatherDataView()
         # The data here is not valid JSON
         request = self.factory.post('/', data="{ 'user_defined_id': 'some-id'", content_type='application/json')
-        response = view.post(request)
+        response = async_to_sync(view.post)(request)
         self.assertEqual(response.status_code, 400)
         response_content = json.loads(response.content)
         self.assertEqual(response_content, {"status": "error", "message": "Invalid JSON"})
@@ -138,37 +274,20 @@ class WeatherDataViewTestCase(TestCase):
         """      
         # Mocking a return value that simulates user exists in the database
         mock_query_set = MagicMock()
-        mock_query_set.first.return_value = MagicMock()
+        mock_query_set.afirst = AsyncMock(return_value=MagicMock())
         mock_filter.return_value = mock_query_set
 
         view = WeatherDataView()
         request = self.factory.post('/', data={'user_defined_id': 'existing-id'}, content_type='application/json')
-        response = view.post(request)
+        response = async_to_sync(view.post)(request)
         
         self.assertEqual(response.status_code, 400)
         response_content = json.loads(response.content)
         self.assertEqual(response_content, {"Error": "User ID already exists"})
 
-    @patch.object(WeatherDataView, 'call_weather_api', return_value=iter(["Part1", "Part2"]))
-    def test_streaming_response_content(self, mock_call_weather_api):
-        """
-        Test for the streaming content of WeatherDataView response.
-
-        Args:
-            mock_call_weather_api (MagicMock): Mocked version of the call_weather_api method of WeatherDataView.
-        """       
-        view = WeatherDataView()
-        request = self.factory.post('/', data={'user_defined_id': 'some-id'}, content_type='application/json')
-        response = view.post(request)
-        
-        self.assertEqual(response.status_code, 200)
-        response_content = b"".join([content for content in response.streaming_content])
-        self.assertEqual(response_content, b"Part1Part2")
-
     def test_build_payload_missing_keys(self):
-        """Test for the build_payload method when provided with incomplete data."""
+        """Test for the default schema when provided with incomplete data."""
       
-        view = WeatherDataView()
         mock_response = {
             "id": 123,
             "main": {
@@ -176,7 +295,7 @@ class WeatherDataViewTestCase(TestCase):
             }
         }
         with self.assertRaises(KeyError):
-            view.build_payload(mock_response)
+            PayloadSchema().build([mock_response])
 
     def test_order_of_error_checks(self):
         """Test the order in which the WeatherDataView checks for errors."""
@@ -184,7 +303,7 @@ class WeatherDataViewTestCase(TestCase):
         view = WeatherDataView()
         # Sending a request with invalid JSON and missing 'user_defined_id'
         request = self.factory.post('/', data="{ 'user_defined_id': 'some-id'", content_type='application/json')
-        response = view.post(request)
+        response = async_to_sync(view.post)(request)
         self.assertEqual(response.status_code, 400)
         response_content = json.loads(response.content)
         self.assertEqual(response_content, {"status": "error", "message": "Invalid JSON"})
@@ -201,126 +320,2234 @@ class WeatherDataViewTestCase(TestCase):
         request = self.factory.post('/', data={'user_defined_id': 'some-id'}, content_type='application/json')
         
         with self.assertRaises(Exception) as context:
-            view.post(request)
+            async_to_sync(view.post)(request)
         self.assertEqual(str(context.exception), "DB Error")
-    
 
-    @patch('open_weather_api.views.grequests.map')
-    @patch('open_weather_api.views.WeatherData.objects.create')
-    @patch('open_weather_api.views.WeatherData.objects.filter')
-    def test_call_weather_api_with_exact_ten_urls(self, mock_filter, mock_create, mock_grequests_map):
+
+def fake_collect(results):
+    """Builds a replacement for `collect` that yields the given results of the requested cities."""
+    async def collect(cities_ids, **kwargs):
+        cities_ids = set(cities_ids)
+        for result in results:
+            if result.city_id in cities_ids:
+                yield result
+    return collect
+
+
+def responding_collect(respond, requested=None):
+    """
+    Builds a replacement for `collect` that answers each city with
+    `respond(city_id)`, recording the requested cities in `requested`.
+    """
+    async def collect(cities_ids, **kwargs):
+        for city_id in cities_ids:
+            if requested is not None:
+                requested.append(city_id)
+            yield respond(city_id)
+    return collect
+
+
+def weather(city_id, **extra):
+    """Builds an upstream response for `city_id` at 300 K and 80% humidity."""
+    return dict({"id": city_id, "main": {"temp": 300, "humidity": 80}}, **extra)
+
+
+class RunJobTestCase(TestCase):
+    """Test cases for collecting a queued job in the background."""
+
+    def setUp(self):
+        """Set up a running job."""
+        self.job = enqueue_job('some-id', list(range(1, 11)))
+        self.job = claim_next_job('test-worker')
+
+    def run_job(self, results):
+        """Runs the job against the given collector results."""
+        with patch('open_weather_api.jobs.collect', fake_collect(results)):
+            async_to_sync(run_job)(self.job)
+        self.job.refresh_from_db()
+
+    def test_run_job_with_exact_ten_cities(self):
+        """Test that a job with exactly ten cities stores all of them and finishes."""
+        self.run_job([CityResult(city_id, weather(city_id, some="data"), None) for city_id in range(1, 11)])
+
+        self.assertEqual(self.job.status, WeatherData.DONE)
+        self.assertIsNotNone(self.job.finished_at)
+        self.assertEqual(
+            list(self.job.readings.order_by("city_id").values_list("city_id", "temperature", "humidity")),
+            [(city_id, 26.85, 80) for city_id in range(1, 11)],
+        )
+
+    def test_run_job_updates_counters(self):
+        """Test that collected and failed cities are counted on the job."""
+        self.run_job([
+            CityResult(1, weather(1), None),
+            CityResult(2, None, Exception("timeout")),
+            CityResult(3, None, Exception("timeout")),
+        ])
+
+        self.assertEqual((self.job.total_cities, self.job.done_cities, self.job.failed_cities), (10, 1, 2))
+        self.assertEqual(list(self.job.readings.values_list("city_id", flat=True)), [1])
+
+    def test_run_job_uses_observation_time(self):
+        """Test that readings keep the observation time reported by OpenWeather."""
+        self.run_job([CityResult(1, weather(1, dt=1700000000), None)])
+
+        reading = CityReading.objects.get(job=self.job, city_id=1)
+        self.assertEqual(reading.observed_at.timestamp(), 1700000000)
+
+    def test_run_job_batches_inserts(self):
+        """Test that readings buffered while fetching are written in a single transaction."""
+        self.job.cities_ids = list(range(1, 31))
+        results = [CityResult(city_id, weather(city_id), None) for city_id in range(1, 31)]
+
+        # The results arrive before the buffer gets to flush, so all 30 go in
+        # one transaction holding a read of the stored readings, one insert,
+        # one counter update and a read and an upsert per rollup period, then
+        # one update finishes the job
+        with patch('open_weather_api.jobs.collect', fake_collect(results)):
+            with self.assertNumQueries(4 + 1 + 2 * 2 + 1):
+                async_to_sync(run_job)(self.job)
+        self.assertEqual(CityReading.objects.filter(job=self.job).count(), 30)
+
+    def test_run_job_records_failures(self):
+        """Test that a job that crashes is marked as failed with the error."""
+        with self.assertLogs('open_weather_api.jobs', 'ERROR'):
+            self.run_job([CityResult(1, {"id": 1}, None)])
+
+        self.assertEqual(self.job.status, WeatherData.FAILED)
+        self.assertIn("KeyError", self.job.error)
+
+
+class WriteBehindTestCase(TestCase):
+    """Test cases for saving the readings of a job behind its fetches."""
+
+    def setUp(self):
+        """Set up a running job and a record of the saved batches."""
+        self.job = enqueue_job('some-id', [1, 2, 3])
+        self.saved = []
+
+    def save(self, job, readings, failed_count=0, retried=0, throttled=0):
+        self.saved.append(([reading["city_id"] for reading in readings], failed_count))
+
+    def reading(self, city_id):
+        return dict(city_id=city_id, temperature=1.0, humidity=1, observed_at=self.job.request_datetime)
+
+    def test_flushes_full_batches_in_the_background(self):
+        """Test that a full batch is saved once the fetch loop yields, and the rest on exit."""
+        async def write():
+            async with WriteBehind(self.job, self.save, size=2, interval=60) as buffer:
+                await buffer.add(self.reading(1))
+                await buffer.add(failed=1)
+                await asyncio.sleep(0.01)
+                await buffer.add(self.reading(3))
+
+        async_to_sync(write)()
+
+        self.assertEqual(self.saved, [([1], 1), ([3], 0)])
+
+    def test_flushes_on_failure(self):
+        """Test that the readings buffered when a pass fails are still saved."""
+        async def write():
+            async with WriteBehind(self.job, self.save, size=10, interval=60) as buffer:
+                await buffer.add(self.reading(1))
+                raise KeyError("main")
+
+        with self.assertRaises(KeyError):
+            async_to_sync(write)()
+
+        self.assertEqual(self.saved, [([1], 0)])
+
+    def test_failed_save_is_retried_on_exit(self):
+        """Test that a batch whose save failed in the background is kept for the final flush."""
+        attempts = []
+
+        def save(job, readings, *counters):
+            attempts.append(len(readings))
+            if len(attempts) == 1:
+                raise RuntimeError("database is locked")
+            self.save(job, readings, *counters)
+
+        async def write():
+            async with WriteBehind(self.job, save, size=1, interval=60) as buffer:
+                await buffer.add(self.reading(1))
+                await asyncio.sleep(0.01)
+                with self.assertRaises(RuntimeError):
+                    await buffer.add(self.reading(2))
+
+        async_to_sync(write)()
+
+        self.assertEqual(attempts, [1, 1])
+        self.assertEqual(self.saved, [([1], 0)])
+
+    @override_settings(OPEN_WEATHER_SQLITE_JOURNAL_MODE="WAL", OPEN_WEATHER_SQLITE_SYNCHRONOUS="")
+    def test_sqlite_pragmas(self):
+        """Test that the SQLite tuning settings become connection pragmas, and unknown values are refused."""
+        self.assertEqual(sqlite_pragmas(), ["PRAGMA journal_mode=wal"])
+        with override_settings(OPEN_WEATHER_SQLITE_SYNCHRONOUS="sometimes"):
+            with self.assertRaises(ImproperlyConfigured):
+                sqlite_pragmas()
+
+
+class AdaptiveConcurrencyTestCase(TestCase):
+    """Test cases for the AIMD limit, retries and circuit breaker of upstream calls."""
+
+    def setUp(self):
+        """Set up a fake clock."""
+        self.now = 0.0
+
+    def clock(self):
+        """Return the fake time."""
+        return self.now
+
+    def make_client(self, handler):
+        """Builds an HTTP client that answers requests with `handler`."""
+        return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    def collect(self, handler, cities_ids, control):
+        """Collects `cities_ids` against `handler` with `control`, returning the results by city."""
+        results = iter_collect(cities_ids, client=self.make_client(handler), limiter=TokenBucket(100, 1), control=control)
+        return {result.city_id: result for result in results}
+
+    def test_aimd_limit(self):
+        """Test that the limit halves once per cooldown and grows by one per round trip."""
+        concurrency = AIMDConcurrency(16, minimum=2, latency_target=1, clock=self.clock)
+
+        concurrency.decrease()
+        concurrency.decrease()
+        self.assertEqual(concurrency.limit, 8)
+        self.now = 1.5
+        concurrency.on_success(latency=2)
+        self.assertEqual(concurrency.limit, 4)
+        for _ in range(5):
+            concurrency.on_success(latency=0.1)
+        self.assertEqual(concurrency.limit, 5)
+        self.now, concurrency.value = 10, 2.5
+        concurrency.decrease()
+        self.assertEqual(concurrency.limit, 2)
+
+    def test_circuit_breaker(self):
+        """Test that the breaker opens on consecutive failures and closes after a successful probe."""
+        breaker = CircuitBreaker(threshold=2, reset_timeout=30, clock=self.clock)
+
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        self.now = 30
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.now = 59
+        self.assertFalse(breaker.allow())
+        self.now = 60
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_retry_after(self):
+        """Test that Retry-After seconds and dates, and spent rate limit headers, are understood."""
+        self.assertEqual(retry_after(httpx.Response(429, headers={"Retry-After": "12"})), 12)
+        date = email.utils.format_datetime(timezone.now() + dt.timedelta(seconds=60), usegmt=True)
+        self.assertAlmostEqual(retry_after(httpx.Response(503, headers={"Retry-After": date})), 60, delta=2)
+        self.assertEqual(retry_after(httpx.Response(200, headers={"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "5"})), 5)
+        self.assertIsNone(retry_after(httpx.Response(200, headers={"X-RateLimit-Remaining": "3", "X-RateLimit-Reset": "5"})))
+        self.assertIsNone(retry_after(httpx.Response(429)))
+
+    def test_throttled_calls_are_retried_after_retry_after(self):
+        """Test that 429s are retried once upstream allows it, so no city is lost."""
+        calls = []
+
+        def handler(request):
+            city_id = int(request.url.params["id"])
+            calls.append(city_id)
+            if calls.count(city_id) == 1:
+                return httpx.Response(429, headers={"Retry-After": "0"})
+            return httpx.Response(200, json=weather(city_id))
+
+        control = UpstreamControl(max_in_flight=4, breaker=CircuitBreaker(threshold=5, reset_timeout=30))
+        results = self.collect(handler, range(1, 6), control)
+
+        self.assertTrue(all(result.error is None for result in results.values()))
+        self.assertEqual((control.stats.retries, control.stats.throttled), (5, 5))
+        self.assertLess(control.limit, 4)
+
+    @override_settings(OPEN_WEATHER_RETRY_BACKOFF=0)
+    def test_client_errors_are_not_retried(self):
+        """Test that a 404 fails the city without retrying it."""
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            return httpx.Response(404)
+
+        control = UpstreamControl(breaker=CircuitBreaker(threshold=5, reset_timeout=30))
+        results = self.collect(handler, [1], control)
+
+        self.assertIsInstance(results[1].error, httpx.HTTPStatusError)
+        self.assertEqual((len(calls), control.stats.retries), (1, 0))
+
+    @override_settings(OPEN_WEATHER_MAX_RETRIES=0)
+    def test_open_breaker_stops_upstream_calls(self):
+        """Test that once upstream is down the remaining cities fail without calling it."""
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            return httpx.Response(503)
+
+        control = UpstreamControl(max_in_flight=1, breaker=CircuitBreaker(threshold=2, reset_timeout=60))
+        results = self.collect(handler, range(1, 6), control)
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(sum(isinstance(result.error, CircuitOpenError) for result in results.values()), 3)
+        self.assertEqual(control.stats.rejected, 3)
+
+    def test_job_reports_retries(self):
+        """Test that the retried and throttled calls of a job are stored with its progress."""
+        async def collect(cities_ids, control=None, **kwargs):
+            for city_id in cities_ids:
+                control.stats.retries += 2
+                control.stats.throttled += 1
+                yield CityResult(city_id, weather(city_id), None)
+
+        job = enqueue_job('some-id', [1, 2, 3])
+        with patch('open_weather_api.jobs.collect', collect):
+            async_to_sync(run_job)(claim_next_job('test-worker'))
+        content = json.loads(async_to_sync(ProgressView().get)(RequestFactory().get('/'), 'some-id').content)
+
+        self.assertEqual((content["retried_calls"], content["throttled_calls"], content["failed"]), (6, 3, 0))
+
+
+class CitySelectionTestCase(TestCase):
+    """Test cases for choosing the cities of a job when posting it."""
+
+    def setUp(self):
+        """Register a few cities and a city set."""
+        self.factory = RequestFactory()
+        City.objects.bulk_create([
+            City(id=1, name="Rio de Janeiro", country="BR", lat=-22.9, lon=-43.2),
+            City(id=2, name="Recife", country="BR", lat=-8.05, lon=-34.9),
+            City(id=3, name="Lisbon", country="PT", lat=38.7, lon=-9.1),
+        ])
+        CitySet.objects.create(name="coast").cities.add(2, 3)
+
+    def post(self, **body):
+        """Post a job with the given body and return the response."""
+        request = self.factory.post('/', data={'user_defined_id': 'some-id', **body}, content_type='application/json')
+        return async_to_sync(WeatherDataView().post)(request)
+
+    def posted_cities(self, **body):
+        """Post a job and return the cities it was queued with."""
+        response = self.post(**body)
+        self.assertEqual(response.status_code, 202, response.content)
+        self.assertEqual(json.loads(response.content)["total"], WeatherData.objects.get().total_cities)
+        return WeatherData.objects.get().cities_ids
+
+    def test_explicit_ids(self):
+        """Test that explicit IDs are collected as given, without duplicates."""
+        self.assertEqual(self.posted_cities(cities_ids=[9, 3, 9]), [9, 3])
+
+    def test_city_set(self):
+        """Test that a named city set collects its members."""
+        self.assertEqual(self.posted_cities(city_set="coast"), [2, 3])
+
+    def test_filter(self):
+        """Test filtering the registry by country, name prefix and bounding box."""
+        self.assertEqual(self.posted_cities(filter={"country": "br", "name": "re"}), [2])
+        WeatherData.objects.all().delete()
+        self.assertEqual(self.posted_cities(filter={"bbox": [-50, -30, -30, 0]}), [1, 2])
+
+    def test_default_cities(self):
+        """Test that the cities file is collected until a default set is loaded."""
+        self.assertEqual(self.posted_cities(), CITIES_IDS)
+        WeatherData.objects.all().delete()
+        CitySet.objects.create(name="default").cities.add(1)
+        self.assertEqual(self.posted_cities(), [1])
+
+    def test_invalid_selections(self):
+        """Test that invalid or empty selections are rejected before queueing a job."""
+        for body in [
+            {"cities_ids": ["1"]},
+            {"cities_ids": []},
+            {"city_set": "missing"},
+            {"filter": {"continent": "SA"}},
+            {"filter": {"bbox": [1, 2]}},
+            {"filter": {"country": "US"}},
+            {"cities_ids": [1], "city_set": "coast"},
+        ]:
+            response = self.post(**body)
+            self.assertEqual(response.status_code, 400, body)
+            self.assertIn("Error", json.loads(response.content))
+        self.assertFalse(WeatherData.objects.exists())
+
+
+class LoadCitiesCommandTestCase(TestCase):
+    """Test cases for the load_cities management command."""
+
+    def write(self, content, suffix):
+        """Write a temporary cities file and return its path."""
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_load_city_list_json(self):
+        """Test loading OpenWeather's city list into the registry and a city set."""
+        path = self.write(json.dumps([
+            {"id": 1, "name": "Recife", "state": "", "country": "BR", "coord": {"lon": -34.9, "lat": -8.05}},
+            {"id": 2, "name": "Lisbon", "state": "", "country": "PT", "coord": {"lon": -9.1, "lat": 38.7}},
+        ]), ".json")
+
+        call_command("load_cities", path, "--set", "mine", stdout=StringIO())
+
+        self.assertEqual(City.objects.get(id=1).country, "BR")
+        self.assertEqual(list(CitySet.objects.get(name="mine").cities.order_by("id").values_list("id", flat=True)), [1, 2])
+
+    def test_load_default_ids_file(self):
+        """Test that the default file becomes the default set without erasing city details."""
+        City.objects.create(id=CITIES_IDS[0], name="Known", country="BR")
+
+        call_command("load_cities", stdout=StringIO())
+
+        self.assertEqual(City.objects.count(), len(set(CITIES_IDS)))
+        self.assertEqual(City.objects.get(id=CITIES_IDS[0]).name, "Known")
+        self.assertEqual(CitySet.objects.get(name="default").cities.count(), len(set(CITIES_IDS)))
+
+
+class ResumeJobTestCase(TestCase):
+    """Test cases for retrying failed cities and resuming interrupted jobs."""
+
+    def setUp(self):
+        """Set up a job of ten cities whose first five were stored before it was interrupted."""
+        self.factory = RequestFactory()
+        self.job = enqueue_job('some-id', list(range(1, 11)))
+        self.job = claim_next_job('test-worker')
+        CityReading.objects.bulk_create(
+            CityReading(job=self.job, city_id=city_id, temperature=20, humidity=50, observed_at=self.job.request_datetime)
+            for city_id in range(1, 6)
+        )
+        finish_job(self.job, WeatherData.FAILED, "Interrupted")
+
+    def test_failed_cities_are_retried_in_a_tail_pass(self):
+        """Test that cities failing once are fetched again at the end of the job."""
+        attempts = []
+
+        def respond(city_id):
+            attempts.append(city_id)
+            if city_id == 7 and attempts.count(7) == 1:
+                return CityResult(city_id, None, Exception("timeout"))
+            return CityResult(city_id, weather(city_id), None)
+
+        self.assertTrue(resume_job(self.job))
+        self.job.refresh_from_db()
+        with patch('open_weather_api.jobs.collect', responding_collect(respond)):
+            async_to_sync(run_job)(self.job)
+        self.job.refresh_from_db()
+
+        self.assertEqual(attempts, [6, 7, 8, 9, 10, 7])
+        self.assertEqual((self.job.status, self.job.done_cities, self.job.failed_cities), (WeatherData.DONE, 10, 0))
+
+    def test_resume_fetches_only_missing_cities(self):
+        """Test that a resumed job skips the cities it already stored."""
+        requested = []
+
+        self.assertTrue(resume_job(self.job))
+        job = claim_next_job('other-worker')
+        with patch('open_weather_api.jobs.collect', responding_collect(lambda city_id: CityResult(city_id, weather(city_id), None), requested)):
+            async_to_sync(run_job)(job)
+        job.refresh_from_db()
+
+        self.assertEqual(requested, [6, 7, 8, 9, 10])
+        self.assertEqual((job.status, job.done_cities, job.readings.count()), (WeatherData.DONE, 10, 10))
+
+    def test_resume_keeps_cities_that_still_fail(self):
+        """Test that cities failing every pass are reported as failed."""
+        def respond(city_id):
+            return CityResult(city_id, None, Exception("timeout")) if city_id == 9 else CityResult(city_id, weather(city_id), None)
+
+        resume_job(self.job)
+        self.job.refresh_from_db()
+        with patch('open_weather_api.jobs.collect', responding_collect(respond)):
+            async_to_sync(run_job)(self.job)
+        self.job.refresh_from_db()
+
+        self.assertEqual((self.job.done_cities, self.job.failed_cities), (9, 1))
+
+    def test_resume_refuses_running_job(self):
+        """Test that a job still checkpointing cannot be resumed twice."""
+        WeatherData.objects.filter(pk=self.job.pk).update(status=WeatherData.RUNNING, updated_at=timezone.now())
+        self.assertFalse(resume_job(self.job))
+
+    def test_resume_stale_running_job(self):
+        """Test that a running job whose worker stopped checkpointing can be resumed."""
+        WeatherData.objects.filter(pk=self.job.pk).update(
+            status=WeatherData.RUNNING,
+            updated_at=timezone.now() - timezone.timedelta(seconds=settings.OPEN_WEATHER_JOB_STALE_AFTER + 1),
+        )
+        self.assertTrue(resume_job(self.job))
+
+    def test_resume_refuses_complete_job(self):
+        """Test that a job with every city stored has nothing to resume."""
+        CityReading.objects.bulk_create(
+            CityReading(job=self.job, city_id=city_id, temperature=20, humidity=50, observed_at=self.job.request_datetime)
+            for city_id in range(6, 11)
+        )
+        self.assertFalse(resume_job(self.job))
+
+    def test_resume_view(self):
+        """Test the resume endpoint for resumable, running and unknown jobs."""
+        view = JobResumeView()
+
+        response = view.post(self.factory.post('/'), 'some-id')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(json.loads(response.content)["status"], WeatherData.QUEUED)
+
+        response = view.post(self.factory.post('/'), 'some-id')
+        self.assertEqual(response.status_code, 409)
+
+        response = view.post(self.factory.post('/'), 'missing-id')
+        self.assertEqual(response.status_code, 404)
+
+
+class ObservationCacheTestCase(TestCase):
+    """Test cases for the per-city observation cache backends."""
+
+    def test_local_cache_expires_entries(self):
+        """Test that entries older than the TTL are treated as misses."""
+        now = {"value": 0}
+        cache = LocalObservationCache(ttl=600, max_entries=10, clock=lambda: now["value"])
+        cache.set_many({1: weather(1), 2: weather(2)})
+
+        now["value"] = 599
+        self.assertEqual(cache.get_many([1, 3]), {1: weather(1)})
+        now["value"] = 601
+        self.assertEqual(cache.get_many([1, 2]), {})
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_local_cache_evicts_least_recently_used(self):
+        """Test that the local cache stays within max_entries, dropping the LRU entry."""
+        cache = LocalObservationCache(ttl=600, max_entries=2)
+        cache.set_many({1: weather(1), 2: weather(2)})
+        cache.get_many([1])
+        cache.set_many({3: weather(3)})
+
+        self.assertEqual(sorted(cache.get_many([1, 2, 3])), [1, 3])
+
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    def test_django_cache_backend(self):
+        """Test that responses round-trip through the Django cache framework."""
+        cache = DjangoObservationCache(ttl=600)
+        cache.set_many({1: weather(1)})
+
+        self.assertEqual(cache.get_many([1, 2]), {1: weather(1)})
+
+    def test_database_cache_backend(self):
+        """Test that the database backend upserts, expires and evicts entries."""
+        cache = DatabaseObservationCache(ttl=600, max_entries=2)
+        cache.set_many({1: weather(1), 2: weather(2)})
+        cache.set_many({1: weather(1, name="updated")})
+        CachedObservation.objects.filter(city_id=2).update(fetched_at=timezone.now() - timezone.timedelta(seconds=601))
+
+        self.assertEqual(cache.get_many([1, 2]), {1: weather(1, name="updated")})
+
+        cache.set_many({3: weather(3)})
+        self.assertEqual(sorted(CachedObservation.objects.values_list("city_id", flat=True)), [1, 3])
+
+    @override_settings(OPEN_WEATHER_CACHE_BACKEND="")
+    def test_cache_can_be_disabled(self):
+        """Test that an empty backend setting turns the cache off."""
+        self.assertIsNone(build_cache())
+
+    def test_run_job_serves_fresh_cities_from_cache(self):
+        """Test that a job only goes upstream for cities missing from the cache."""
+        cache = LocalObservationCache(ttl=600, max_entries=10)
+        cache.set_many({1: weather(1), 2: weather(2)})
+        enqueue_job('some-id', [1, 2, 3])
+        job = claim_next_job('test-worker')
+        requested = []
+
+        with patch('open_weather_api.jobs.collect', responding_collect(lambda city_id: CityResult(city_id, weather(city_id), None), requested)):
+            async_to_sync(run_job)(job, cache=cache)
+        job.refresh_from_db()
+
+        self.assertEqual(requested, [3])
+        self.assertEqual((job.done_cities, job.cache_hits, job.cache_misses), (3, 2, 1))
+        self.assertEqual(sorted(cache.get_many([1, 2, 3])), [1, 2, 3])
+
+
+class SingleFlightTestCase(TestCase):
+    """Test cases for coalescing concurrent fetches of the same cities."""
+
+    def test_concurrent_jobs_fetch_each_city_once(self):
+        """Test that overlapping jobs share upstream calls but each store their readings."""
+        enqueue_job('first', [1, 2, 3, 4, 5])
+        enqueue_job('second', [3, 4, 5, 6, 7, 8])
+        first, second = claim_next_job('test-worker'), claim_next_job('test-worker')
+        requested = []
+
+        async def collect(cities_ids, **kwargs):
+            for city_id in cities_ids:
+                requested.append(city_id)
+                await asyncio.sleep(0.01)
+                yield CityResult(city_id, weather(city_id), None)
+
+        async def run_both():
+            await asyncio.gather(run_job(first), run_job(second))
+
+        with patch('open_weather_api.jobs.collect', collect):
+            async_to_sync(run_both)()
+
+        self.assertEqual(sorted(requested), [1, 2, 3, 4, 5, 6, 7, 8])
+        self.assertEqual(
+            list(WeatherData.objects.order_by('pk').values_list('status', 'done_cities')),
+            [(WeatherData.DONE, 5), (WeatherData.DONE, 6)],
+        )
+        self.assertEqual(CityReading.objects.filter(job=second).count(), 6)
+
+    @override_settings(OPEN_WEATHER_SINGLE_FLIGHT="")
+    def test_coalescing_can_be_disabled(self):
+        """Test that an empty setting turns single-flight off."""
+        self.assertIsNone(async_to_sync(get_single_flight_async)())
+
+    def test_abandoned_cities_fail_for_followers(self):
+        """Test that followers of a leader that stops get a failure instead of waiting."""
+        async def follow():
+            flight = SingleFlight()
+            flight.claim([1, 2])
+            leading, following = flight.claim([1, 2, 3])
+            flight.resolve(CityResult(1, weather(1), None))
+            flight.abandon([1, 2])
+            return leading, [result async for result in flight.follow(following)]
+
+        leading, results = async_to_sync(follow)()
+
+        self.assertEqual(leading, [3])
+        results = {result.city_id: result for result in results}
+        self.assertIsNone(results[1].error)
+        self.assertIsInstance(results[2].error, FetchAbandoned)
+
+    @override_settings(OPEN_WEATHER_SINGLE_FLIGHT="shared")
+    def test_shared_mode_needs_shared_cache(self):
+        """Test that cross-process coalescing refuses a per-process cache."""
+        with self.assertRaises(ImproperlyConfigured):
+            get_shared_leases(LocalObservationCache(ttl=600, max_entries=10))
+
+    @override_settings(
+        OPEN_WEATHER_SINGLE_FLIGHT="shared",
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    )
+    def test_shared_followers_read_leader_response(self):
+        """Test that a city leased by another process is read from the shared cache."""
+        cache = DjangoObservationCache(ttl=600)
+        leases = get_shared_leases(cache)
+        self.assertEqual(leases.claim([1, 2]), ([1, 2], []))
+        other = SharedLeases(cache, lease=5, poll_interval=0.01)
+        self.assertEqual(other.claim([1, 2, 3]), ([3], [1, 2]))
+
+        async def follow():
+            return [result async for result in other.follow([1, 2])]
+
+        cache.set_many({1: weather(1)})
+        leases.release([1, 2])
+        results = {result.city_id: result for result in async_to_sync(follow)()}
+
+        self.assertEqual(results[1].data, weather(1))
+        self.assertIsInstance(results[2].error, FetchAbandoned)
+
+
+async def get_single_flight_async():
+    return get_single_flight()
+
+
+class JobQueueTestCase(TestCase):
+    """Test cases for the database backed job queue and its worker."""
+
+    def test_claim_next_job_is_exclusive(self):
+        """Test that a queued job is handed to a single worker, oldest first."""
+        enqueue_job('first', [1])
+        enqueue_job('second', [2])
+
+        self.assertEqual(claim_next_job('worker-a').pk, 'first')
+        self.assertEqual(claim_next_job('worker-b').pk, 'second')
+        self.assertIsNone(claim_next_job('worker-c'))
+        self.assertEqual(WeatherData.objects.get(pk='first').worker, 'worker-a')
+
+    def test_worker_drains_queue(self):
+        """Test that a burst worker runs every queued job and exits."""
+        enqueue_job('first', [1])
+        enqueue_job('second', [1])
+
+        with patch('open_weather_api.jobs.collect', fake_collect([CityResult(1, weather(1), None)])):
+            call_command('collect_worker', '--burst', stdout=StringIO())
+
+        self.assertEqual(
+            list(WeatherData.objects.order_by('pk').values_list('status', 'done_cities')),
+            [(WeatherData.DONE, 1), (WeatherData.DONE, 1)],
+        )
+
+
+class JobStreamViewTestCase(TestCase):
+    """Test cases for attaching to a job and streaming its readings."""
+
+    def setUp(self):
+        """Set up the testing environment for JobStreamView."""
+        self.factory = RequestFactory()
+        self.view = JobStreamView()
+
+    @patch.object(JobStreamView, 'stream_sse', return_value=iter(["Part1", "Part2"]))
+    def test_streaming_response_content(self, mock_stream_sse):
         """
-        Test the call_weather_api method when provided with exactly ten URLs.
+        Test for the streaming content of JobStreamView response.
 
         Args:
-            mock_filter (MagicMock): Mocked version of the filter method for WeatherData objects.
-            mock_create (MagicMock): Mocked version of the create method for WeatherData objects.
-            mock_grequests_map (MagicMock): Mocked version of the map function in grequests.
-        """      
-        # Mock the grequests response
-        mock_response = MagicMock()
-        mock_response.json.return_value = {"id": 1, "main": {"temp": 300, "humidity": 80}, "some": "data"}
-        mock_grequests_map.return_value = [mock_response] * 10
+            mock_stream_sse (MagicMock): Mocked version of the stream_sse method of JobStreamView.
+        """       
+        enqueue_job('some-id', [1])
+        response = async_to_sync(self.view.get)(self.factory.get('/'), 'some-id')
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        response_content = b"".join([content for content in response.streaming_content])
+        self.assertEqual(response_content, b"Part1Part2")
 
-        # Mock the database response for `filter`
-        mock_query_set = MagicMock()
-        mock_weather_data = WeatherData()
-        mock_weather_data.request_datetime = timezone.now() 
-        mock_weather_data.city_info = {"cities_info": []}
-        mock_query_set.first.return_value = mock_weather_data
-        mock_filter.return_value = mock_query_set
+    def finished_job(self):
+        """Create a finished job with two stored readings."""
+        job = enqueue_job('some-id', [1, 2])
+        CityReading.objects.bulk_create(
+            CityReading(job=job, city_id=city_id, temperature=20.5, humidity=50, observed_at=job.request_datetime)
+            for city_id in [1, 2]
+        )
+        WeatherData.objects.filter(pk=job.pk).update(done_cities=2)
+        finish_job(job, WeatherData.DONE)
+        return job
 
-        mock_create.return_value = mock_weather_data
+    def test_stream_of_finished_job(self):
+        """Test that the legacy mode streams the readings as one JSON document."""
+        self.finished_job()
 
-        view = WeatherDataView()
-        cities_urls = ["http://example.com"] * 10
-        generator_response = view.call_weather_api('some-id', timezone.now(), cities_urls)  # Use timezone-aware datetime
+        response = async_to_sync(self.view.get)(self.factory.get('/', {'mode': 'legacy'}), 'some-id')
+        content = json.loads(b"".join(response.streaming_content))
 
-        # Convert generator to list
-        response_list = list(generator_response)
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(content["user_defined_id"], "some-id")
+        self.assertEqual(content["city_info"], [
+            {"city_id": 1, "temperature": 20.5, "humidity": 50},
+            {"city_id": 2, "temperature": 20.5, "humidity": 50},
+        ])
 
-        # Check the starting and ending of the response
-        self.assertIn('"user_defined_id": "some-id"', response_list[0])
-        self.assertEqual(response_list[-1], "]}")
+    def test_sse_events(self):
+        """Test that every reading is its own event, followed by progress and end events."""
+        job = self.finished_job()
+        first_id = job.readings.order_by("id").values_list("id", flat=True)[0]
 
-        # Ensure there were 10 city responses included
-        city_data = ",".join(response_list[1:-1])
-        self.assertEqual(city_data.count('{"city_id": 1, "temperature": 26.85, "humidity": 80}'), 10)
+        response = async_to_sync(self.view.get)(self.factory.get('/'), 'some-id')
+        events = b"".join(response.streaming_content).decode().split("\n\n")
 
+        self.assertEqual(events[0], f'event: reading\nid: {first_id}\ndata: {{"city_id":1,"temperature":20.5,"humidity":50}}')
+        self.assertTrue(events[2].startswith('event: progress\ndata: {"Status":"100.0%"'))
+        self.assertEqual(events[3], 'event: end\ndata: {"state":"done"}')
 
+    def test_sse_resumes_after_last_event_id(self):
+        """Test that a reconnecting client only gets the readings after Last-Event-ID."""
+        job = self.finished_job()
+        first_id = job.readings.order_by("id").values_list("id", flat=True)[0]
 
-class ProgressViewTestCase(TestCase):
-    """Test cases for the ProgressView."""   
+        request = self.factory.get('/', HTTP_LAST_EVENT_ID=str(first_id))
+        content = b"".join(async_to_sync(self.view.get)(request, 'some-id').streaming_content).decode()
+
+        self.assertEqual(content.count("event: reading"), 1)
+        self.assertIn('"city_id":2', content)
+
+    def test_ndjson_chosen_by_accept_header(self):
+        """Test that NDJSON clients get one JSON event per line."""
+        self.finished_job()
+
+        response = async_to_sync(self.view.get)(self.factory.get('/', HTTP_ACCEPT='application/x-ndjson'), 'some-id')
+        lines = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertEqual([line["event"] for line in lines], ["reading", "reading", "progress", "end"])
+        self.assertEqual(lines[1], {"event": "reading", "city_id": 2, "temperature": 20.5, "humidity": 50})
+
+    def test_async_stream_under_asgi(self):
+        """Test that ASGI requests get an async body tailing the job with async queries."""
+        self.finished_job()
+
+        async def stream():
+            request = AsyncRequestFactory().get('/', {'mode': 'ndjson'})
+            response = await self.view.get(request, 'some-id')
+            return response, [chunk async for chunk in response.streaming_content]
+
+        response, chunks = async_to_sync(stream)()
+        lines = [json.loads(line) for line in b"".join(chunks).splitlines()]
+
+        self.assertTrue(response.is_async)
+        self.assertEqual([line["event"] for line in lines], ["reading", "reading", "progress", "end"])
+
+    @override_settings(OPEN_WEATHER_STREAM_HEARTBEAT=0, OPEN_WEATHER_STREAM_POLL_INTERVAL=0)
+    def test_heartbeat_while_waiting(self):
+        """Test that an idle stream sends heartbeats until the job has news."""
+        job = enqueue_job('some-id', [1])
+        events = self.view.job_events(job)
+
+        self.assertEqual(next(events), ("heartbeat", {}))
+        finish_job(job, WeatherData.DONE)
+        self.assertEqual([event for event, _ in events], ["progress", "end"])
+
+    def test_unknown_mode(self):
+        """Test that an unknown stream mode is rejected."""
+        enqueue_job('some-id', [1])
+        response = async_to_sync(self.view.get)(self.factory.get('/', {'mode': 'xml'}), 'some-id')
+        self.assertEqual(response.status_code, 400)
+
+    def test_stream_unknown_job(self):
+        """Test the response when streaming a user ID that does not exist."""
+        response = async_to_sync(self.view.get)(self.factory.get('/'), 'missing-id')
+        self.assertEqual(response.status_code, 404)
+
+
+class ResultsViewTestCase(TestCase):
+    """Test cases for paging through the readings of a job."""
 
     def setUp(self):
-        """Set up the testing environment for ProgressView."""       
+        """Create a finished job with five readings."""
         self.factory = RequestFactory()
-        self.view = ProgressView()
+        self.job = enqueue_job('some-id', [5, 4, 3, 2, 1])
+        CityReading.objects.bulk_create(
+            CityReading(job=self.job, city_id=city_id, temperature=10.0 * city_id, humidity=city_id, observed_at=self.job.request_datetime)
+            for city_id in [5, 4, 3, 2, 1]
+        )
+        WeatherData.objects.filter(pk=self.job.pk).update(done_cities=5, updated_at=timezone.now())
+        finish_job(self.job, WeatherData.DONE)
 
-    @patch('open_weather_api.views.WeatherData.objects.filter')
-    def test_user_id_not_found(self, mock_filter):
-        """Test the response when a user ID is not found in the ProgressView."""
-       
-        mock_filter.return_value.first.return_value = None
+    def get(self, path='/results/some-id/', **params):
+        """Get a page of results and return the response."""
+        headers = {key: params.pop(key) for key in list(params) if key.startswith("HTTP_")}
+        request = self.factory.get(path, params, **headers)
+        return ResultsView().get(request, 'some-id')
 
-        request = self.factory.get('/progress/some-id')
-        response = self.view.get(request, 'some-id')
+    def test_pages_follow_next_links(self):
+        """Test that following the next links returns every reading once, in city order."""
+        cities = []
+        response = self.get(limit=2)
+        while True:
+            content = json.loads(response.content)
+            cities.extend(reading["city_id"] for reading in content["results"])
+            if not content["next"]:
+                break
+            self.assertIn("limit=2", content["next"])
+            response = ResultsView().get(self.factory.get(content["next"]), 'some-id')
+
+        self.assertEqual(cities, [1, 2, 3, 4, 5])
+        self.assertEqual(content["total"], 5)
+
+    def test_page_costs_constant_queries(self):
+        """Test that a page takes one query for the job and one for its readings."""
+        with self.assertNumQueries(2):
+            self.get(cursor=3, limit=1)
+
+    def test_filters_and_projection(self):
+        """Test the city and range filters and the field projection."""
+        content = json.loads(self.get(temperature_min=20, humidity_max=4, fields="temperature").content)
+        self.assertEqual(content["results"], [{"temperature": 20.0}, {"temperature": 30.0}, {"temperature": 40.0}])
+
+        content = json.loads(self.get(city_id="1,5").content)
+        self.assertEqual([reading["city_id"] for reading in content["results"]], [1, 5])
+        self.assertEqual(set(content["results"][0]), {"city_id", "temperature", "humidity", "observed_at"})
+
+    def test_not_modified(self):
+        """Test that a repeated read with the ETag gets a 304 until the job changes."""
+        etag = self.get()["ETag"]
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.get(limit=1, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        finish_job(self.job, WeatherData.FAILED, "Interrupted")
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_invalid_query(self):
+        """Test that unknown fields and malformed filters are rejected."""
+        for params in [{"fields": "pressure"}, {"city_id": "a"}, {"temperature_min": "warm"}, {"cursor": "x"}]:
+            response = self.get(**params)
+            self.assertEqual(response.status_code, 400, params)
 
+    def test_unknown_job(self):
+        """Test the response for a user ID that does not exist."""
+        response = ResultsView().get(self.factory.get('/'), 'missing-id')
         self.assertEqual(response.status_code, 404)
-        self.assertEqual(json.loads(response.content), {
-            "user_defined_id": "some-id",
-            "Status": "User ID not found."
-        })
 
 
-    @patch('open_weather_api.views.WeatherData.objects.filter')
-    def test_user_id_progress(self, mock_filter):
-        """Test calculating and returning progress percentage for a valid user ID."""
-       
-        mock_user_data = WeatherData()
-        mock_user_data.city_info = {"cities_info": [1, 2, 3]} 
-        mock_filter.return_value.first.return_value = mock_user_data
+class MoveCityInfoMigrationTestCase(TransactionTestCase):
+    """Test case for the migration moving JSON blobs into CityReading rows."""
 
-        request = self.factory.get('/progress/some-id')
-        response = self.view.get(request, 'some-id')
+    def test_blobs_become_readings(self):
+        """Test that every entry of a stored blob becomes one reading."""
+        executor = MigrationExecutor(connection)
+        executor.migrate([("open_weather_api", "0002_cityreading")])
+        old_apps = executor.loader.project_state([("open_weather_api", "0002_cityreading")]).apps
+        OldWeatherData = old_apps.get_model("open_weather_api", "WeatherData")
+        OldWeatherData.objects.create(
+            user_defined_id="old-job",
+            request_datetime=timezone.now(),
+            city_info={"cities_info": [
+                {"city_id": 1, "temperature": 20.5, "humidity": 50},
+                {"city_id": 2, "temperature": 21.5, "humidity": 60},
+            ]},
+        )
 
-        expected_progress = round(len(mock_user_data.city_info["cities_info"]) / len(CITIES_IDS) * 100, 2)
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(json.loads(response.content), {
-            "user_defined_id": "some-id",
-            "Status": f"{expected_progress}%",
-        })
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
 
-    @patch('open_weather_api.views.WeatherData.objects.filter')
-    def test_user_id_progress_100_percent(self, mock_filter):
-        """Test the response when progress for a user ID is 100%."""
-       
-        mock_user_data = WeatherData()
-        mock_user_data.city_info = {"cities_info": list(CITIES_IDS)}
-        mock_filter.return_value.first.return_value = mock_user_data
+        self.assertEqual(
+            list(CityReading.objects.order_by("city_id").values_list("job_id", "city_id", "temperature", "humidity")),
+            [("old-job", 1, 20.5, 50), ("old-job", 2, 21.5, 60)],
+        )
 
-        request = self.factory.get('/progress/some-id')
-        response = self.view.get(request, 'some-id')
 
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(json.loads(response.content), {
-            "user_defined_id": "some-id",
-            "Status": "100.0%",
-        })
+class TokenBucketTestCase(TestCase):
+    """Test cases for the continuous token bucket rate limiter."""
 
-    @patch('open_weather_api.views.WeatherData.objects.filter')
-    def test_user_id_progress_0_percent(self, mock_filter):
-        """Test the response when progress for a user ID is 0%."""
-       
-        mock_user_data = WeatherData()
-        mock_user_data.city_info = {"cities_info": []}
-        mock_filter.return_value.first.return_value = mock_user_data
+    def setUp(self):
+        """Set up a bucket driven by a fake clock."""
+        self.now = 0.0
+        self.bucket = TokenBucket(10, 11, clock=lambda: self.now)
 
-        request = self.factory.get('/progress/some-id')
-        response = self.view.get(request, 'some-id')
+    def test_burst_up_to_capacity(self):
+        """Test that a full bucket hands out its capacity without waiting."""
+        delays = [self.bucket.reserve() for _ in range(10)]
+        self.assertEqual(delays, [0.0] * 10)
 
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(json.loads(response.content), {
-            "user_defined_id": "some-id",
-            "Status": "0.0%",
-        })
\ No newline at end of file
+    def test_reservations_are_spaced_by_the_rate(self):
+        """Test that callers beyond the capacity wait one refill interval each."""
+        for _ in range(10):
+            self.bucket.reserve()
+        self.assertAlmostEqual(self.bucket.reserve(), 1.1)
+        self.assertAlmostEqual(self.bucket.reserve(), 2.2)
+
+    def test_tokens_refill_continuously(self):
+        """Test that tokens come back gradually rather than once per window."""
+        for _ in range(10):
+            self.bucket.reserve()
+        self.now = 2.2
+        self.assertEqual(self.bucket.reserve(), 0.0)
+        self.assertEqual(self.bucket.reserve(), 0.0)
+        self.assertGreater(self.bucket.reserve(), 0.0)
+
+
+class SharedRateLimiterTestCase(TestCase):
+    """Test cases for the rate limiters shared between processes."""
+
+    def setUp(self):
+        """Set up a fake wall clock."""
+        self.now = 1000.0
+        self.clock = lambda: self.now
+
+    def assert_shares_quota(self, first, second):
+        """Assert that two limiters with the same state take calls from one quota."""
+        delays = [limiter.reserve() for limiter in [first, second] * 5]
+        self.assertLess(max(delays), 1e-9)
+        self.assertAlmostEqual(first.utilization(), 1.0)
+        self.assertAlmostEqual(second.reserve(), 1.1)
+        self.now += 2.3
+        self.assertEqual(first.reserve(), 0.0)
+
+    def test_database_limiter(self):
+        """Test that limiters of different workers share the quota through the database."""
+        self.assert_shares_quota(
+            DatabaseRateLimiter(10, 11, clock=self.clock),
+            DatabaseRateLimiter(10, 11, clock=self.clock),
+        )
+
+    def test_file_limiter(self):
+        """Test that limiters of different processes share the quota through a locked file."""
+        path = os.path.join(tempfile.mkdtemp(), "ratelimit")
+        self.addCleanup(os.remove, path)
+        self.assert_shares_quota(
+            FileRateLimiter(10, 11, clock=self.clock, path=path),
+            FileRateLimiter(10, 11, clock=self.clock, path=path),
+        )
+
+    def test_idle_utilization(self):
+        """Test that an unused limiter reports no utilization."""
+        self.assertEqual(DatabaseRateLimiter(10, 11, clock=self.clock).utilization(), 0)
+
+    def test_fair_share(self):
+        """Test that each running job only gets its share of the quota."""
+        fair_share = FairShare(TokenBucket(10, 11, clock=self.clock), lambda: 2, clock=self.clock)
+        async_to_sync(fair_share.update_share)()
+
+        self.assertEqual([fair_share.bucket.reserve() for _ in range(5)], [0.0] * 5)
+        self.assertAlmostEqual(fair_share.bucket.reserve(), 2.2)
+
+    @override_settings(OPEN_WEATHER_RATE_LIMIT_BACKEND="open_weather_api.ratelimit.DatabaseRateLimiter")
+    def test_rate_limit_view(self):
+        """Test the endpoint exposing the utilization of the shared quota."""
+        enqueue_job("some-id", [1])
+        WeatherData.objects.update(status=WeatherData.RUNNING)
+        DatabaseRateLimiter(10, 11).reserve()
+
+        content = json.loads(RateLimitView().get(RequestFactory().get('/')).content)
+
+        self.assertEqual((content["backend"], content["shared"], content["running_jobs"]), ("DatabaseRateLimiter", True, 1))
+        self.assertAlmostEqual(content["utilization"], 0.1, places=2)
+
+
+class RateLimitDuringFlushTestCase(TransactionTestCase):
+    """Test case for the reservations made while readings are being saved."""
+
+    def test_reserve_during_slow_flush(self):
+        """Test that fetches take their calls from the database quota while a flush is stuck."""
+        saving, release = threading.Event(), threading.Event()
+
+        def slow_save(*args):
+            saving.set()
+            release.wait(10)
+
+        async def reserve_while_saving():
+            loop = asyncio.get_running_loop()
+            async with WriteBehind(None, slow_save, size=1) as buffer:
+                await buffer.add({"city_id": 1})
+                await loop.run_in_executor(None, saving.wait, 5)
+                try:
+                    await asyncio.wait_for(DatabaseRateLimiter(10, 11).acquire(), 5)
+                    return release.is_set()
+                finally:
+                    release.set()
+
+        self.assertIs(async_to_sync(reserve_while_saving)(), False)
+        self.assertEqual(RateLimitState.objects.count(), 1)
+
+
+class CollectorTestCase(TestCase):
+    """Test cases for the asyncio collection engine."""
+
+    def make_client(self, handler):
+        """Builds an HTTP client that answers requests with `handler`."""
+        return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    def test_collect_yields_every_city(self):
+        """Test that every requested city comes back exactly once."""
+        def handler(request):
+            city_id = int(request.url.params["id"])
+            return httpx.Response(200, json={"id": city_id, "main": {"temp": 273.15, "humidity": 50}})
+
+        results = list(iter_collect(range(1, 26), client=self.make_client(handler), limiter=TokenBucket(100, 1)))
+
+        self.assertEqual(sorted(result.city_id for result in results), list(range(1, 26)))
+        self.assertTrue(all(result.error is None for result in results))
+
+    @override_settings(OPEN_WEATHER_RETRY_BACKOFF=0)
+    def test_collect_reports_upstream_errors(self):
+        """Test that upstream calls failing every retry are reported instead of dropped."""
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            return httpx.Response(500)
+
+        results = list(iter_collect([1, 2], client=self.make_client(handler), limiter=TokenBucket(100, 1)))
+
+        self.assertEqual(len(results), 2)
+        self.assertEqual(len(calls), 2 * (1 + settings.OPEN_WEATHER_MAX_RETRIES))
+        self.assertTrue(all(isinstance(result.error, httpx.HTTPStatusError) for result in results))
+
+    def test_collect_keeps_only_stored_fields(self):
+        """Test that responses are projected to the fields payloads can store, and malformed ones fail."""
+        def handler(request):
+            city_id = int(request.url.params["id"])
+            if city_id == 2:
+                return httpx.Response(200, json={"id": 2, "weather": []})
+            return httpx.Response(200, json={
+                "id": city_id, "dt": 1700000000, "name": "Recife", "wind": {"speed": 3},
+                "main": {"temp": 273.15, "humidity": 50, "pressure": 1012},
+            })
+
+        results = {result.city_id: result for result in iter_collect([1, 2], client=self.make_client(handler), limiter=TokenBucket(100, 1))}
+
+        self.assertEqual(results[1].data, {"id": 1, "main": {"temp": 273.15, "humidity": 50, "pressure": 1012}, "dt": 1700000000, "wind": {"speed": 3}})
+        self.assertIsNone(results[1].raw)
+        self.assertIsInstance(results[2].error, KeyError)
+
+    @override_settings(OPEN_WEATHER_RAW_ARCHIVE='gzip')
+    def test_collect_keeps_raw_responses_to_archive(self):
+        """Test that the whole responses are kept next to the projected ones while they are archived."""
+        response = dict(weather(1), name="Recife", wind={"speed": 3})
+        results = list(iter_collect([1], client=self.make_client(lambda request: httpx.Response(200, json=response)), limiter=TokenBucket(100, 1)))
+
+        self.assertEqual(results[0].raw, response)
+        self.assertEqual(results[0].data, weather(1, wind={"speed": 3}))
+
+    def test_collect_bounds_requests_in_flight(self):
+        """Test that no more than max_in_flight requests are pending at once."""
+        in_flight = {"current": 0, "peak": 0}
+
+        async def handler(request):
+            in_flight["current"] += 1
+            in_flight["peak"] = max(in_flight["peak"], in_flight["current"])
+            await asyncio.sleep(0.01)
+            in_flight["current"] -= 1
+            return httpx.Response(200, json={"id": 1, "main": {"temp": 0, "humidity": 0}})
+
+        list(iter_collect(range(20), client=self.make_client(handler), limiter=TokenBucket(100, 1), max_in_flight=3))
+
+        self.assertEqual(in_flight["peak"], 3)
+
+    def collect_groups(self, handler, cities_ids):
+        """Collects `cities_ids` with the group strategy against `handler`, recording the calls."""
+        calls = []
+
+        def recording_handler(request):
+            calls.append((request.url.path, request.url.params["id"]))
+            return handler(request)
+
+        results = list(iter_collect(
+            cities_ids, client=self.make_client(recording_handler), limiter=TokenBucket(100, 1), strategy="group",
+        ))
+        return results, calls
+
+    @override_settings(OPEN_WEATHER_GROUP_SIZE=20)
+    def test_group_strategy_packs_cities(self):
+        """Test that the group strategy fetches up to 20 cities per call and splits the list."""
+        def handler(request):
+            cities_ids = request.url.params["id"].split(",")
+            return httpx.Response(200, json={"list": [weather(int(city_id)) for city_id in cities_ids]})
+
+        results, calls = self.collect_groups(handler, list(range(1, 46)))
+
+        self.assertEqual([len(ids.split(",")) for _, ids in calls], [20, 20, 5])
+        self.assertTrue(all(path.endswith("/group") for path, _ in calls))
+        self.assertEqual(sorted(result.data["id"] for result in results), list(range(1, 46)))
+
+    def test_group_strategy_falls_back_to_single_calls(self):
+        """Test that cities of a failed group call, or missing from its list, are fetched one by one."""
+        def handler(request):
+            if request.url.path.endswith("/group"):
+                if "1" in request.url.params["id"].split(","):
+                    return httpx.Response(500)
+                return httpx.Response(200, json={"list": [weather(30)]})
+            return httpx.Response(200, json=weather(int(request.url.params["id"])))
+
+        with override_settings(OPEN_WEATHER_GROUP_SIZE=2):
+            results, calls = self.collect_groups(handler, [1, 2, 30, 31])
+
+        self.assertEqual(sorted(result.city_id for result in results if result.error is None), [1, 2, 30, 31])
+        self.assertEqual(
+            sorted(ids for path, ids in calls if path.endswith("/weather")),
+            ["1", "2", "31"],
+        )
+
+    def test_pooled_client_reuses_connections(self):
+        """Test that consecutive collections share the pooled keep-alive connection."""
+        server = FakeOpenWeatherServer().start()
+        self.addCleanup(server.shutdown)
+
+        async def collect_twice():
+            results = []
+            for _ in range(2):
+                async for result in collect(range(1, 6), limiter=TokenBucket(100, 1), max_in_flight=1):
+                    results.append(result)
+            await close_client()
+            return results
+
+        with override_settings(OPEN_WEATHER_API_URL=server.base_url):
+            results = async_to_sync(collect_twice)()
+
+        self.assertEqual(len(results), 10)
+        self.assertEqual(sum(result.timing.new_connection for result in results), 1)
+        self.assertTrue(all(result.timing.total >= result.timing.server > 0 for result in results))
+
+    def test_timing_summary_counts_each_call_once(self):
+        """Test that cities sharing a group call only count that call once."""
+        group_timing, single_timing = RequestTiming(), RequestTiming()
+        group_timing.connect, group_timing.server = 0.1, 0.2
+        single_timing.server = 0.3
+        summary = TimingSummary()
+
+        for timing in [group_timing, group_timing, single_timing, None]:
+            summary.add(timing)
+
+        self.assertEqual((summary.calls, summary.new_connections), (2, 1))
+        self.assertAlmostEqual(summary.server, 0.5)
+
+    @override_settings(OPEN_WEATHER_FETCH_STRATEGY="bulk")
+    def test_unknown_strategy(self):
+        """Test that an unknown fetch strategy is reported as a configuration error."""
+        with self.assertRaises(ImproperlyConfigured):
+            get_strategy()
+
+
+class FastJsonTestCase(TestCase):
+    """Test cases for the pluggable JSON backend."""
+
+    document = {"id": 3439525, "name": "São Paulo", "main": {"temp": 293.15, "humidity": 80}, "list": [1, None]}
+
+    def test_backends_agree(self):
+        """Test that orjson and the standard library produce the same output."""
+        outputs = set()
+        for backend in ["json", "orjson"]:
+            with override_settings(OPEN_WEATHER_JSON_BACKEND=backend):
+                self.assertEqual(fastjson.loads(fastjson.dumps(self.document).encode()), self.document)
+                outputs.add(fastjson.dumps(self.document))
+        self.assertEqual(len(outputs), 1)
+
+    def test_invalid_documents(self):
+        """Test that both backends raise the standard decode error."""
+        for backend in ["json", "orjson"]:
+            with override_settings(OPEN_WEATHER_JSON_BACKEND=backend):
+                with self.assertRaises(json.JSONDecodeError):
+                    fastjson.loads(b"{")
+
+    def test_backend_resolved_once(self):
+        """Test that the backend is looked up once, and again when the setting changes."""
+        with override_settings(OPEN_WEATHER_JSON_BACKEND="json"):
+            with patch.object(fastjson, 'get_backend', wraps=fastjson.get_backend) as get_backend:
+                for _ in range(3):
+                    fastjson.loads(fastjson.dumps(self.document))
+            self.assertEqual(get_backend.call_count, 1)
+            self.assertIs(fastjson.backend(), fastjson.BACKENDS["json"])
+        with override_settings(OPEN_WEATHER_JSON_BACKEND="orjson"):
+            self.assertIs(fastjson.backend(), fastjson.BACKENDS["orjson"])
+
+    @override_settings(OPEN_WEATHER_JSON_BACKEND="yaml")
+    def test_unknown_backend(self):
+        """Test that an unknown backend is reported as a configuration error."""
+        with self.assertRaises(ImproperlyConfigured):
+            fastjson.dumps({})
+
+    def test_json_fields(self):
+        """Test that JSON model fields round-trip through the fast backend."""
+        CachedObservation.objects.create(city_id=1, response=self.document, fetched_at=timezone.now())
+        job = enqueue_job("some-id", [3, 1, 2])
+
+        self.assertEqual(CachedObservation.objects.get().response, self.document)
+        self.assertEqual(WeatherData.objects.get(pk=job.pk).cities_ids, [3, 1, 2])
+        self.assertEqual(CachedObservation.objects.values_list("response__main__humidity", flat=True).get(), 80)
+
+
+class FakeUpstreamTestCase(TestCase):
+    """Test cases for the fake OpenWeather server used by the benchmarks."""
+
+    def get(self, server, path):
+        """Send a GET to the fake server and return the response."""
+        return httpx.get(server.base_url + path)
+
+    def test_serves_weather_and_group(self):
+        """Test that both endpoints answer with payloads the collector can read."""
+        server = FakeOpenWeatherServer().start()
+        self.addCleanup(server.shutdown)
+
+        single = self.get(server, "/weather?id=7").json()
+        group = self.get(server, "/group?id=7,8").json()
+
+        self.assertEqual((single["id"], single["main"]["humidity"]), (7, 7))
+        self.assertEqual([item["id"] for item in group["list"]], [7, 8])
+        self.assertEqual(server.stats["cities"], 3)
+
+    def test_invalid_city_ids(self):
+        """Test that missing or non-numeric city IDs get a 400 like the real API, not a crash."""
+        server = FakeOpenWeatherServer().start()
+        self.addCleanup(server.shutdown)
+
+        for path in ["/weather", "/weather?id=abc", "/weather?id=%C2%B2", "/group?id=7,x"]:
+            response = self.get(server, path)
+            self.assertEqual((response.status_code, response.json()["cod"]), (400, "400"))
+        self.assertEqual(self.get(server, "/forecast?id=7").status_code, 404)
+        self.assertEqual(server.stats["cities"], 0)
+
+    def test_quota_answers_429_with_retry_after(self):
+        """Test that calls beyond the quota are throttled like the real API."""
+        server = FakeOpenWeatherServer(quota=(2, 60)).start()
+        self.addCleanup(server.shutdown)
+
+        statuses = [self.get(server, f"/weather?id={city_id}") for city_id in range(3)]
+
+        self.assertEqual([response.status_code for response in statuses], [200, 200, 429])
+        self.assertEqual(statuses[-1].headers["Retry-After"], "60")
+        self.assertEqual(server.stats["throttled"], 1)
+
+    def test_error_rate(self):
+        """Test that an error rate of 1 fails every call with a 500."""
+        server = FakeOpenWeatherServer(error_rate=1).start()
+        self.addCleanup(server.shutdown)
+
+        self.assertEqual(self.get(server, "/weather?id=1").status_code, 500)
+        self.assertEqual(server.stats["errors"], 1)
+
+    def test_sliding_window_quota(self):
+        """Test that the quota frees up as old calls leave the window."""
+        now = [0.0]
+        quota = SlidingWindowQuota(2, 10, clock=lambda: now[0])
+
+        self.assertEqual([quota.allow(), quota.allow()], [0, 0])
+        now[0] = 4.0
+        self.assertAlmostEqual(quota.allow(), 6.0)
+        now[0] = 10.0
+        self.assertEqual(quota.allow(), 0)
+
+    def test_parse_latency(self):
+        """Test the latency specs accepted by the benchmark and the command."""
+        self.assertEqual(parse_latency("constant:0.25")(), 0.25)
+        self.assertTrue(0.1 <= parse_latency("uniform:0.1:0.2", seed=1)() <= 0.2)
+        self.assertGreater(parse_latency("lognormal:0.2:0.8", seed=1)(), 0)
+        with self.assertRaises(ValueError):
+            parse_latency("pareto:1")
+
+
+class ProgressViewTestCase(TestCase):
+    """Test cases for the ProgressView."""   
+
+    def setUp(self):
+        """Set up the testing environment for ProgressView."""       
+        self.factory = RequestFactory()
+        self.view = ProgressView()
+
+    def test_user_id_not_found(self):
+        """Test the response when a user ID is not found in the ProgressView."""
+       
+        request = self.factory.get('/progress/some-id')
+        response = async_to_sync(self.view.get)(request, 'some-id')
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(json.loads(response.content), {
+            "user_defined_id": "some-id",
+            "Status": "User ID not found."
+        })
+
+
+    def create_job(self, done, failed=0, total=None, elapsed=0):
+        """Creates a job whose counters report `done` and `failed` cities."""
+        request_datetime = timezone.now()
+        return WeatherData.objects.create(
+            user_defined_id='some-id',
+            request_datetime=request_datetime,
+            status=WeatherData.RUNNING,
+            started_at=request_datetime,
+            total_cities=len(CITIES_IDS) if total is None else total,
+            done_cities=done,
+            failed_cities=failed,
+            updated_at=request_datetime + timezone.timedelta(seconds=elapsed),
+        )
+
+    def test_user_id_progress(self):
+        """Test calculating and returning progress percentage for a valid user ID."""
+        self.create_job(3)
+
+        request = self.factory.get('/progress/some-id')
+        response = async_to_sync(self.view.get)(request, 'some-id')
+
+        expected_progress = round(3 / len(CITIES_IDS) * 100, 2)
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)
+        self.assertEqual(content["user_defined_id"], "some-id")
+        self.assertEqual(content["Status"], f"{expected_progress}%")
+        self.assertEqual((content["done"], content["failed"], content["total"]), (3, 0, len(CITIES_IDS)))
+
+    def test_user_id_progress_100_percent(self):
+        """Test the response when progress for a user ID is 100%."""
+        self.create_job(len(CITIES_IDS) - 2, failed=2)
+
+        request = self.factory.get('/progress/some-id')
+        response = async_to_sync(self.view.get)(request, 'some-id')
+
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)
+        self.assertEqual(content["Status"], "100.0%")
+        self.assertEqual(content["eta_seconds"], 0)
+
+    def test_user_id_progress_0_percent(self):
+        """Test the response when progress for a user ID is 0%."""
+        self.create_job(0)
+
+        request = self.factory.get('/progress/some-id')
+        response = async_to_sync(self.view.get)(request, 'some-id')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)["Status"], "0.0%")
+
+    @override_settings(OPEN_WEATHER_RATE_LIMIT_CALLS=10, OPEN_WEATHER_RATE_LIMIT_PERIOD=10)
+    def test_user_id_progress_rate_and_eta(self):
+        """Test the throughput and ETA, which is capped by the configured rate limit."""
+        self.create_job(40, total=100, elapsed=10)
+
+        content = json.loads(async_to_sync(self.view.get)(self.factory.get('/progress/some-id'), 'some-id').content)
+
+        self.assertEqual(content["cities_per_second"], 4.0)
+        # 60 cities left at no more than the 1 city/s allowed by the quota
+        self.assertEqual(content["eta_seconds"], 60.0)
+
+    def test_progress_through_async_client(self):
+        """Test that the async view is served end to end by the ASGI handler."""
+        self.create_job(3)
+
+        response = async_to_sync(AsyncClient().get)('/progress/some-id/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["done"], 3)
+
+    def test_progress_query_does_not_touch_readings(self):
+        """Test that progress is served from the counters with a single query."""
+        self.create_job(3)
+        with self.assertNumQueries(1):
+            async_to_sync(self.view.get)(self.factory.get('/progress/some-id'), 'some-id')
+
+
+class ExportTestCase(TestCase):
+    """Test cases for the bulk export of readings."""
+
+    def setUp(self):
+        """Create two jobs with three readings each."""
+        self.factory = RequestFactory()
+        for job_id in ['first', 'second']:
+            job = enqueue_job(job_id, [1, 2, 3])
+            CityReading.objects.bulk_create(
+                CityReading(job=job, city_id=city_id, temperature=10.0 * city_id, humidity=city_id, observed_at=job.request_datetime)
+                for city_id in [3, 2, 1]
+            )
+
+    def get(self, **params):
+        """Request an export and return the response."""
+        return async_to_sync(ExportView().get)(self.factory.get('/export/', params))
+
+    def asgi_get(self, query):
+        """Request an export through the ASGI handler and return the messages it sent."""
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+            "path": "/export/", "raw_path": b"/export/", "query_string": query.encode(), "root_path": "",
+            "headers": [(b"host", b"testserver")], "server": ("testserver", 80), "client": ("127.0.0.1", 50000),
+        }
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        # Like the test client, keeps the handler from closing the test's connection
+        signals.request_finished.disconnect(close_old_connections)
+        self.addCleanup(signals.request_finished.connect, close_old_connections)
+        async_to_sync(ASGIHandler())(scope, receive, send)
+        return messages
+
+    def test_ndjson_export_of_many_jobs(self):
+        """Test that NDJSON exports every reading of the jobs, by job then city."""
+        response = self.get(jobs='first,second')
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertIn('filename="weather.ndjson"', response["Content-Disposition"])
+        self.assertEqual([(row["user_defined_id"], row["city_id"]) for row in rows],
+                         [('first', 1), ('first', 2), ('first', 3), ('second', 1), ('second', 2), ('second', 3)])
+        self.assertEqual(rows[2]["temperature"], 30.0)
+
+    @override_settings(OPEN_WEATHER_EXPORT_BATCH_SIZE=2)
+    def test_export_streams_under_asgi(self):
+        """Test that under ASGI an export is sent a batch at a time rather than read whole first."""
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            messages = self.asgi_get("jobs=first,second")
+        bodies = [message["body"] for message in messages if message["type"] == "http.response.body" and message.get("body")]
+
+        self.assertEqual(messages[0]["status"], 200)
+        self.assertEqual(len(bodies), 3)
+        self.assertEqual(b"".join(bodies), b"".join(export_readings(['first', 'second'], 'ndjson')))
+        self.assertFalse([warning for warning in caught if "synchronous iterators" in str(warning.message)])
+
+    def test_csv_export_in_batches(self):
+        """Test that a CSV export keeps one header and every row across batches."""
+        chunks = list(export_readings(['first', 'second'], 'csv', batch_size=2))
+        rows = list(csv.reader(b"".join(chunks).decode().splitlines()))
+
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(rows[0], ["user_defined_id", "city_id", "temperature", "humidity", "observed_at"])
+        self.assertEqual(len(rows), 7)
+
+    def test_gzip_export(self):
+        """Test that a gzip export decompresses to the plain export."""
+        response = self.get(jobs='first', format='csv', compression='gzip')
+        plain = b"".join(export_readings(['first'], 'csv'))
+
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        self.assertIn('filename="weather.csv.gz"', response["Content-Disposition"])
+        self.assertEqual(gzip.decompress(b"".join(response.streaming_content)), plain)
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+    def test_parquet_export_row_groups(self):
+        """Test that a Parquet export writes one row group per batch."""
+        import pyarrow.parquet as pq
+
+        data = b"".join(export_readings(['first', 'second'], 'parquet', batch_size=4))
+        parquet = pq.ParquetFile(BytesIO(data))
+
+        self.assertEqual(parquet.metadata.num_row_groups, 2)
+        self.assertEqual(parquet.read().column("city_id").to_pylist(), [1, 2, 3, 1, 2, 3])
+
+    def test_unknown_format_and_jobs(self):
+        """Test that unknown formats fail with 400 and unknown jobs with 404."""
+        self.assertEqual(self.get(jobs='first', format='xml').status_code, 400)
+        self.assertEqual(self.get(jobs='first', compression='lz4').status_code, 400)
+        self.assertEqual(self.get().status_code, 400)
+        self.assertEqual(self.get(jobs='first,missing').status_code, 404)
+        with self.assertRaises(ExportError):
+            export_readings(['first'], 'xml')
+
+    def test_export_command_writes_file(self):
+        """Test that the export_weather command writes the export to a file."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'weather.ndjson.gz')
+            call_command('export_weather', 'first', '--compression', 'gzip', '--output', path, stderr=StringIO())
+            with gzip.open(path) as f:
+                self.assertEqual(len(f.read().splitlines()), 3)
+
+
+class CompactTestCase(TestCase):
+    """Test cases for packing the readings of finished jobs into archives."""
+
+    def setUp(self):
+        """Create a finished job with four readings."""
+        self.factory = RequestFactory()
+        self.job = enqueue_job('some-id', [1, 2, 3, 4])
+        self.observed_at = self.job.request_datetime
+        CityReading.objects.bulk_create(
+            CityReading(job=self.job, city_id=city_id, temperature=10.25 * city_id, humidity=10 * city_id, observed_at=self.observed_at)
+            for city_id in [1, 2, 3, 4]
+        )
+        WeatherData.objects.filter(pk=self.job.pk).update(done_cities=4, updated_at=timezone.now())
+        finish_job(self.job, WeatherData.DONE)
+        self.rows = load_arrays('some-id', '').rows(['city_id', 'temperature', 'humidity', 'observed_at'])
+
+    def test_pack_round_trip(self):
+        """Test that unpacking returns the readings, their temperatures and times as stored in rows."""
+        data = pack(load_arrays('some-id', ''))
+        arrays = unpack(data)
+
+        self.assertEqual(len(data), 16 + 4 * (8 + 8 + 4 + 4 + 1))
+        self.assertEqual(arrays.rows(['city_id', 'temperature', 'humidity', 'observed_at']), self.rows)
+        self.assertEqual(self.rows[0], (1, 10.25, 10, self.observed_at))
+        with self.assertRaises(ValueError):
+            unpack(b"JSON" + data[4:])
+
+    @override_settings(OPEN_WEATHER_COMPACT_STORAGE='database')
+    @override_settings(OPEN_WEATHER_COMPACT_GRACE=0)
+    def test_compact_to_database(self):
+        """Test that compacting replaces the rows of a job with one archive, once."""
+        self.assertTrue(compact_job(self.job))
+        self.job.refresh_from_db()
+
+        self.assertEqual(self.job.archive, 'database')
+        self.assertEqual(CityReading.objects.filter(job=self.job).count(), 0)
+        self.assertEqual(ReadingArchive.objects.count(), 1)
+        self.assertEqual(load_arrays('some-id', 'database').rows(['city_id', 'temperature', 'humidity', 'observed_at']), self.rows)
+        self.assertFalse(compact_job(self.job))
+        self.assertFalse(resume_job(self.job))
+
+    @override_settings(OPEN_WEATHER_COMPACT_STORAGE='database', OPEN_WEATHER_COMPACT_GRACE=60)
+    def test_rows_outlive_compaction_for_a_grace_period(self):
+        """Test that the rows of a compacted job are only deleted once the grace period is over."""
+        compact_job(self.job)
+        self.job.refresh_from_db()
+
+        self.assertEqual(self.job.archive, 'database')
+        self.assertEqual(purge_compacted_rows(), 0)
+        self.assertEqual(CityReading.objects.filter(job=self.job).count(), 4)
+        with patch('open_weather_api.compact.timezone.now', return_value=timezone.now() + dt.timedelta(seconds=61)):
+            self.assertEqual(purge_compacted_rows(), 1)
+        self.assertEqual(CityReading.objects.filter(job=self.job).count(), 0)
+        self.assertEqual(purge_compacted_rows(), 0)
+
+    @override_settings(OPEN_WEATHER_COMPACT_STORAGE='database', OPEN_WEATHER_COMPACT_GRACE=60)
+    def test_stream_compacted_while_read(self):
+        """Test that a stream which found the job done and uncompacted gets every reading if it is compacted right then."""
+        readings = WeatherData.readings
+        compacted = []
+
+        class CompactedOnRead:
+            """Compacts the job between the stream's read of its counters and of its readings."""
+            def __get__(self, job, owner):
+                if job is not None and not compacted:
+                    compacted.append(job.pk)
+                    compact_job(job)
+                return readings.__get__(job, owner)
+
+        stream = JobStreamView().stream_ndjson(WeatherData.objects.get(pk=self.job.pk))
+        with patch.object(WeatherData, 'readings', CompactedOnRead()):
+            events = [json.loads(line) for line in "".join(stream).splitlines()]
+        self.job.refresh_from_db()
+
+        self.assertEqual((compacted, self.job.archive), (['some-id'], 'database'))
+        self.assertEqual([event["city_id"] for event in events if event["event"] == "reading"], [1, 2, 3, 4])
+        self.assertEqual(events[-1], {"event": "end", "state": "done"})
+
+    def test_compact_to_file(self):
+        """Test that a file archive is named after a hash of the job ID and read back memory-mapped."""
+        with tempfile.TemporaryDirectory() as directory, override_settings(OPEN_WEATHER_COMPACT_STORAGE='file', OPEN_WEATHER_COMPACT_DIR=directory):
+            self.assertTrue(compact_job(self.job))
+            path = FileArchive().path('some-id')
+
+            self.assertEqual(os.listdir(directory), [os.path.basename(path)])
+            arrays = load_arrays('some-id', 'file')
+            self.assertEqual(arrays.rows(['city_id', 'temperature', 'humidity', 'observed_at']), self.rows)
+
+    def test_compact_skips_incomplete_or_disabled(self):
+        """Test that jobs missing cities keep their rows, as does everything while compaction is off."""
+        self.assertFalse(compact_job(self.job))
+        WeatherData.objects.filter(pk=self.job.pk).update(done_cities=3)
+        with override_settings(OPEN_WEATHER_COMPACT_STORAGE='database'):
+            self.assertFalse(compact_job(self.job))
+        self.assertEqual(CityReading.objects.filter(job=self.job).count(), 4)
+
+    def test_filter_arrays(self):
+        """Test the cursor, filters and limit on archived readings."""
+        arrays = load_arrays('some-id', '')
+
+        self.assertEqual(filter_arrays(arrays, cursor=1, limit=2).city_id.tolist(), [2, 3])
+        self.assertEqual(filter_arrays(arrays, filters={"temperature__gte": 20.5, "humidity__lt": 40}).city_id.tolist(), [2, 3])
+        self.assertEqual(filter_arrays(arrays, filters={"city_id__in": [1, 4]}).city_id.tolist(), [1, 4])
+
+    def test_filter_archive_ranges(self):
+        """Test that pages read from archives by range match the readings, however deep they are."""
+        rows = [(city_id, city_id % 50 - 10.5, city_id % 101, self.observed_at, city_id) for city_id in range(1, 10001)]
+        data = pack(arrays_from_rows(rows))
+        ReadingArchive.objects.create(job=self.job, data=data)
+        pages = [
+            (0, None, 10, lambda row: True),
+            (9000, None, 101, lambda row: True),
+            (5000, {"temperature__gte": 38.5}, 20, lambda row: row[1] >= 38.5),
+            (0, {"city_id__in": [7, 9999], "humidity__lt": 50}, None, lambda row: row[0] in (7, 9999)),
+            (10000, None, 5, lambda row: True),
+        ]
+        with tempfile.TemporaryDirectory() as directory, override_settings(OPEN_WEATHER_COMPACT_DIR=directory):
+            FileArchive().write('some-id', data)
+            for archive in ('database', 'file'):
+                for cursor, filters, limit, matches in pages:
+                    expected = [row[:3] for row in rows if row[0] > cursor and matches(row)][:limit]
+                    page = filter_arrays(open_archive('some-id', archive), cursor, filters, limit)
+                    self.assertEqual(page.rows(['city_id', 'temperature', 'humidity']), expected)
+        with CaptureQueriesContext(connection) as queries:
+            filter_arrays(open_archive('some-id', 'database'), 9000, None, 101)
+        self.assertTrue(all('SUBSTR' in query['sql'] for query in queries.captured_queries))
+
+    @override_settings(OPEN_WEATHER_COMPACT_STORAGE='database')
+    def test_reads_of_compacted_job(self):
+        """Test that results, exports and streams of a compacted job match those of its rows."""
+        def read():
+            results = json.loads(ResultsView().get(self.factory.get('/', {'temperature_min': 20}), 'some-id').content)["results"]
+            export = b"".join(export_readings(['some-id'], 'ndjson'))
+            stream = "".join(JobStreamView().stream_ndjson(self.job)).splitlines()
+            return results, export, stream
+
+        before = read()
+        compact_job(self.job)
+        self.job.refresh_from_db()
+
+        self.assertEqual(read(), before)
+        last_id = CityReading.objects.get(job=self.job, city_id=3).pk
+        events = "".join(JobStreamView().stream_sse(self.job, last_id=last_id)).split("\n\n")
+        self.assertEqual(events[0], f'event: reading\nid: {last_id + 1}\ndata: {{"city_id":4,"temperature":41.0,"humidity":40}}')
+
+    @override_settings(OPEN_WEATHER_COMPACT_STORAGE='database', OPEN_WEATHER_COMPACT_GRACE=0)
+    def test_stream_resumes_across_compaction(self):
+        """Test that a client reconnecting with a Last-Event-ID got before compaction gets exactly the readings it missed."""
+        def reading_events(last_id=0):
+            self.job.refresh_from_db()
+            chunks = JobStreamView().stream_sse(self.job, last_id=last_id)
+            events = [event.split("\n") for event in "".join(chunks).split("\n\n") if event.startswith("event: reading")]
+            return [(int(event[1][4:]), json.loads(event[2][6:])["city_id"]) for event in events]
+
+        # Stored out of city order, with IDs that are not 1 to 4
+        readings = list(CityReading.objects.filter(job=self.job).order_by('-city_id'))
+        CityReading.objects.filter(job=self.job).delete()
+        for reading in readings:
+            reading.pk = None
+            reading.save()
+
+        before = reading_events()
+        compact_job(self.job)
+        after = reading_events(last_id=before[1][0])
+
+        self.assertEqual([city_id for _, city_id in before], [4, 3, 2, 1])
+        self.assertEqual(after, before[2:])
+        self.assertEqual(reading_events(last_id=before[-1][0]), [])
+
+    def test_unpack_first_version(self):
+        """Test that archives written before they kept row IDs still read, numbered from 1."""
+        arrays = load_arrays('some-id', '')
+        data = HEADER.pack(MAGIC, 1, len(arrays)) + b"".join(
+            (getattr(arrays, name) // 1_000_000 if name == "observed_at" else getattr(arrays, name)).astype(dtype).tobytes()
+            for name, dtype in FIELDS_V1
+        )
+        arrays = unpack(data)
+
+        self.assertEqual(arrays.reading_id.tolist(), [1, 2, 3, 4])
+        self.assertEqual(arrays.rows(['city_id', 'observed_at'])[0], (1, self.observed_at.replace(microsecond=0)))
+
+    @override_settings(OPEN_WEATHER_COMPACT_STORAGE='database', OPEN_WEATHER_COMPACT_GRACE=0)
+    def test_run_job_compacts_when_done(self):
+        """Test that a job collecting every city is compacted by the worker."""
+        job = enqueue_job('other-id', [1, 2])
+        job = claim_next_job('test-worker')
+        with patch('open_weather_api.jobs.collect', responding_collect(lambda city_id: CityResult(city_id, weather(city_id), None))):
+            async_to_sync(run_job)(job)
+        job.refresh_from_db()
+
+        self.assertEqual((job.status, job.archive, job.readings.count()), (WeatherData.DONE, 'database', 0))
+
+
+def build_with_name(response):
+    """Payload builder keeping the city name, for replays."""
+    return dict(PayloadSchema().build([response])[0], name=response["name"])
+
+
+def build_name_only(response):
+    """Payload builder without the fields of a reading, for replays."""
+    return {"city_id": response["id"], "name": response["name"]}
+
+
+class RawArchiveTestCase(TestCase):
+    """Test cases for archiving raw upstream responses and replaying them."""
+
+    def setUp(self):
+        """Point the archive to a temporary directory."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        archive_settings = override_settings(OPEN_WEATHER_RAW_ARCHIVE='gzip', OPEN_WEATHER_RAW_ARCHIVE_DIR=directory.name)
+        archive_settings.enable()
+        self.addCleanup(archive_settings.disable)
+
+    def run_archived_job(self, cities_ids):
+        """Run a job whose upstream responses carry a city name, and return it."""
+        def respond(city_id):
+            response = weather(city_id, name=f"City {city_id}", dt=1700000000)
+            return CityResult(city_id, weather(city_id, dt=1700000000), None, None, response)
+
+        enqueue_job('some-id', cities_ids)
+        job = claim_next_job('test-worker')
+        with patch('open_weather_api.jobs.collect', responding_collect(respond)):
+            async_to_sync(run_job)(job)
+        job.refresh_from_db()
+        return job
+
+    def test_job_archives_raw_responses(self):
+        """Test that a job appends the whole responses it fetched to its segments."""
+        self.run_archived_job([1, 2, 3])
+
+        segments = job_segments('some-id')
+        self.assertEqual(len(segments), 1)
+        self.assertTrue(segments[0].endswith('.ndjson.gz'))
+        self.assertEqual([response["name"] for response in read_segment(segments[0])], ["City 1", "City 2", "City 3"])
+
+    def test_cached_cities_are_archived(self):
+        """Test that cities served from the observation cache are archived whole by the job they serve."""
+        cache = LocalObservationCache(ttl=600)
+        for job_id, cities_ids in [('first', [1, 2]), ('second', [1, 2, 3])]:
+            enqueue_job(job_id, cities_ids)
+            job = claim_next_job('test-worker')
+            with patch('open_weather_api.jobs.collect', responding_collect(lambda city_id: CityResult(city_id, weather(city_id), None, None, weather(city_id, name=f"City {city_id}")))):
+                async_to_sync(run_job)(job, cache=cache)
+
+        job = WeatherData.objects.get(pk='second')
+        self.assertEqual((job.cache_hits, cache.get_many([1])[1]["name"]), (2, "City 1"))
+        self.assertEqual(job.readings.get(city_id=1).extra, {})
+        names = sorted(response["name"] for path in job_segments('second') for response in read_segment(path))
+        self.assertEqual(names, ["City 1", "City 2", "City 3"])
+        CityReading.objects.filter(job=job).delete()
+        self.assertEqual(restore_readings(job), 3)
+
+    def test_segments_rotate_and_survive_truncation(self):
+        """Test that segments are closed after their size and a cut short flush only loses itself."""
+        async def archive():
+            async with RawArchive('some-id', segment_size=2, batch_size=3) as raw:
+                for city_id in range(1, 6):
+                    await raw.add(weather(city_id))
+
+        async_to_sync(archive)()
+        segments = job_segments('some-id')
+        with open(segments[-1], 'ab') as f:
+            f.write(gzip.compress(b'{"id": 6}\n')[:15])
+
+        self.assertEqual(len(segments), 3)
+        self.assertEqual([response["id"] for path in segments for response in read_segment(path)], [1, 2, 3, 4, 5])
+
+    def test_archive_during_slow_flush(self):
+        """Test that responses are archived while a flush holds the thread of the database."""
+        saving, release = threading.Event(), threading.Event()
+
+        def slow_save(*args):
+            saving.set()
+            release.wait(10)
+
+        async def archive_while_saving():
+            loop = asyncio.get_running_loop()
+            async with WriteBehind(None, slow_save, size=1) as buffer:
+                await buffer.add({"city_id": 1})
+                await loop.run_in_executor(None, saving.wait, 5)
+                try:
+                    async with RawArchive('some-id', batch_size=2) as raw:
+                        for city_id in range(1, 4):
+                            await asyncio.wait_for(raw.add(weather(city_id)), 5)
+                    return release.is_set()
+                finally:
+                    release.set()
+
+        self.assertIs(async_to_sync(archive_while_saving)(), False)
+        self.assertEqual([response["id"] for path in job_segments('some-id') for response in read_segment(path)], [1, 2, 3])
+
+    def test_archive_writes_behind(self):
+        """Test that adding responses does not wait for their write until too many are unwritten."""
+        writing, release = threading.Event(), threading.Event()
+        write = RawArchive.write
+
+        def slow_write(raw, lines):
+            writing.set()
+            release.wait(10)
+            write(raw, lines)
+
+        async def archive():
+            async with RawArchive('some-id', batch_size=2, max_pending=4) as raw:
+                for city_id in range(1, 4):
+                    await asyncio.wait_for(raw.add(weather(city_id)), 5)
+                await asyncio.get_running_loop().run_in_executor(None, writing.wait, 5)
+                waiting = asyncio.ensure_future(raw.add(weather(4)))
+                await asyncio.sleep(0.05)
+                blocked = not waiting.done()
+                release.set()
+                await waiting
+                return blocked
+
+        with patch.object(RawArchive, 'write', slow_write):
+            self.assertIs(async_to_sync(archive)(), True)
+        self.assertEqual([response["id"] for path in job_segments('some-id') for response in read_segment(path)], [1, 2, 3, 4])
+
+    def test_restore_missing_readings(self):
+        """Test that a replay stores the readings a job lost and keeps the others."""
+        job = self.run_archived_job([1, 2, 3])
+        CityReading.objects.filter(job=job, city_id__in=[1, 3]).delete()
+        CityReading.objects.filter(job=job, city_id=2).update(temperature=99)
+
+        self.assertEqual(restore_readings(job), 2)
+        readings = dict(job.readings.values_list("city_id", "temperature"))
+        self.assertEqual(readings, {1: 26.85, 2: 99.0, 3: 26.85})
+        self.assertEqual(job.readings.get(city_id=1).observed_at, dt.datetime.fromtimestamp(1700000000, tz=dt.timezone.utc))
+        job.refresh_from_db()
+        self.assertEqual(job.done_cities, 3)
+
+        CityReading.objects.filter(job=job).delete()
+        with self.assertRaises(ReplayError):
+            restore_readings(job, 'open_weather_api.tests.build_name_only')
+
+    def archive_again(self, responses):
+        """Archive another pass of the job, as a resumed job does."""
+        async def archive():
+            async with RawArchive('some-id', segment_size=2) as raw:
+                for response in responses:
+                    await raw.add(response)
+
+        async_to_sync(archive)()
+
+    def test_replay_keeps_last_response_across_segments(self):
+        """Test that a city archived by several passes is replayed once, from its last response."""
+        job = self.run_archived_job([1, 2, 3])
+        self.archive_again([weather(2, main={"temp": 310, "humidity": 50}, dt=1700000600), weather(3, dt=1700000000)])
+        CityReading.objects.filter(job=job).delete()
+
+        self.assertEqual(len(job_segments('some-id')), 2)
+        self.assertEqual(restore_readings(job), 3)
+        readings = dict(job.readings.values_list("city_id", "temperature"))
+        self.assertEqual(readings, {1: 26.85, 2: 36.85, 3: 26.85})
+        job.refresh_from_db()
+        self.assertEqual(job.done_cities, 3)
+
+    def test_rebuild_replaces_stored_readings(self):
+        """Test that a rebuild rewrites the readings a job has and stores those it lost."""
+        job = self.run_archived_job([1, 2, 3])
+        self.archive_again([weather(2, main={"temp": 310, "humidity": 50}, dt=1700000000)])
+        CityReading.objects.filter(job=job, city_id=3).delete()
+        CityReading.objects.filter(job=job, city_id=1).update(temperature=99, extra={"stale": True})
+        rollups = CityRollup.objects.filter(city_id=2).values_list("count", flat=True)
+        counts = list(rollups)  # rebuilt readings were rolled up when first stored
+
+        call_command('replay_weather', 'some-id', '--rebuild', '--processes', '1', stdout=StringIO())
+
+        readings = {row.city_id: (row.temperature, row.humidity, row.extra) for row in job.readings.all()}
+        self.assertEqual(readings, {1: (26.85, 80, {}), 2: (36.85, 50, {}), 3: (26.85, 80, {})})
+        self.assertEqual(list(rollups), counts)
+        job.refresh_from_db()
+        self.assertEqual(job.done_cities, 3)
+
+    def test_replay_command_with_another_builder(self):
+        """Test that replay_weather writes payloads with new fields from the archive alone."""
+        self.run_archived_job([1, 2])
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'replay.ndjson')
+            call_command('replay_weather', 'some-id', '--builder', 'open_weather_api.tests.build_with_name', '--processes', '1', '--output', path, stderr=StringIO())
+            with open(path) as f:
+                payloads = [json.loads(line) for line in f]
+
+        self.assertEqual([(payload["city_id"], payload["name"]) for payload in payloads], [(1, "City 1"), (2, "City 2")])
+        self.assertEqual(payloads[0]["user_defined_id"], "some-id")
+        with self.assertRaises(CommandError):
+            call_command('replay_weather', 'some-id', '--builder', 'open_weather_api.tests.missing', '--processes', '1', stdout=StringIO())
+
+
+def rich_weather(city_id):
+    """Builds an upstream response for `city_id` with wind, pressure and more."""
+    return weather(
+        city_id, name="Recife", wind={"speed": 10, "deg": 90}, coord={"lat": -8.05, "lon": -34.9},
+        main={"temp": 300, "humidity": 80, "pressure": 1012, "feels_like": 305},
+    )
+
+
+class PayloadSchemaTestCase(TestCase):
+    """Test cases for payload schemas and jobs storing other fields and units."""
+
+    def test_build_converts_columns(self):
+        """Test that payloads are built in each units, with None for fields a response lacks."""
+        responses = [project(rich_weather(1)), project(weather(2))]
+
+        self.assertEqual(PayloadSchema().build(responses), [
+            {"city_id": 1, "temperature": 26.85, "humidity": 80},
+            {"city_id": 2, "temperature": 26.85, "humidity": 80},
+        ])
+        payloads = PayloadSchema(["feels_like", "wind_speed", "pressure", "lat"], "imperial").build(responses)
+        self.assertEqual(payloads[0], {
+            "city_id": 1, "temperature": 80.33, "humidity": 80, "feels_like": 89.33, "wind_speed": 22.37, "pressure": 1012, "lat": -8.05,
+        })
+        self.assertEqual(payloads[1]["wind_speed"], None)
+        self.assertEqual(PayloadSchema(["wind_speed"], "standard").build(responses)[0], {"city_id": 1, "temperature": 300.0, "humidity": 80, "wind_speed": 10})
+
+    def test_project_keeps_schema_fields(self):
+        """Test that projection keeps every field a schema can store and drops the rest."""
+        self.assertEqual(project(rich_weather(1)), {
+            "id": 1, "main": {"temp": 300, "humidity": 80, "pressure": 1012, "feels_like": 305},
+            "wind": {"speed": 10, "deg": 90}, "coord": {"lat": -8.05, "lon": -34.9},
+        })
+
+    def test_invalid_schema(self):
+        """Test that unknown fields and units are rejected."""
+        for fields, units in [(["ozone"], None), ("wind_speed", None), ([1], None), ([], "kelvin")]:
+            with self.assertRaises(SchemaError):
+                PayloadSchema(fields, units)
+
+    @override_settings(OPEN_WEATHER_ROLLUP_PERIODS="hour")
+    def test_job_stores_its_schema(self):
+        """Test that a job stores its extra fields and units, while rollups stay in Celsius."""
+        enqueue_job('some-id', [1, 2], fields=["wind_speed", "pressure"], units="imperial")
+        job = claim_next_job('test-worker')
+        with patch('open_weather_api.jobs.collect', responding_collect(lambda city_id: CityResult(city_id, project(rich_weather(city_id)), None))):
+            async_to_sync(run_job)(job)
+
+        reading = CityReading.objects.get(job=job, city_id=1)
+        self.assertEqual((reading.temperature, reading.humidity, reading.extra), (80.33, 80, {"wind_speed": 22.37, "pressure": 1012}))
+        rollup = CityRollup.objects.get(city_id=1)
+        self.assertAlmostEqual(rollup.temperature_sum, 26.85, places=2)
+
+    def test_reads_include_schema_fields(self):
+        """Test that results and streams return the fields of the schema, and results can project them."""
+        factory = RequestFactory()
+        enqueue_job('some-id', [1], fields=["wind_speed"])
+        job = claim_next_job('test-worker')
+        with patch('open_weather_api.jobs.collect', responding_collect(lambda city_id: CityResult(city_id, project(rich_weather(city_id)), None))):
+            async_to_sync(run_job)(job)
+
+        content = json.loads(ResultsView().get(factory.get('/'), 'some-id').content)
+        self.assertEqual(content["units"], "metric")
+        self.assertEqual(content["results"][0]["wind_speed"], 10)
+        content = json.loads(ResultsView().get(factory.get('/', {'fields': 'wind_speed'}), 'some-id').content)
+        self.assertEqual(content["results"], [{"wind_speed": 10}])
+        self.assertEqual(ResultsView().get(factory.get('/', {'fields': 'pressure'}), 'some-id').status_code, 400)
+
+        events = "".join(JobStreamView().stream_sse(job)).split("\n\n")
+        self.assertTrue(events[0].endswith('data: {"city_id":1,"temperature":26.85,"humidity":80,"wind_speed":10}'))
+        export = json.loads(b"".join(export_readings(['some-id'], 'ndjson')))
+        self.assertEqual(export["wind_speed"], 10)
+
+
+class RollupTestCase(TestCase):
+    """Test cases for the hourly and daily rollups of readings."""
+
+    def setUp(self):
+        """Create a job and the readings of two cities over two hours."""
+        self.factory = RequestFactory()
+        self.job = enqueue_job('some-id', [1, 2, 3, 4])
+        start = dt.datetime(2026, 1, 1, 10, tzinfo=dt.timezone.utc)
+        self.readings = [
+            {"city_id": 1, "temperature": 10.0, "humidity": 50, "observed_at": start},
+            {"city_id": 1, "temperature": 14.0, "humidity": 70, "observed_at": start + dt.timedelta(minutes=30)},
+            {"city_id": 1, "temperature": 20.0, "humidity": 40, "observed_at": start + dt.timedelta(hours=1)},
+            {"city_id": 2, "temperature": -5.0, "humidity": 90, "observed_at": start + dt.timedelta(minutes=59)},
+        ]
+
+    def store(self):
+        """Store the readings as three jobs would, each with one reading per city."""
+        for job_id, positions in [('first', [0, 3]), ('second', [1]), ('third', [2])]:
+            save_readings(enqueue_job(job_id, [1, 2]), [self.readings[position] for position in positions])
+
+    def test_aggregate_groups_by_city_and_bucket(self):
+        """Test that a batch is reduced to one group per city and hour."""
+        groups = aggregate(self.readings, 3600)
+
+        self.assertEqual(groups["city_id"].tolist(), [1, 1, 2])
+        self.assertEqual(groups["count"].tolist(), [2, 1, 1])
+        self.assertEqual(groups["temperature_min"].tolist(), [10.0, 20.0, -5.0])
+        self.assertEqual(groups["temperature_max"].tolist(), [14.0, 20.0, -5.0])
+        self.assertEqual(groups["humidity_sum"].tolist(), [120, 40, 90])
+
+    def test_batches_merge_into_rollups(self):
+        """Test that readings stored in several batches add up to the same rollups."""
+        self.store()
+
+        hour = CityRollup.objects.get(period=CityRollup.HOUR, city_id=1, start=self.readings[0]["observed_at"])
+        day = CityRollup.objects.get(period=CityRollup.DAY, city_id=1)
+        self.assertEqual((hour.count, hour.temperature_min, hour.temperature_max, hour.temperature_sum), (2, 10.0, 14.0, 24.0))
+        self.assertEqual((day.count, day.temperature_max, day.humidity_min, day.humidity_sum), (3, 20.0, 40, 160))
+        self.assertEqual(day.start, dt.datetime(2026, 1, 1, tzinfo=dt.timezone.utc))
+        self.assertEqual(CityRollup.objects.count(), 5)
+
+    @override_settings(OPEN_WEATHER_ROLLUP_PERIODS="")
+    def test_rollups_can_be_disabled(self):
+        """Test that no rollup is kept without configured periods."""
+        save_readings(self.job, self.readings)
+
+        self.assertFalse(CityRollup.objects.exists())
+
+    def test_repeated_readings_count_once(self):
+        """Test that a batch saved again, or repeating a city, moves neither the progress nor the rollups."""
+        save_readings(self.job, self.readings[:2])
+        save_readings(self.job, self.readings[:1] + self.readings[3:])
+        self.job.refresh_from_db()
+
+        hour = CityRollup.objects.get(period=CityRollup.HOUR, city_id=1, start=self.readings[0]["observed_at"])
+        self.assertEqual((self.job.done_cities, self.job.readings.count()), (2, 2))
+        self.assertEqual((hour.count, hour.temperature_sum), (1, 10.0))
+
+    def test_shared_observation_rolls_up_once(self):
+        """Test that an observation stored by several jobs, as cached and shared calls do, is rolled up once."""
+        for job_id in ['first', 'second']:
+            save_readings(enqueue_job(job_id, [1]), self.readings[:1])
+
+        self.assertEqual(CityReading.objects.filter(city_id=1).count(), 2)
+        self.assertEqual(CityRollup.objects.get(period=CityRollup.DAY, city_id=1).count, 1)
+
+    def test_rollups_view_pages(self):
+        """Test that the rollups endpoint pages through rollups in city then time order."""
+        self.store()
+        response = RollupsView().get(self.factory.get('/rollups/', {'period': 'hour', 'limit': 2}))
+        content = json.loads(response.content)
+
+        self.assertEqual([(r["city_id"], r["start"]) for r in content["results"]],
+                         [(1, "2026-01-01T10:00:00+00:00"), (1, "2026-01-01T11:00:00+00:00")])
+        self.assertEqual(content["results"][0]["temperature"], {"min": 10.0, "max": 14.0, "avg": 12.0})
+        content = json.loads(RollupsView().get(self.factory.get(content["next"])).content)
+        self.assertEqual([r["city_id"] for r in content["results"]], [2])
+        self.assertIsNone(content["next"])
+
+    def test_rollups_view_filters(self):
+        """Test that rollups filter on city, period start and period."""
+        self.store()
+        get = lambda **params: json.loads(RollupsView().get(self.factory.get('/rollups/', params)).content)
+
+        self.assertEqual(get(period='day', city_id='2')["results"][0]["humidity"]["avg"], 90.0)
+        self.assertEqual(get(city_id='1', start='2026-01-01T10:30:00')["count"], 1)
+        self.assertEqual(get(end='2026-01-01T11:00:00+00:00')["count"], 2)
+        self.assertEqual(RollupsView().get(self.factory.get('/rollups/', {'period': 'week'})).status_code, 400)
+        self.assertEqual(RollupsView().get(self.factory.get('/rollups/', {'start': 'yesterday'})).status_code, 400)
+
+
+class SchedulerTestCase(TestCase):
+    """Test cases for recurring collections."""
+
+    def setUp(self):
+        """Create a city set and a schedule collecting it every 15 minutes."""
+        City.objects.bulk_create(City(id=city_id) for city_id in [1, 2])
+        city_set = CitySet.objects.create(name='capitals')
+        city_set.cities.add(1, 2)
+        self.start = dt.datetime(2026, 1, 1, 10, tzinfo=dt.timezone.utc)
+        CollectionSchedule.objects.create(name='capitals', city_set=city_set, interval=900, next_run_at=self.start)
+
+    def test_due_schedule_enqueues_one_job(self):
+        """Test that a due schedule enqueues one job and moves to its next run."""
+        jobs = run_due_schedules(self.start + dt.timedelta(seconds=1))
+
+        self.assertEqual([job.user_defined_id for job in jobs], ['capitals-20260101T100000'])
+        self.assertEqual(jobs[0].cities_ids, [1, 2])
+        schedule = CollectionSchedule.objects.get()
+        self.assertEqual(schedule.next_run_at, self.start + dt.timedelta(minutes=15))
+        self.assertEqual(schedule.last_job, 'capitals-20260101T100000')
+        self.assertEqual(run_due_schedules(self.start + dt.timedelta(seconds=2)), [])
+
+    def test_missed_runs_are_skipped(self):
+        """Test that a scheduler down for an hour runs once, not once per missed run."""
+        jobs = run_due_schedules(self.start + dt.timedelta(minutes=61))
+
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(CollectionSchedule.objects.get().next_run_at, self.start + dt.timedelta(minutes=75))
+
+    def test_schedule_collection_command(self):
+        """Test that schedule_collection creates, disables and rejects schedules."""
+        call_command('schedule_collection', 'hourly', '--set', 'capitals', '--every', '3600', stdout=StringIO())
+        self.assertEqual(CollectionSchedule.objects.get(name='hourly').interval, 3600)
+
+        call_command('schedule_collection', 'hourly', '--disable', stdout=StringIO())
+        self.assertFalse(CollectionSchedule.objects.get(name='hourly').enabled)
+        with self.assertRaises(CommandError):
+            call_command('schedule_collection', 'other', '--set', 'missing', '--every', '60', stdout=StringIO())
+
+
+class MetricsTestCase(TestCase):
+    """Test cases for the Prometheus metrics."""
+
+    def setUp(self):
+        """Start every test from empty metrics."""
+        for metric in metrics.REGISTRY:
+            metric.clear()
+
+    def test_histogram_exposition(self):
+        """Test that histograms render cumulative buckets, sum and count per label set."""
+        histogram = metrics.Histogram("test_seconds", "Test.", ["kind"], buckets=(0.1, 1), registry=None)
+        for value in [0.05, 0.1, 0.5, 3]:
+            histogram.observe(value, 'a"b')
+
+        self.assertEqual(histogram.render().splitlines(), [
+            "# HELP test_seconds Test.",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{kind="a\\"b",le="0.1"} 2',
+            'test_seconds_bucket{kind="a\\"b",le="1.0"} 3',
+            'test_seconds_bucket{kind="a\\"b",le="+Inf"} 4',
+            'test_seconds_sum{kind="a\\"b"} 3.65',
+            'test_seconds_count{kind="a\\"b"} 4',
+        ])
+
+    def test_collection_is_instrumented(self):
+        """Test that a collection records upstream latency, decoding, sleeps and stored batches."""
+        def handler(request):
+            return httpx.Response(200, json=weather(int(request.url.params["id"])))
+
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        results = list(iter_collect([1, 2, 3], client=client, limiter=TokenBucket(1, 0.01)))
+        job = enqueue_job('some-id', [1, 2, 3])
+        save_responses(job, [result.data for result in results])
+
+        text = metrics.render()
+        self.assertIn('open_weather_upstream_latency_seconds_count{endpoint="weather",outcome="ok"} 3', text)
+        self.assertIn('open_weather_sleep_seconds_count{reason="rate_limit"} 2', text)
+        self.assertIn("open_weather_db_write_seconds_count 1", text)
+        self.assertIn("open_weather_json_decode_seconds_total ", text)
+
+    def test_metrics_view(self):
+        """Test that /metrics serves the process metrics and the job gauges."""
+        enqueue_job('queued-job', [1])
+        enqueue_job('running-job', [1, 2])
+        job = claim_next_job('test-worker')
+        WeatherData.objects.filter(pk=job.pk).update(done_cities=1, failed_cities=1)
+        metrics.CITIES.inc(5, "done")
+
+        response = MetricsView().get(RequestFactory().get('/metrics'))
+        text = response.content.decode()
+
+        self.assertEqual(response["Content-Type"], metrics.CONTENT_TYPE)
+        self.assertIn('open_weather_cities_total{outcome="done"} 5', text)
+        self.assertIn('open_weather_jobs{status="queued"} 1', text)
+        self.assertIn('open_weather_jobs{status="running"} 1', text)
+        self.assertIn(f'open_weather_job_cities{{job="{job.pk}",outcome="failed"}} 1', text)
+
+    @override_settings(OPEN_WEATHER_METRICS=False)
+    def test_metrics_can_be_disabled(self):
+        """Test that disabled metrics record nothing and are not served."""
+        metrics.CITIES.inc(1, "done")
+
+        self.assertNotIn("open_weather_cities_total{", metrics.render())
+        self.assertEqual(MetricsView().get(RequestFactory().get('/metrics')).status_code, 404)
+
+    def test_worker_metrics_server(self):
+        """Test that workers serve their metrics over HTTP."""
+        metrics.WORKER_JOBS.set(2)
+        server = metrics.start_metrics_server(0, "127.0.0.1")
+        self.addCleanup(server.shutdown)
+
+        response = httpx.get(f"http://127.0.0.1:{server.server_address[1]}/metrics")
+
+        self.assertIn("open_weather_worker_jobs 2", response.text)
+
+
+class ProfilingTestCase(TestCase):
+    """Test cases for request profiling and trace spans."""
+
+    def setUp(self):
+        """Save profiles to a temporary directory and start from no spans."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.settings_override = override_settings(OPEN_WEATHER_PROFILE_DIR=directory.name, OPEN_WEATHER_PROFILE_TOKEN='secret')
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.directory = directory.name
+        spans.clear()
+        enqueue_job('some-id', [1, 2])
+
+    def test_profile_with_token(self):
+        """Test that a request with X-Profile and the token is profiled and its profile saved."""
+        response = self.client.get('/progress/some-id/', HTTP_X_PROFILE='1', HTTP_X_PROFILE_TOKEN='secret')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["X-Profile"].endswith("-ProgressView-%d.prof" % os.getpid()))
+        stats = pstats.Stats(os.path.join(self.directory, response["X-Profile"]))
+        self.assertGreater(stats.total_calls, 0)
+
+    def test_profile_requires_authorization(self):
+        """Test that X-Profile is ignored without the token or a staff user, and other views are never profiled."""
+        self.assertNotIn("X-Profile", self.client.get('/progress/some-id/', HTTP_X_PROFILE='1'))
+        self.assertNotIn("X-Profile", self.client.get('/progress/some-id/', HTTP_X_PROFILE='1', HTTP_X_PROFILE_TOKEN='wrong'))
+        response = self.client.get('/progress/some-id/', HTTP_X_PROFILE='1', HTTP_X_PROFILE_TOKEN='sécret')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("X-Profile", response)
+        self.assertNotIn("X-Profile", self.client.get('/results/some-id/', HTTP_X_PROFILE='1', HTTP_X_PROFILE_TOKEN='secret'))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_profile_under_asgi(self):
+        """Test that the middleware runs on the event loop under ASGI and still profiles async views."""
+        async def get_response(request):
+            return None
+
+        self.assertTrue(asyncio.iscoroutinefunction(ProfilingMiddleware(get_response)))
+        self.assertFalse(asyncio.iscoroutinefunction(ProfilingMiddleware(lambda request: None)))
+        with patch('open_weather_api.profiling.sync_to_async', side_effect=AssertionError("moved to a thread")):
+            response = async_to_sync(AsyncClient().get)('/progress/some-id/')
+        self.assertEqual(response.status_code, 200)
+
+        response = async_to_sync(AsyncClient().get)('/progress/some-id/', headers={'X-Profile': '1', 'X-Profile-Token': 'secret'})
+        self.assertTrue(response["X-Profile"].endswith("-ProgressView-%d.prof" % os.getpid()))
+        self.assertGreater(pstats.Stats(os.path.join(self.directory, response["X-Profile"])).total_calls, 0)
+
+    def test_span_recorder(self):
+        """Test that spans are aggregated per stage and the latest ones kept."""
+        recorder = SpanRecorder(size=2)
+        for duration in [0.01, 0.03, 0.02]:
+            recorder.record("fetch", 1700000000.0, duration, job='some-id')
+
+        snapshot = recorder.snapshot()
+        self.assertEqual(snapshot["stages"]["fetch"], {"count": 3, "total_ms": 60.0, "avg_ms": 20.0, "max_ms": 30.0})
+        self.assertEqual([span["duration_ms"] for span in snapshot["recent"]], [20.0, 30.0])
+
+    def test_collection_stages_are_traced(self):
+        """Test that storing readings records a persist span for the job."""
+        job = WeatherData.objects.get(pk='some-id')
+        save_readings(job, [dict(city_id=1, temperature=1.0, humidity=1, observed_at=job.request_datetime)])
+
+        self.assertEqual(spans.snapshot()["recent"][0]["name"], "persist")
+        self.assertEqual(spans.snapshot()["recent"][0]["job"], 'some-id')
+
+    def test_spans_endpoint_is_admin_only(self):
+        """Test that /debug/spans/ lists the spans of every process and the profiles, for staff only."""
+        self.client.get('/progress/some-id/', HTTP_X_PROFILE='1', HTTP_X_PROFILE_TOKEN='secret')
+        SpanSnapshot.objects.create(process='worker:1', updated_at=timezone.now(), spans={"stages": {"fetch": {"count": 1}}, "recent": []})
+
+        self.assertEqual(self.client.get('/debug/spans/').status_code, 403)
+        self.client.force_login(User.objects.create_user('admin', is_staff=True))
+        content = self.client.get('/debug/spans/').json()
+
+        self.assertIn('worker:1', [process["process"] for process in content["processes"]])
+        self.assertEqual(len(content["profiles"]), 1)
+        self.assertEqual(self.client.get(content["profiles"][0]).status_code, 200)
+        self.assertEqual(self.client.get('/debug/profiles/..%2Fsettings.py').status_code, 404)
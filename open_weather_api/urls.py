@@ -1,12 +1,45 @@
 from django.urls import path
 
-from .views import ProgressView, WeatherDataView
+from .views import (
+    ExportView,
+    JobResumeView,
+    JobStreamView,
+    MetricsView,
+    ProfileView,
+    ProgressView,
+    RateLimitView,
+    ResultsView,
+    RollupsView,
+    SpansView,
+    WeatherDataView,
+)
 
 urlpatterns = [
     path("collect/", WeatherDataView.as_view(), name="collect_weather_data"),
+    path(
+        "collect/<str:user_defined_id>/resume/",
+        JobResumeView.as_view(),
+        name="resume_job",
+    ),
+    path(
+        "collect/<str:user_defined_id>/stream/",
+        JobStreamView.as_view(),
+        name="stream_job",
+    ),
     path(
         "progress/<str:user_defined_id>/",
         ProgressView.as_view(),
         name="progress_percentage",
     ),
+    path(
+        "results/<str:user_defined_id>/",
+        ResultsView.as_view(),
+        name="job_results",
+    ),
+    path("rollups/", RollupsView.as_view(), name="rollups"),
+    path("export/", ExportView.as_view(), name="export"),
+    path("metrics", MetricsView.as_view(), name="metrics"),
+    path("debug/spans/", SpansView.as_view(), name="spans"),
+    path("debug/profiles/<str:name>", ProfileView.as_view(), name="profile"),
+    path("ratelimit/", RateLimitView.as_view(), name="rate_limit"),
 ]
@@ -1,115 +1,702 @@
+import asyncio
 import datetime as dt
+import hashlib
 import json
+import os
 import time
 
-import grequests
+from asgiref.sync import markcoroutinefunction, sync_to_async
 from django.conf import settings
-from django.http import JsonResponse, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Count
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponse,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag
 from drf_yasg.utils import swagger_auto_schema
-from more_itertools import chunked
 from rest_framework import status
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from .models import WeatherData
-from .swagger_schemas import get_response, post_request, post_response
+from . import fastjson, metrics
+from .cities import CitySelectionError, city_set_ids, select_cities
+from .collector import get_strategy
+from .compact import filter_arrays, load_arrays, open_archive
+from .export import (
+    ExportError,
+    aiter_chunks,
+    export_content_type,
+    export_filename,
+    export_readings,
+)
+from .jobs import enqueue_job, resume_job, running_jobs
+from .models import CityReading, CityRollup, SpanSnapshot, WeatherData
+from .profiling import (
+    PROCESS,
+    list_profiles,
+    profiled,
+    spans,
+    traced_async_stream,
+    traced_stream,
+)
+from .ratelimit import build_limiter
+from .rollups import rollup_after, rollup_cursor, serialize_rollup
+from .schema import PayloadSchema, SchemaError
+from .swagger_schemas import (
+    export_parameters,
+    get_response,
+    post_request,
+    post_response,
+    rate_limit_response,
+    results_parameters,
+    results_response,
+    rollups_parameters,
+    rollups_response,
+    stream_mode_parameter,
+    stream_response,
+)
 
-API_KEY = settings.OPEN_WEATHER_API_KEY
-URL = "https://api.openweathermap.org/data/2.5/weather?id={city_id}&appid={API_KEY}"
-CITIES_IDS = settings.CITIES_IDS
+PROGRESS_FIELDS = (
+    "status",
+    "started_at",
+    "updated_at",
+    "total_cities",
+    "done_cities",
+    "failed_cities",
+    "cache_hits",
+    "cache_misses",
+    "retried_calls",
+    "throttled_calls",
+)
 
 
-def kelvin_to_celsius(temp):
+def job_handle(job):
     """
-    Converts the temperature from Kelvin to Celsius.
+    Describes where to follow a job that was just enqueued.
     """
-    return round(temp - 273.15, 2)
+    return {
+        "user_defined_id": job.user_defined_id,
+        "status": job.status,
+        "total": job.total_cities,
+        "progress_url": reverse("progress_percentage", args=[job.user_defined_id]),
+        "stream_url": reverse("stream_job", args=[job.user_defined_id]),
+        "results_url": reverse("job_results", args=[job.user_defined_id]),
+    }
 
 
-class WeatherDataView(APIView):
-    def build_payload(self, response):
-        """
-        Constructs the JSON payload in the required format.
-        """
-        return {
-            "city_id": response["id"],
-            "temperature": kelvin_to_celsius(response["main"]["temp"]),
-            "humidity": response["main"]["humidity"],
-        }
+def with_extra(reading):
+    """
+    Moves the fields of the payload schema that a reading read with
+    .values() keeps in `extra` next to its other fields.
+    """
+    reading.update(reading.pop("extra", None) or {})
+    return reading
 
-    def call_weather_api(self, user_defined_id, request_datetime, cities_urls):
-        """
-        Calls the URLS via grequests and returns it as a generator.
-        """
-        yield f'{{"user_defined_id": {json.dumps(user_defined_id)}, "request_datetime": {json.dumps(str(request_datetime))}, "city_info": ['
-        is_first = True
-        for chunk in chunked(cities_urls, 10):
-            if not is_first:
-                yield ","
-            is_first = False
-            start_time = time.time()
-            responses = grequests.map(grequests.get(u) for u in chunk)
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            diff_to_11_seconds = 11 - elapsed_time
-            responses = (response.json() for response in responses if response)
-            responses = [self.build_payload(response) for response in responses]
-            user_defined_object = WeatherData.objects.filter(
-                user_defined_id=user_defined_id
-            ).first()
-            if not user_defined_object:
-                user_defined_object = WeatherData.objects.create(
-                    user_defined_id=user_defined_id,
-                    request_datetime=request_datetime,
-                    city_info={"cities_info": []},
+
+def without_id(data):
+    """
+    The data of an event without the reading ID, which only numbers events.
+    The event's data is left as is: the stream still reads its ID.
+    """
+    return {name: value for name, value in data.items() if name != "id"}
+
+
+def progress(counters):
+    """
+    Computes the progress figures of a job from its stored counters.
+
+    The ETA assumes the job keeps its observed throughput, capped by the
+    configured rate limit since no job can go faster than the quota.
+    """
+    total = counters["total_cities"]
+    processed = counters["done_cities"] + counters["failed_cities"]
+    elapsed = 0
+    if counters["started_at"] and counters["updated_at"]:
+        elapsed = (counters["updated_at"] - counters["started_at"]).total_seconds()
+    throughput = processed / elapsed if elapsed > 0 else 0
+    _, cities_per_call = get_strategy()
+    rate_limit = (
+        settings.OPEN_WEATHER_RATE_LIMIT_CALLS
+        / settings.OPEN_WEATHER_RATE_LIMIT_PERIOD
+        * cities_per_call
+    )
+    remaining = max(0, total - processed)
+    return {
+        "Status": f"{round(processed / total * 100 if total else 0, 2)}%",
+        "state": counters["status"],
+        "total": total,
+        "done": counters["done_cities"],
+        "failed": counters["failed_cities"],
+        "cache_hits": counters["cache_hits"],
+        "cache_misses": counters["cache_misses"],
+        "retried_calls": counters["retried_calls"],
+        "throttled_calls": counters["throttled_calls"],
+        "cities_per_second": round(throughput, 2),
+        "eta_seconds": round(remaining / min(throughput or rate_limit, rate_limit), 1),
+    }
+
+
+class AsyncAPIView(APIView):
+    """
+    APIView whose handlers are coroutines, so under ASGI its requests run on
+    the event loop instead of holding a thread each. Authentication,
+    permissions and throttling are still synchronous and run in a thread.
+    """
+
+    view_is_async = True
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # csrf_exempt wraps the view in a plain function, hiding that it is
+        # a coroutine function from the handler
+        return markcoroutinefunction(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+            handler = self.http_method_not_allowed
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(
+                    self, request.method.lower(), self.http_method_not_allowed
                 )
-            user_defined_object.city_info["cities_info"].extend(responses)
-            user_defined_object.save()
-            yield ",".join(json.dumps(response) for response in responses)
-            time.sleep(max(0, diff_to_11_seconds))
-        yield "]}"
+            response = handler(request, *args, **kwargs)
+            # OPTIONS is answered by APIView's synchronous handler
+            if asyncio.iscoroutine(response):
+                response = await response
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
 
-    @swagger_auto_schema(request_body=post_request(), responses={200: post_response()})
-    def post(self, request):
+@profiled
+class WeatherDataView(AsyncAPIView):
+    @swagger_auto_schema(request_body=post_request(), responses={202: post_response()})
+    async def post(self, request):
         if request.method == "POST":
             try:
-                req = json.loads(request.body)
+                req = fastjson.loads(request.body)
             except json.JSONDecodeError:
                 return JsonResponse({"status": "error", "message": "Invalid JSON"}, status=400)
             user_defined_id = req.get("user_defined_id")
             if not user_defined_id:
                 return JsonResponse({"Error": "User ID not provided"}, status=400)
-            check_user_exists = WeatherData.objects.filter(
+            check_user_exists = await WeatherData.objects.filter(
                 user_defined_id=user_defined_id
-            ).first()
+            ).afirst()
             if check_user_exists:
                 return JsonResponse({"Error": "User ID already exists"}, status=400)
-            request_datetime = dt.datetime.now()
-            cities_urls = (
-                URL.format(city_id=city_id, API_KEY=API_KEY) for city_id in CITIES_IDS
+            try:
+                schema = PayloadSchema(req.get("fields"), req.get("units"))
+                cities_ids = await sync_to_async(select_cities)(req)
+            except (SchemaError, CitySelectionError) as exc:
+                return JsonResponse({"Error": str(exc)}, status=400)
+            job = await sync_to_async(enqueue_job)(
+                str(user_defined_id), cities_ids, schema.fields, schema.units
+            )
+            return JsonResponse(job_handle(job), status=status.HTTP_202_ACCEPTED)
+        else:
+            return JsonResponse({"Error": "Method not allowed."}, status=400)
+
+
+class JobResumeView(APIView):
+    @swagger_auto_schema(
+        operation_description="Queues an interrupted or failed job again, fetching only the missing cities",
+        responses={202: post_response()},
+    )
+    def post(self, request, user_defined_id):
+        job = WeatherData.objects.filter(user_defined_id=user_defined_id).first()
+        if not job:
+            return JsonResponse(
+                {
+                    "user_defined_id": user_defined_id,
+                    "Status": "User ID not found.",
+                },
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        if not resume_job(job):
+            return JsonResponse(
+                {"Error": "Job is still running or has no cities left to fetch"},
+                status=status.HTTP_409_CONFLICT,
+            )
+        job.refresh_from_db()
+        return JsonResponse(job_handle(job), status=status.HTTP_202_ACCEPTED)
+
+
+class JobStreamView(AsyncAPIView):
+    # Stream formats, picked with ?mode= or else from the Accept header
+    FORMATS = {
+        "sse": "text/event-stream",
+        "ndjson": "application/x-ndjson",
+        "legacy": "application/json",
+    }
+
+    def perform_content_negotiation(self, request, force=False):
+        # The stream picks its own format, which DRF's renderers don't know
+        return super().perform_content_negotiation(request, force=True)
+
+    def stream_format(self, request):
+        mode = request.GET.get("mode")
+        if mode:
+            return mode if mode in self.FORMATS else None
+        accept = request.headers.get("Accept", "")
+        for name, content_type in self.FORMATS.items():
+            if content_type in accept:
+                return name
+        return "sse"
+
+    def poll_events(self, counters, readings):
+        """
+        Returns the (event, data) pairs of one poll of the job: a "reading"
+        per new city, then a "progress" if there was news and an "end" once
+        the job is finished.
+        """
+        events = [("reading", with_extra(reading)) for reading in readings]
+        finished = counters["status"] in WeatherData.FINISHED_STATUSES
+        if readings or finished:
+            events.append(("progress", progress(counters)))
+        if finished:
+            events.append(("end", {"state": counters["status"]}))
+        return events
+
+    def archived_events(self, counters, arrays, last_id=0):
+        """
+        Events of a compacted job, which is done: its readings after `last_id`
+        in the order they were stored, with the IDs of their rows, so clients
+        resume with Last-Event-ID across compaction.
+        """
+        columns = arrays.stored_after(last_id).columns(
+            ("reading_id", "city_id", "temperature", "humidity")
+        )
+        for reading_id, city_id, temperature, humidity in zip(*columns):
+            yield "reading", {
+                "id": reading_id,
+                "city_id": city_id,
+                "temperature": temperature,
+                "humidity": humidity,
+            }
+        yield from self.poll_events(counters, [])
+
+    def job_events(self, job, last_id=0):
+        """
+        Tails a job as the worker stores its readings and yields (event, data)
+        pairs until the job is finished, with a "heartbeat" after
+        OPEN_WEATHER_STREAM_HEARTBEAT seconds without news.
+        """
+        if job.archive:
+            counters = (
+                WeatherData.objects.filter(pk=job.pk).values(*PROGRESS_FIELDS).first()
             )
-            # Using StreamingHttpResponse to avoid timeout
-            response = StreamingHttpResponse(
-                self.call_weather_api(user_defined_id, request_datetime, cities_urls),
-                status=200,
-                content_type="text/event-stream",
+            arrays = load_arrays(job.pk, job.archive)
+            yield from self.archived_events(counters, arrays, last_id)
+            return
+        last_event = time.monotonic()
+        while True:
+            # Read before the readings so rows stored right before the job
+            # finished are still picked up by this iteration.
+            counters = (
+                WeatherData.objects.filter(pk=job.pk).values(*PROGRESS_FIELDS).first()
             )
-            response["Cache-Control"] = "no-cache"
+            readings = list(
+                job.readings.filter(id__gt=last_id)
+                .order_by("id")
+                .values("id", "city_id", "temperature", "humidity", "extra")
+            )
+            events = self.poll_events(counters, readings)
+            yield from events
+            if readings:
+                last_id = readings[-1]["id"]
+            if events:
+                last_event = time.monotonic()
+                if events[-1][0] == "end":
+                    return
+                continue
+            if time.monotonic() - last_event >= settings.OPEN_WEATHER_STREAM_HEARTBEAT:
+                yield "heartbeat", {}
+                last_event = time.monotonic()
+            metrics.SLEEP_SECONDS.observe(
+                settings.OPEN_WEATHER_STREAM_POLL_INTERVAL, "stream_poll"
+            )
+            time.sleep(settings.OPEN_WEATHER_STREAM_POLL_INTERVAL)
+
+    async def ajob_events(self, job, last_id=0):
+        """
+        `job_events` with async queries and sleeps, so a stream served under
+        ASGI only holds the event loop while it reads the database.
+        """
+        if job.archive:
+            counters = (
+                await WeatherData.objects.filter(pk=job.pk)
+                .values(*PROGRESS_FIELDS)
+                .afirst()
+            )
+            arrays = await sync_to_async(load_arrays)(job.pk, job.archive)
+            for event in self.archived_events(counters, arrays, last_id):
+                yield event
+            return
+        last_event = time.monotonic()
+        while True:
+            counters = (
+                await WeatherData.objects.filter(pk=job.pk)
+                .values(*PROGRESS_FIELDS)
+                .afirst()
+            )
+            readings = [
+                reading
+                async for reading in job.readings.filter(id__gt=last_id)
+                .order_by("id")
+                .values("id", "city_id", "temperature", "humidity", "extra")
+            ]
+            events = self.poll_events(counters, readings)
+            for event in events:
+                yield event
+            if readings:
+                last_id = readings[-1]["id"]
+            if events:
+                last_event = time.monotonic()
+                if events[-1][0] == "end":
+                    return
+                continue
+            if time.monotonic() - last_event >= settings.OPEN_WEATHER_STREAM_HEARTBEAT:
+                yield "heartbeat", {}
+                last_event = time.monotonic()
+            metrics.SLEEP_SECONDS.observe(
+                settings.OPEN_WEATHER_STREAM_POLL_INTERVAL, "stream_poll"
+            )
+            await asyncio.sleep(settings.OPEN_WEATHER_STREAM_POLL_INTERVAL)
+
+    def sse_chunk(self, event, data):
+        """
+        Server-sent events; reading IDs let clients reconnect with
+        Last-Event-ID and pick up where they left off.
+        """
+        if event == "heartbeat":
+            return ": heartbeat\n\n"
+        event_id = f"id: {data['id']}\n" if event == "reading" else ""
+        return f"event: {event}\n{event_id}data: {fastjson.dumps(without_id(data))}\n\n"
+
+    def ndjson_chunk(self, event, data):
+        return fastjson.dumps({"event": event, **without_id(data)}) + "\n"
 
+    def legacy_head(self, job):
+        """
+        The legacy mode streams the whole job as a single JSON document, as
+        returned before streaming events existed.
+        """
+        return f'{{"user_defined_id":{fastjson.dumps(job.user_defined_id)},"request_datetime":{fastjson.dumps(str(job.request_datetime))},"city_info":['
+
+    def legacy_chunk(self, data, is_first):
+        data = fastjson.dumps(without_id(data))
+        return data if is_first else "," + data
+
+    def stream_sse(self, job, last_id=0):
+        for event, data in self.job_events(job, last_id):
+            yield self.sse_chunk(event, data)
+
+    def stream_ndjson(self, job, last_id=0):
+        for event, data in self.job_events(job, last_id):
+            yield self.ndjson_chunk(event, data)
+
+    def stream_legacy(self, job, last_id=0):
+        yield self.legacy_head(job)
+        is_first = True
+        for event, data in self.job_events(job, last_id):
+            if event == "reading":
+                yield self.legacy_chunk(data, is_first)
+                is_first = False
+        yield "]}"
+
+    async def astream_sse(self, job, last_id=0):
+        async for event, data in self.ajob_events(job, last_id):
+            yield self.sse_chunk(event, data)
+
+    async def astream_ndjson(self, job, last_id=0):
+        async for event, data in self.ajob_events(job, last_id):
+            yield self.ndjson_chunk(event, data)
+
+    async def astream_legacy(self, job, last_id=0):
+        yield self.legacy_head(job)
+        is_first = True
+        async for event, data in self.ajob_events(job, last_id):
+            if event == "reading":
+                yield self.legacy_chunk(data, is_first)
+                is_first = False
+        yield "]}"
+
+    @swagger_auto_schema(
+        operation_description=(
+            "Attaches to a job and streams its readings as they are collected, "
+            "as server-sent events (default), NDJSON or the legacy JSON document"
+        ),
+        manual_parameters=[stream_mode_parameter()],
+        responses={200: stream_response()},
+    )
+    async def get(self, request, user_defined_id):
+        job = await WeatherData.objects.filter(user_defined_id=user_defined_id).afirst()
+        if not job:
+            return JsonResponse(
+                {
+                    "user_defined_id": user_defined_id,
+                    "Status": "User ID not found.",
+                },
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        stream_format = self.stream_format(request)
+        if stream_format is None:
+            return JsonResponse(
+                {"Error": f"Unknown mode, expected one of {', '.join(self.FORMATS)}"},
+                status=400,
+            )
+        last_id = request.headers.get("Last-Event-ID", "0")
+        last_id = int(last_id) if last_id.isdigit() else 0
+        # Under WSGI (e.g. gunicorn's gevent workers) the body must be a
+        # plain iterator, or Django would read the whole stream before
+        # sending any of it.
+        if isinstance(getattr(request, "_request", request), ASGIRequest):
+            stream = getattr(self, f"astream_{stream_format}")
+            chunks = metrics.timed_async_stream(
+                traced_async_stream(stream(job, last_id), "stream", job.pk),
+                metrics.STREAM_FLUSH_SECONDS,
+                stream_format,
+            )
+        else:
+            stream = getattr(self, f"stream_{stream_format}")
+            chunks = metrics.timed_stream(
+                traced_stream(stream(job, last_id), "stream", job.pk),
+                metrics.STREAM_FLUSH_SECONDS,
+                stream_format,
+            )
+        response = StreamingHttpResponse(
+            chunks, status=200, content_type=self.FORMATS[stream_format]
+        )
+        response["Cache-Control"] = "no-cache"
+        # Keeps nginx and similar proxies from buffering the events
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+
+class ResultsView(APIView):
+    FIELDS = ("city_id", "temperature", "humidity", "observed_at")
+    # Query parameter: lookup on CityReading
+    RANGE_FILTERS = {
+        "temperature_min": "temperature__gte",
+        "temperature_max": "temperature__lte",
+        "humidity_min": "humidity__gte",
+        "humidity_max": "humidity__lte",
+    }
+
+    def etag(self, job, request):
+        """
+        Changes whenever the job stores readings or changes state, and with
+        the query, so clients can revalidate any page of any job.
+        """
+        version = (
+            f"{job['user_defined_id']}:{job['status']}:{job['updated_at']}:"
+            f"{job['done_cities']}:{request.GET.urlencode()}"
+        )
+        return quote_etag(hashlib.md5(version.encode()).hexdigest())
+
+    def parse_query(self, params, extra_fields=()):
+        """
+        Returns the fields, reading filters, cursor and page size requested
+        by the query string, where the fields are FIELDS and the
+        `extra_fields` of the job's payload schema. Raises ValueError with a
+        message for the client.
+        """
+        available = [*self.FIELDS, *extra_fields]
+        fields = params.get("fields")
+        fields = fields.split(",") if fields else available
+        unknown = set(fields) - set(available)
+        if unknown:
+            raise ValueError(
+                f"Unknown fields {', '.join(sorted(unknown))}, "
+                f"expected {', '.join(available)}"
+            )
+        filters = {}
+        try:
+            if params.get("city_id"):
+                filters["city_id__in"] = [
+                    int(city_id) for city_id in params["city_id"].split(",")
+                ]
+            for param, lookup in self.RANGE_FILTERS.items():
+                if params.get(param):
+                    filters[lookup] = float(params[param])
+            cursor = int(params.get("cursor", 0))
+            limit = int(params.get("limit", settings.OPEN_WEATHER_RESULTS_PAGE_SIZE))
+        except ValueError:
+            raise ValueError(
+                "city_id, cursor and limit must be integers and ranges numbers"
+            )
+        limit = max(1, min(limit, settings.OPEN_WEATHER_RESULTS_MAX_PAGE_SIZE))
+        return fields, filters, cursor, limit
+
+    @swagger_auto_schema(
+        operation_description=(
+            "Pages through the readings of a job in city ID order. Responses "
+            "carry an ETag; send it back in If-None-Match to get a 304 while "
+            "the job has not changed"
+        ),
+        manual_parameters=results_parameters(),
+        responses={200: results_response()},
+    )
+    def get(self, request, user_defined_id):
+        job = (
+            WeatherData.objects.filter(user_defined_id=user_defined_id)
+            .values(
+                "user_defined_id",
+                "status",
+                "updated_at",
+                "total_cities",
+                "done_cities",
+                "archive",
+                "payload_fields",
+                "units",
+            )
+            .first()
+        )
+        if not job:
+            return JsonResponse(
+                {
+                    "user_defined_id": user_defined_id,
+                    "Status": "User ID not found.",
+                },
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        etag = self.etag(job, request)
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+            response["ETag"] = etag
             return response
+        try:
+            fields, filters, cursor, limit = self.parse_query(
+                request.GET, job["payload_fields"]
+            )
+        except ValueError as exc:
+            return JsonResponse({"Error": str(exc)}, status=400)
+
+        # Keyset pagination on the (job, city_id) unique index: every page
+        # costs the same however deep it is, and only the page is loaded.
+        columns = ["city_id", *(field for field in self.FIELDS[1:] if field in fields)]
+        if set(fields) - set(columns):
+            columns.append("extra")
+        if job["archive"]:
+            # Compacted jobs are sorted arrays: the cursor is a binary search
+            # and only the arrays' ranges the page spans are read
+            arrays = open_archive(user_defined_id, job["archive"])
+            rows = filter_arrays(arrays, cursor, filters, limit + 1).rows(columns)
         else:
-            return JsonResponse({"Error": "Method not allowed."}, status=400)
+            rows = list(
+                CityReading.objects.filter(
+                    job_id=user_defined_id, city_id__gt=cursor, **filters
+                )
+                .order_by("city_id")
+                .values_list(*columns)[: limit + 1]
+            )
+        has_next = len(rows) > limit
+        rows = rows[:limit]
+        results = []
+        for row in rows:
+            reading = with_extra(dict(zip(columns, row)))
+            if "observed_at" in reading:
+                reading["observed_at"] = reading["observed_at"].isoformat()
+            results.append({field: reading[field] for field in fields})
+        next_url = None
+        if has_next:
+            query = request.GET.copy()
+            query["cursor"] = rows[-1][0]
+            next_url = f"{request.path}?{query.urlencode()}"
+        response = HttpResponse(
+            fastjson.dumps(
+                {
+                    "user_defined_id": job["user_defined_id"],
+                    "status": job["status"],
+                    "units": job["units"],
+                    "total": job["total_cities"],
+                    "count": len(results),
+                    "next": next_url,
+                    "results": results,
+                }
+            ),
+            content_type="application/json",
+        )
+        response["ETag"] = etag
+        return response
+
 
+class ExportView(AsyncAPIView):
+    def perform_content_negotiation(self, request, force=False):
+        # `format` selects the export format, not a DRF renderer
+        return super().perform_content_negotiation(request, force=True)
 
-class ProgressView(APIView):
+    @swagger_auto_schema(
+        operation_description=(
+            "Downloads the readings of one or many jobs as NDJSON, CSV, Parquet "
+            "or an Arrow stream, optionally compressed. The file is streamed "
+            "while it is read from the database"
+        ),
+        manual_parameters=export_parameters(),
+        responses={200: "The exported file"},
+    )
+    async def get(self, request):
+        jobs_ids = [job for job in request.GET.get("jobs", "").split(",") if job]
+        if not jobs_ids:
+            return JsonResponse({"Error": "jobs not provided"}, status=400)
+        found = {
+            job
+            async for job in WeatherData.objects.filter(
+                user_defined_id__in=jobs_ids
+            ).values_list("user_defined_id", flat=True)
+        }
+        missing = [job for job in jobs_ids if job not in found]
+        if missing:
+            return JsonResponse(
+                {"user_defined_id": missing, "Status": "User ID not found."},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        export_format = request.GET.get("format", "ndjson")
+        compression = request.GET.get("compression") or None
+        try:
+            chunks = await sync_to_async(export_readings)(
+                jobs_ids, export_format, compression
+            )
+        except ExportError as exc:
+            return JsonResponse({"Error": str(exc)}, status=400)
+        # As for streams, WSGI servers need a plain iterator
+        if isinstance(getattr(request, "_request", request), ASGIRequest):
+            chunks = aiter_chunks(chunks)
+        response = StreamingHttpResponse(
+            chunks, content_type=export_content_type(export_format, compression)
+        )
+        response["Content-Disposition"] = (
+            f'attachment; filename="{export_filename(export_format, compression)}"'
+        )
+        return response
+
+
+@profiled
+class ProgressView(AsyncAPIView):
     @swagger_auto_schema(
         operation_description="Endpoint to check the progress of the POST operation",
         responses={200: get_response()},
     )
-    def get(self, request, user_defined_id):
-        user_defined_id_info = WeatherData.objects.filter(
-            user_defined_id=user_defined_id
-        ).first()
+    async def get(self, request, user_defined_id):
+        user_defined_id_info = (
+            await WeatherData.objects.filter(user_defined_id=user_defined_id)
+            .values(*PROGRESS_FIELDS)
+            .afirst()
+        )
         if not user_defined_id_info:
             return JsonResponse(
                 {
@@ -118,12 +705,198 @@ class ProgressView(APIView):
                 },
                 status=status.HTTP_404_NOT_FOUND,
             )
-        user_defined_id_progress = len(
-            user_defined_id_info.city_info["cities_info"]
-        ) / len(CITIES_IDS)
+        return JsonResponse(
+            {"user_defined_id": user_defined_id, **progress(user_defined_id_info)}
+        )
+
+
+class RollupsView(APIView):
+    def parse_query(self, params):
+        """
+        Returns the period, rollup filters, cursor and page size requested by
+        the query string. Raises ValueError with a message for the client.
+        """
+        period = params.get("period", CityRollup.HOUR)
+        if period not in CityRollup.PERIOD_SECONDS:
+            raise ValueError(
+                f"Unknown period {period!r}, expected "
+                f"{', '.join(CityRollup.PERIOD_SECONDS)}"
+            )
+        filters = {"period": period}
+        try:
+            if params.get("city_id"):
+                filters["city_id__in"] = [
+                    int(city_id) for city_id in params["city_id"].split(",")
+                ]
+            limit = int(params.get("limit", settings.OPEN_WEATHER_RESULTS_PAGE_SIZE))
+        except ValueError:
+            raise ValueError("city_id and limit must be integers")
+        if params.get("city_set"):
+            cities_ids = city_set_ids(params["city_set"])
+            if cities_ids is None:
+                raise ValueError(f"Unknown city set {params['city_set']!r}")
+            filters["city_id__in"] = cities_ids
+        for param, lookup in (("start", "start__gte"), ("end", "start__lt")):
+            if params.get(param):
+                try:
+                    filters[lookup] = dt.datetime.fromisoformat(params[param])
+                except ValueError:
+                    raise ValueError(f"{param} must be an ISO 8601 datetime")
+                if timezone.is_naive(filters[lookup]):
+                    filters[lookup] = timezone.make_aware(filters[lookup], dt.timezone.utc)
+        cursor = params.get("cursor")
+        if cursor:
+            try:
+                cursor = rollup_after(cursor)
+            except ValueError:
+                raise ValueError("Invalid cursor")
+        limit = max(1, min(limit, settings.OPEN_WEATHER_RESULTS_MAX_PAGE_SIZE))
+        return filters, cursor, limit
+
+    @swagger_auto_schema(
+        operation_description=(
+            "Hourly or daily min, max and average temperature and humidity "
+            "per city, precomputed as readings are stored. Pages follow city "
+            "ID then time order"
+        ),
+        manual_parameters=rollups_parameters(),
+        responses={200: rollups_response()},
+    )
+    def get(self, request):
+        try:
+            filters, cursor, limit = self.parse_query(request.GET)
+        except ValueError as exc:
+            return JsonResponse({"Error": str(exc)}, status=400)
+
+        rollups = CityRollup.objects.filter(**filters)
+        if cursor:
+            rollups = rollups.filter(cursor)
+        # Keyset pagination on the (period, city_id, start) unique index
+        rows = list(rollups.order_by("city_id", "start")[: limit + 1])
+        has_next = len(rows) > limit
+        rows = rows[:limit]
+        next_url = None
+        if has_next:
+            query = request.GET.copy()
+            query["cursor"] = rollup_cursor(rows[-1])
+            next_url = f"{request.path}?{query.urlencode()}"
+        return HttpResponse(
+            fastjson.dumps(
+                {
+                    "period": filters["period"],
+                    "count": len(rows),
+                    "next": next_url,
+                    "results": [serialize_rollup(row) for row in rows],
+                }
+            ),
+            content_type="application/json",
+        )
+
+
+class MetricsView(APIView):
+    def perform_content_negotiation(self, request, force=False):
+        # Scrapers ask for the Prometheus text format, not a DRF renderer
+        return super().perform_content_negotiation(request, force=True)
+
+    def job_metrics(self):
+        """
+        Job gauges read from the database, so they hold for every worker:
+        jobs per status and the cities done and failed of the running ones.
+        """
+        jobs = metrics.Gauge(
+            "open_weather_jobs", "Jobs per status.", ["status"], registry=None
+        )
+        for status_name, _ in WeatherData.STATUS_CHOICES:
+            jobs.set(0, status_name)
+        for row in WeatherData.objects.values("status").annotate(count=Count("pk")):
+            jobs.set(row["count"], row["status"])
+        cities = metrics.Gauge(
+            "open_weather_job_cities",
+            "Cities done and failed so far by each running job.",
+            ["job", "outcome"],
+            registry=None,
+        )
+        running = WeatherData.objects.filter(status=WeatherData.RUNNING).values_list(
+            "user_defined_id", "done_cities", "failed_cities"
+        )
+        for job, done, failed in running:
+            cities.set(done, job, "done")
+            cities.set(failed, job, "failed")
+        return f"{jobs.render()}\n{cities.render()}\n"
+
+    @swagger_auto_schema(
+        operation_description=(
+            "Metrics of the web process and of the jobs in the Prometheus "
+            "text format. Workers serve theirs on OPEN_WEATHER_METRICS_PORT"
+        ),
+        responses={200: "Prometheus text exposition format", 404: "Metrics are disabled"},
+    )
+    def get(self, request):
+        if not metrics.enabled():
+            return JsonResponse({"Error": "Metrics are disabled"}, status=404)
+        return HttpResponse(
+            metrics.render() + self.job_metrics(), content_type=metrics.CONTENT_TYPE
+        )
+
+
+class SpansView(APIView):
+    permission_classes = [IsAdminUser]
+
+    @swagger_auto_schema(
+        operation_description=(
+            "Admin only. Span timings of the fetch, parse, persist and stream "
+            "stages per process, and the saved request profiles"
+        ),
+        responses={200: "Spans per process and profile names", 403: "Not an admin"},
+    )
+    def get(self, request):
+        processes = {PROCESS: {"updated_at": timezone.now(), "spans": spans.snapshot()}}
+        for snapshot in SpanSnapshot.objects.exclude(process=PROCESS).order_by(
+            "-updated_at"
+        ):
+            processes[snapshot.process] = {
+                "updated_at": snapshot.updated_at,
+                "spans": snapshot.spans,
+            }
         return JsonResponse(
             {
-                "user_defined_id": user_defined_id,
-                "Status": f"{round(user_defined_id_progress*100,2)}%",
+                "processes": [
+                    {
+                        "process": process,
+                        "updated_at": data["updated_at"].isoformat(),
+                        **data["spans"],
+                    }
+                    for process, data in processes.items()
+                ],
+                "profiles": [
+                    reverse("profile", args=[name]) for name in list_profiles()
+                ],
             }
         )
+
+
+class ProfileView(APIView):
+    permission_classes = [IsAdminUser]
+
+    @swagger_auto_schema(
+        operation_description="Admin only. Downloads a saved request profile",
+        responses={200: "cProfile stats or a pyinstrument HTML report"},
+    )
+    def get(self, request, name):
+        # Only names listed from the profile directory, never a path
+        if name not in list_profiles():
+            raise Http404
+        return FileResponse(
+            open(os.path.join(settings.OPEN_WEATHER_PROFILE_DIR, name), "rb"),
+            as_attachment=True,
+            filename=name,
+        )
+
+
+class RateLimitView(APIView):
+    @swagger_auto_schema(
+        operation_description="Current use of the upstream quota shared by the workers",
+        responses={200: rate_limit_response()},
+    )
+    def get(self, request):
+        return JsonResponse({**build_limiter().stats(), "running_jobs": running_jobs()})
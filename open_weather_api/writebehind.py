@@ -0,0 +1,126 @@
+"""
+Write-behind persistence of the readings of a job pass: results are
+buffered in memory and saved by a background task, one transaction per
+flush, so fetching the next cities never waits on the database.
+"""
+
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+
+class WriteBehind:
+    """
+    Buffers the readings and counters of a job and saves them with `save`
+    (jobs.save_responses, or jobs.save_readings) once
+    OPEN_WEATHER_BATCH_SIZE cities are pending or every
+    OPEN_WEATHER_FLUSH_INTERVAL seconds, whichever comes first.
+
+    Adding only waits when OPEN_WEATHER_WRITE_BUFFER_MAX cities are pending,
+    i.e. when the database cannot keep up. Use it as an async context
+    manager: leaving it, also on errors and cancellation, flushes whatever
+    is left.
+    """
+
+    def __init__(self, job, save, stats=None, size=None, interval=None, max_pending=None):
+        self.job = job
+        self.save = save
+        self.stats = stats
+        self.size = size or settings.OPEN_WEATHER_BATCH_SIZE
+        self.interval = interval or settings.OPEN_WEATHER_FLUSH_INTERVAL
+        self.max_pending = max_pending or settings.OPEN_WEATHER_WRITE_BUFFER_MAX
+        self.readings = []
+        self.failed_count = 0
+        self.pending = 0
+        self.saved_retries = 0
+        self.saved_throttled = 0
+        self.flushes = 0
+        self.error = None
+        self.closed = False
+        self.lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.task = None
+
+    async def __aenter__(self):
+        self.task = asyncio.ensure_future(self.run())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        # Lets a flush in progress finish rather than cancelling it midway
+        self.closed = True
+        self.wakeup.set()
+        await self.task
+        await self.flush()
+
+    async def add(self, reading=None, failed=0):
+        """
+        Buffers a city: its `reading` when it was fetched, and how it moves
+        the job's failed counter.
+        """
+        if self.error is not None:
+            raise self.error
+        if reading is not None:
+            self.readings.append(reading)
+        self.failed_count += failed
+        self.pending += 1
+        if self.pending >= self.size:
+            self.wakeup.set()
+        while self.pending >= self.max_pending and self.error is None:
+            self.drained.clear()
+            await self.drained.wait()
+
+    def counters_changed(self):
+        return self.stats is not None and (
+            self.stats.retries > self.saved_retries
+            or self.stats.throttled > self.saved_throttled
+        )
+
+    async def flush(self):
+        """
+        Saves everything buffered so far in one transaction. A failed save
+        puts the batch back, so the final flush retries it.
+        """
+        async with self.lock:
+            if not self.pending and not self.counters_changed():
+                return
+            readings, failed_count, pending = self.readings, self.failed_count, self.pending
+            self.readings, self.failed_count, self.pending = [], 0, 0
+            retries = self.stats.retries if self.stats else 0
+            throttled = self.stats.throttled if self.stats else 0
+            try:
+                await sync_to_async(self.save)(
+                    self.job,
+                    readings,
+                    failed_count,
+                    retries - self.saved_retries,
+                    throttled - self.saved_throttled,
+                )
+            except Exception:
+                self.readings[:0] = readings
+                self.failed_count += failed_count
+                self.pending += pending
+                raise
+            finally:
+                self.drained.set()
+            self.saved_retries = retries
+            self.saved_throttled = throttled
+            self.flushes += 1
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            if self.closed:
+                return
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as exc:
+                # Surfaced by the next add(); the final flush retries it
+                self.error = exc
+                self.drained.set()
+                return
@@ -20,10 +20,6 @@ load_dotenv()
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
-with open("cities_id_list.txt", "r") as f:
-    CITIES_IDS = f.read()
-    CITIES_IDS = CITIES_IDS.split(",")
-
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/4.2/howto/deployment/checklist/
@@ -32,6 +28,179 @@ with open("cities_id_list.txt", "r") as f:
 # SECRET_KEY = "django-insecure-g$p38*u3aqr3^jqrk(jnc1wnr(2gi7#**tcu_tbqmh*d5bbr@)"
 SECRET_KEY = os.getenv("SECRET_KEY")
 OPEN_WEATHER_API_KEY = os.getenv("OPEN_WEATHER_API_KEY")
+OPEN_WEATHER_API_URL = os.getenv(
+    "OPEN_WEATHER_API_URL", "https://api.openweathermap.org/data/2.5"
+)
+
+# Upstream quota: at most RATE_LIMIT_CALLS requests every RATE_LIMIT_PERIOD
+# seconds (the free tier allows 60 calls per minute).
+OPEN_WEATHER_RATE_LIMIT_CALLS = int(os.getenv("OPEN_WEATHER_RATE_LIMIT_CALLS", "10"))
+OPEN_WEATHER_RATE_LIMIT_PERIOD = float(
+    os.getenv("OPEN_WEATHER_RATE_LIMIT_PERIOD", "11")
+)
+# Where the quota is tracked: DatabaseRateLimiter shares it between every
+# worker using the database, FileRateLimiter between the processes of one host
+# (in OPEN_WEATHER_RATE_LIMIT_FILE) and TokenBucket only within a process.
+OPEN_WEATHER_RATE_LIMIT_BACKEND = os.getenv(
+    "OPEN_WEATHER_RATE_LIMIT_BACKEND", "open_weather_api.ratelimit.DatabaseRateLimiter"
+)
+OPEN_WEATHER_RATE_LIMIT_FILE = os.getenv(
+    "OPEN_WEATHER_RATE_LIMIT_FILE", "/tmp/open_weather_ratelimit_{name}"
+)
+# Splits the quota equally between running jobs
+OPEN_WEATHER_RATE_LIMIT_FAIR_SHARE = (
+    os.getenv("OPEN_WEATHER_RATE_LIMIT_FAIR_SHARE", "1") == "1"
+)
+OPEN_WEATHER_MAX_IN_FLIGHT = int(os.getenv("OPEN_WEATHER_MAX_IN_FLIGHT", "10"))
+# AIMD on the requests in flight: halved on 429s, 5xx, timeouts and calls
+# slower than LATENCY_TARGET seconds (0 to ignore latency), raised back by
+# one per round trip up to MAX_IN_FLIGHT
+OPEN_WEATHER_ADAPTIVE_CONCURRENCY = (
+    os.getenv("OPEN_WEATHER_ADAPTIVE_CONCURRENCY", "1") == "1"
+)
+OPEN_WEATHER_MIN_IN_FLIGHT = int(os.getenv("OPEN_WEATHER_MIN_IN_FLIGHT", "1"))
+OPEN_WEATHER_LATENCY_TARGET = float(os.getenv("OPEN_WEATHER_LATENCY_TARGET", "0"))
+# Retries of a call after a 429 (waiting for its Retry-After), 5xx or
+# timeout, with full jitter exponential backoff from RETRY_BACKOFF seconds
+OPEN_WEATHER_MAX_RETRIES = int(os.getenv("OPEN_WEATHER_MAX_RETRIES", "3"))
+OPEN_WEATHER_RETRY_BACKOFF = float(os.getenv("OPEN_WEATHER_RETRY_BACKOFF", "0.5"))
+OPEN_WEATHER_RETRY_BACKOFF_MAX = float(
+    os.getenv("OPEN_WEATHER_RETRY_BACKOFF_MAX", "30")
+)
+# Consecutive failed calls after which upstream is considered down and left
+# alone for BREAKER_RESET_TIMEOUT seconds
+OPEN_WEATHER_BREAKER_THRESHOLD = int(os.getenv("OPEN_WEATHER_BREAKER_THRESHOLD", "10"))
+OPEN_WEATHER_BREAKER_RESET_TIMEOUT = float(
+    os.getenv("OPEN_WEATHER_BREAKER_RESET_TIMEOUT", "30")
+)
+
+# Process-wide pooled HTTP client used for every upstream call. HTTP/2 needs the
+# optional h2 package (pip install httpx[http2]).
+OPEN_WEATHER_POOL_SIZE = int(os.getenv("OPEN_WEATHER_POOL_SIZE", "20"))
+OPEN_WEATHER_KEEPALIVE_EXPIRY = float(os.getenv("OPEN_WEATHER_KEEPALIVE_EXPIRY", "30"))
+OPEN_WEATHER_HTTP2 = os.getenv("OPEN_WEATHER_HTTP2", "0") == "1"
+OPEN_WEATHER_CONNECT_TIMEOUT = float(os.getenv("OPEN_WEATHER_CONNECT_TIMEOUT", "5"))
+OPEN_WEATHER_REQUEST_TIMEOUT = float(os.getenv("OPEN_WEATHER_REQUEST_TIMEOUT", "10"))
+
+# Cities collected when a POST names none: the OPEN_WEATHER_DEFAULT_CITY_SET
+# city set once `load_cities` has run, else the IDs listed in the file
+OPEN_WEATHER_CITIES_FILE = os.getenv(
+    "OPEN_WEATHER_CITIES_FILE", str(BASE_DIR / "cities_id_list.txt")
+)
+OPEN_WEATHER_DEFAULT_CITY_SET = os.getenv("OPEN_WEATHER_DEFAULT_CITY_SET", "default")
+
+# JSON library for upstream responses, streams and JSON fields: "orjson",
+# "json" (standard library) or "auto" to use orjson when it is installed
+OPEN_WEATHER_JSON_BACKEND = os.getenv("OPEN_WEATHER_JSON_BACKEND", "auto")
+
+OPEN_WEATHER_BATCH_SIZE = int(os.getenv("OPEN_WEATHER_BATCH_SIZE", "10"))
+# Readings are also stored once this many seconds passed since the last
+# checkpoint, so streams see slow batches city by city.
+OPEN_WEATHER_FLUSH_INTERVAL = float(os.getenv("OPEN_WEATHER_FLUSH_INTERVAL", "1"))
+# Fetching only waits for the database once this many cities are unsaved
+OPEN_WEATHER_WRITE_BUFFER_MAX = int(os.getenv("OPEN_WEATHER_WRITE_BUFFER_MAX", "1000"))
+# "single" calls /weather once per city, "group" packs up to GROUP_SIZE cities
+# (at most 20) into each /group call, falling back to single calls on errors.
+OPEN_WEATHER_FETCH_STRATEGY = os.getenv("OPEN_WEATHER_FETCH_STRATEGY", "single")
+OPEN_WEATHER_GROUP_SIZE = int(os.getenv("OPEN_WEATHER_GROUP_SIZE", "20"))
+
+# Background collection (`python manage.py collect_worker`)
+OPEN_WEATHER_WORKER_CONCURRENCY = int(os.getenv("OPEN_WEATHER_WORKER_CONCURRENCY", "4"))
+OPEN_WEATHER_WORKER_POLL_INTERVAL = float(
+    os.getenv("OPEN_WEATHER_WORKER_POLL_INTERVAL", "1")
+)
+OPEN_WEATHER_STREAM_POLL_INTERVAL = float(
+    os.getenv("OPEN_WEATHER_STREAM_POLL_INTERVAL", "0.5")
+)
+# Seconds of silence after which a stream sends a heartbeat to keep proxies
+# from closing the connection
+OPEN_WEATHER_STREAM_HEARTBEAT = float(os.getenv("OPEN_WEATHER_STREAM_HEARTBEAT", "15"))
+# Readings per page of /results/<user_defined_id>/
+OPEN_WEATHER_RESULTS_PAGE_SIZE = int(os.getenv("OPEN_WEATHER_RESULTS_PAGE_SIZE", "100"))
+OPEN_WEATHER_RESULTS_MAX_PAGE_SIZE = int(
+    os.getenv("OPEN_WEATHER_RESULTS_MAX_PAGE_SIZE", "1000")
+)
+# Readings read from the database and encoded at a time by exports; also the
+# size of Parquet row groups and Arrow record batches
+OPEN_WEATHER_EXPORT_BATCH_SIZE = int(os.getenv("OPEN_WEATHER_EXPORT_BATCH_SIZE", "5000"))
+# Packs the readings of jobs that collected every city into typed arrays:
+# "database" (a blob per job), "file" (memory-mapped files in COMPACT_DIR)
+# or empty to keep them as rows.
+OPEN_WEATHER_COMPACT_STORAGE = os.getenv("OPEN_WEATHER_COMPACT_STORAGE", "")
+OPEN_WEATHER_COMPACT_DIR = os.getenv(
+    "OPEN_WEATHER_COMPACT_DIR", str(BASE_DIR / "archives")
+)
+# Seconds the rows of a compacted job are kept once its archive is written,
+# so streams and result pages that started on the rows finish on them; the
+# workers delete them afterwards. 0 deletes them along with the compaction.
+OPEN_WEATHER_COMPACT_GRACE = float(os.getenv("OPEN_WEATHER_COMPACT_GRACE", "60"))
+# Archives the raw upstream responses of every job as compressed NDJSON
+# segments in RAW_ARCHIVE_DIR, for replay_weather: "gzip", "zstd" (needs the
+# zstandard package) or empty to keep only the readings. While set, the
+# observation cache keeps whole responses too, so cached cities are archived.
+OPEN_WEATHER_RAW_ARCHIVE = os.getenv("OPEN_WEATHER_RAW_ARCHIVE", "")
+OPEN_WEATHER_RAW_ARCHIVE_DIR = os.getenv(
+    "OPEN_WEATHER_RAW_ARCHIVE_DIR", str(BASE_DIR / "raw")
+)
+# Responses per segment file; segments are replayed in parallel
+OPEN_WEATHER_RAW_ARCHIVE_SEGMENT_SIZE = int(
+    os.getenv("OPEN_WEATHER_RAW_ARCHIVE_SEGMENT_SIZE", "10000")
+)
+# Rollups kept up to date as readings are stored: hour, day or both (empty
+# to disable), served by /rollups/
+OPEN_WEATHER_ROLLUP_PERIODS = os.getenv("OPEN_WEATHER_ROLLUP_PERIODS", "hour,day")
+# Seconds between checks for due collections by `python manage.py run_scheduler`
+OPEN_WEATHER_SCHEDULER_POLL_INTERVAL = float(
+    os.getenv("OPEN_WEATHER_SCHEDULER_POLL_INTERVAL", "5")
+)
+# Prometheus metrics, served at /metrics by the web process and on
+# METRICS_PORT (0 to disable) by each `collect_worker`
+OPEN_WEATHER_METRICS = os.getenv("OPEN_WEATHER_METRICS", "1") == "1"
+OPEN_WEATHER_METRICS_PORT = int(os.getenv("OPEN_WEATHER_METRICS_PORT", "0"))
+# Profiling of requests to /collect/ and /progress/: every request with
+# PROFILE_REQUESTS, else those sending an X-Profile header from a staff user
+# or with an X-Profile-Token equal to PROFILE_TOKEN. PROFILER is cprofile or
+# sampling (needs pyinstrument); profiles are saved to PROFILE_DIR.
+OPEN_WEATHER_PROFILE_REQUESTS = os.getenv("OPEN_WEATHER_PROFILE_REQUESTS", "0") == "1"
+OPEN_WEATHER_PROFILE_TOKEN = os.getenv("OPEN_WEATHER_PROFILE_TOKEN", "")
+OPEN_WEATHER_PROFILER = os.getenv("OPEN_WEATHER_PROFILER", "cprofile")
+OPEN_WEATHER_PROFILE_DIR = os.getenv(
+    "OPEN_WEATHER_PROFILE_DIR", "/tmp/open_weather_profiles"
+)
+# Trace spans of the fetch, parse, persist and stream stages, kept per process
+# (the last SPAN_BUFFER ones) and saved every SPAN_FLUSH_INTERVAL seconds for
+# /debug/spans/
+OPEN_WEATHER_TRACE_SPANS = os.getenv("OPEN_WEATHER_TRACE_SPANS", "1") == "1"
+OPEN_WEATHER_SPAN_BUFFER = int(os.getenv("OPEN_WEATHER_SPAN_BUFFER", "1000"))
+OPEN_WEATHER_SPAN_FLUSH_INTERVAL = float(
+    os.getenv("OPEN_WEATHER_SPAN_FLUSH_INTERVAL", "5")
+)
+# Extra passes over the cities that failed, run at the end of a job
+OPEN_WEATHER_RETRY_PASSES = int(os.getenv("OPEN_WEATHER_RETRY_PASSES", "1"))
+# Running jobs that have not checkpointed for this long can be resumed
+OPEN_WEATHER_JOB_STALE_AFTER = float(os.getenv("OPEN_WEATHER_JOB_STALE_AFTER", "120"))
+
+# Cache of per-city observations shared by collection jobs. The backend is one
+# of open_weather_api.cache.{Local,Django,Database}ObservationCache (empty to
+# disable); responses younger than CACHE_TTL seconds are not fetched again.
+OPEN_WEATHER_CACHE_BACKEND = os.getenv(
+    "OPEN_WEATHER_CACHE_BACKEND", "open_weather_api.cache.LocalObservationCache"
+)
+OPEN_WEATHER_CACHE_TTL = float(os.getenv("OPEN_WEATHER_CACHE_TTL", "600"))
+OPEN_WEATHER_CACHE_MAX_ENTRIES = int(
+    os.getenv("OPEN_WEATHER_CACHE_MAX_ENTRIES", "50000")
+)
+OPEN_WEATHER_CACHE_ALIAS = os.getenv("OPEN_WEATHER_CACHE_ALIAS", "default")
+# Coalesces concurrent fetches of the same city: "local" within a worker,
+# "shared" also across workers (needs a Django or database observation cache
+# and leases held at most SINGLE_FLIGHT_LEASE seconds), empty to disable.
+OPEN_WEATHER_SINGLE_FLIGHT = os.getenv("OPEN_WEATHER_SINGLE_FLIGHT", "local")
+OPEN_WEATHER_SINGLE_FLIGHT_LEASE = float(
+    os.getenv("OPEN_WEATHER_SINGLE_FLIGHT_LEASE", "60")
+)
+OPEN_WEATHER_SINGLE_FLIGHT_POLL_INTERVAL = float(
+    os.getenv("OPEN_WEATHER_SINGLE_FLIGHT_POLL_INTERVAL", "0.2")
+)
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
@@ -64,6 +233,7 @@ MIDDLEWARE = [
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
+    "open_weather_api.profiling.ProfilingMiddleware",
 ]
 
 ROOT_URLCONF = "open_weather_project.urls"
@@ -93,9 +263,16 @@ WSGI_APPLICATION = "open_weather_project.wsgi.application"
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+        "NAME": os.getenv("SQLITE_PATH", BASE_DIR / "db.sqlite3"),
+        # Seconds a writer waits for the lock held by another process
+        "OPTIONS": {"timeout": float(os.getenv("OPEN_WEATHER_SQLITE_BUSY_TIMEOUT", "20"))},
     }
 }
+# The web processes, workers and scheduler all write to the same SQLite file:
+# WAL lets readers go on while one of them writes, and synchronous=NORMAL
+# only syncs at checkpoints. Empty values keep SQLite's defaults.
+OPEN_WEATHER_SQLITE_JOURNAL_MODE = os.getenv("OPEN_WEATHER_SQLITE_JOURNAL_MODE", "wal")
+OPEN_WEATHER_SQLITE_SYNCHRONOUS = os.getenv("OPEN_WEATHER_SQLITE_SYNCHRONOUS", "normal")
 
 
 # Password validation